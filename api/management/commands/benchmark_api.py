@@ -0,0 +1,58 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from api.v1.benchmark import BENCHMARK_ENDPOINTS, BenchmarkRunner
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures the p50/p95/p99 latency and the throughput of every /api/v1/ endpoint against the current database, '
+        'usually seeded with seed_benchmark. Requests go through the whole Django stack in process, without a server.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', action='append', dest='endpoints', metavar='NAME',
+                            help='Endpoint to benchmark, can be repeated, all of them by default')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests sent first')
+        parser.add_argument('--concurrency', type=int, default=1, help='Threads sending the requests')
+        parser.add_argument('--seed', type=int, default=1, help='Seed of the sampled ids and search terms')
+        parser.add_argument('--serializers', action='store_true',
+                            help='Render the lists with the serializers instead of api.v1.compiled, to compare them')
+        parser.add_argument('--output', help='File receiving the results as JSON')
+
+    def handle(self, *args, **options):
+        endpoints = BENCHMARK_ENDPOINTS
+        if options['endpoints']:
+            names = {endpoint.name: endpoint for endpoint in BENCHMARK_ENDPOINTS}
+            unknown = set(options['endpoints']) - set(names)
+            if unknown:
+                raise CommandError('Unknown endpoints: {}. Available: {}'.format(
+                    ', '.join(sorted(unknown)), ', '.join(names)
+                ))
+            endpoints = [names[name] for name in options['endpoints']]
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('At least one request and one thread are required')
+        if settings.DEBUG:
+            self.stderr.write('DEBUG is on, query logging and the debug toolbar inflate the timings')
+        runner = BenchmarkRunner(endpoints, options['requests'], options['warmup'], options['concurrency'],
+                                 options['seed'])
+        self.stdout.write('{:<28}{:>9}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+            'endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'
+        ))
+        with override_settings(API_COMPILED_LISTS=not options['serializers']):
+            results = runner.run(self.write_result)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'concurrency': options['concurrency'], 'compiled_lists': not options['serializers'],
+                           'endpoints': results}, output, indent=2)
+
+    def write_result(self, endpoint, result):
+        if result is None:
+            self.stdout.write('{:<28}skipped, no matching user or data'.format(endpoint.name))
+            return
+        self.stdout.write('{:<28}{:>9}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            endpoint.name, result['requests'], result['errors'], result['p50'] * 1000, result['p95'] * 1000,
+            result['p99'] * 1000, result['throughput']
+        ))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from api.v1.export import BookExporter, Exporter, UserBookRelationExporter
+from catalog.models import Book, UserBookRelation
+
+EXPORTS = {
+    'books': (BookExporter, Book),
+    'book_relations': (UserBookRelationExporter, UserBookRelation),
+}
+
+
+class Command(BaseCommand):
+    help = 'Dumps books or book relations as NDJSON or CSV, streaming them in primary key ordered chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', choices=sorted(EXPORTS), help='What to export')
+        parser.add_argument('--output-format', choices=sorted(Exporter.formats), default='ndjson')
+        parser.add_argument('--output', help='Destination file, the standard output by default')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Number of rows read per query')
+
+    def handle(self, *args, **options):
+        exporter_class, model = EXPORTS[options['export']]
+        exporter = exporter_class(model.objects.all(), options['chunk_size'])
+        chunks = exporter.iter_format(options['output_format'])
+        if not options['output']:
+            for data in chunks:
+                self.stdout.write(data, ending='')
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            output.writelines(chunks)
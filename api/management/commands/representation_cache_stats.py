@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from api.v1.cache import representation_cache
+
+
+class Command(BaseCommand):
+    help = 'Prints the hit/miss counters of the shared book representation cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        if representation_cache.cache is None:
+            self.stdout.write('Book representation cache is disabled')
+            return
+        stats = representation_cache.get_stats()
+        total = stats['hits'] + stats['misses']
+        self.stdout.write('hits: {hits}\nmisses: {misses}'.format(**stats))
+        self.stdout.write('hit ratio: {:.1%}'.format(stats['hits'] / total if total else 0))
+        if options['reset']:
+            representation_cache.reset_stats()
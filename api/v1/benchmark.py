@@ -0,0 +1,235 @@
+import itertools
+import random
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Max, Min
+from django.urls import reverse
+from django.utils.http import urlencode
+from rest_framework.test import APIClient
+from catalog.models import Author, Book, Category, UserBookRelation, UserLibraryStats
+
+
+class Endpoint(object):
+    def __init__(self, name, route, args=None, params=None, data=None, method='get', user=None):
+        # args, params and data may be callables taking the context (a test case or a BenchmarkRunner), called for
+        # every request; user names an attribute of the context, None sends the request anonymously
+        self.name = name
+        self.route = route
+        self.args = args
+        self.params = params
+        self.data = data
+        self.method = method
+        self.user = user
+
+    @staticmethod
+    def resolve(value, context):
+        return value(context) if callable(value) else value
+
+    def build(self, context):
+        url = reverse(self.route, args=self.resolve(self.args, context) or ())
+        params = self.resolve(self.params, context)
+        if params:
+            url = '{}?{}'.format(url, urlencode(params))
+        return url, self.resolve(self.data, context)
+
+
+def percentile(values, percent):
+    # nearest rank of sorted values
+    return values[max(int(round(percent / 100 * len(values))) - 1, 0)]
+
+
+BOOKS = 'api:v1:book-list'
+RELATIONS = 'api:v1:userbookrelation-list'
+
+BENCHMARK_ENDPOINTS = (
+    Endpoint('authors', 'api:v1:author-list'),
+    Endpoint('author', 'api:v1:author-detail', lambda run: (run.pick('author'),)),
+    Endpoint('author autocomplete', 'api:v1:author-autocomplete', params=lambda run: {'q': run.pick('author_prefix')}),
+    Endpoint('categories', 'api:v1:category-list'),
+    Endpoint('category', 'api:v1:category-detail', lambda run: (run.pick('category'),)),
+    Endpoint('books', BOOKS),
+    Endpoint('books as user', BOOKS, user='user'),
+    Endpoint('books expanded', BOOKS, params={'expand': '1'}, user='user'),
+    Endpoint('books sparse', BOOKS, params={'fields': 'id,title,price'}),
+    Endpoint('books large page', BOOKS, params={'limit': 500}, user='user'),
+    Endpoint('books large page expanded', BOOKS, params={'limit': 500, 'expand': '1'}, user='user'),
+    Endpoint('books deep offset', BOOKS, params=lambda run: {'offset': run.book_count // 2}),
+    Endpoint('books cursor', BOOKS, params={'pagination': 'cursor', 'ordering': '-rating_avg'}),
+    Endpoint('books in category', BOOKS, params=lambda run: {'categories': run.pick('category')}, user='user'),
+    Endpoint('books by year', BOOKS, params=lambda run: {'year_published': run.pick('year')}),
+    Endpoint('book', 'api:v1:book-detail', lambda run: (run.pick('book'),), user='user'),
+    Endpoint('book expanded', 'api:v1:book-detail', lambda run: (run.pick('book'),), {'expand': '1'}, user='user'),
+    Endpoint('book update', 'api:v1:book-detail', lambda run: (run.pick('book'),), data={'discount': 10},
+             method='patch', user='admin'),
+    Endpoint('book search', 'api:v1:book-search', params=lambda run: {'q': run.pick('term')}, user='user'),
+    Endpoint('book autocomplete', 'api:v1:book-autocomplete', params=lambda run: {'q': run.pick('title_prefix')}),
+    Endpoint('similar books', 'api:v1:book-similar', lambda run: (run.pick('book'),), user='user'),
+    Endpoint('top books', 'api:v1:book-top', params={'by': 'rating'}),
+    Endpoint('top books in category', 'api:v1:book-top',
+             params=lambda run: {'by': 'wishlist', 'period': 'week', 'category': run.pick('category')}),
+    Endpoint('book export', 'api:v1:book-export',
+             params=lambda run: {'output': 'csv', 'year_published': run.pick('year')}),
+    Endpoint('relations', RELATIONS, user='user'),
+    Endpoint('relations expanded', RELATIONS, params={'expand': '1'}, user='user'),
+    Endpoint('relations bookmarked', RELATIONS, params={'in_bookmarks': 'true'}, user='user'),
+    Endpoint('relations cursor', RELATIONS, params={'pagination': 'cursor'}, user='user'),
+    Endpoint('relations as staff', RELATIONS, params=lambda run: {'user': run.pick('reader')}, user='admin'),
+    Endpoint('relation', 'api:v1:userbookrelation-detail', lambda run: (run.pick('relation'),), user='user'),
+    Endpoint('relation update', 'api:v1:userbookrelation-detail', lambda run: (run.pick('relation'),),
+             data={'rating': 5}, method='patch', user='user'),
+    Endpoint('relation create', RELATIONS, data=lambda run: {'book': run.pick('unread_book'), 'in_wishlist': True},
+             method='post', user='user'),
+    Endpoint('relations bulk', 'api:v1:userbookrelation-bulk', method='post', user='user',
+             data=lambda run: [{'book': run.pick('book'), 'rating': 4} for _ in range(50)]),
+    Endpoint('library summary', 'api:v1:userbookrelation-summary', user='user'),
+    Endpoint('relation export', 'api:v1:userbookrelation-export', params=lambda run: {'user': run.pick('reader')},
+             user='admin'),
+)
+
+
+class BenchmarkRunner(object):
+    """
+    Replays the v1 endpoints in process, through the middleware and the views, against the configured database
+    (typically filled by seed_benchmark) and reports latency percentiles and throughput. Ids and search terms are
+    drawn from samples of the dataset, the requesting user is the heaviest reader. Writes run in rolled back
+    transactions so the dataset is left unchanged.
+    """
+
+    def __init__(self, endpoints=BENCHMARK_ENDPOINTS, requests=200, warmup=10, concurrency=1, seed=1,
+                 sample_size=1000):
+        self.endpoints = endpoints
+        self.requests = requests
+        self.warmup = warmup
+        self.concurrency = concurrency
+        self.rng = random.Random(seed)
+        self.sample_size = sample_size
+        # the host the requests are sent to has to pass ALLOWED_HOSTS
+        self.host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        self.load_samples()
+
+    def sample_ids(self, queryset):
+        bounds = queryset.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            return []
+        span = range(bounds['first'], bounds['last'] + 1)
+        candidates = self.rng.sample(span, min(self.sample_size, len(span)))
+        return sorted(queryset.filter(pk__in=candidates).values_list('pk', flat=True))
+
+    def load_samples(self):
+        user_model = get_user_model()
+        stats = UserLibraryStats.objects.filter(user__is_staff=False).order_by('-rating_count', 'user_id').first()
+        self.user = stats.user if stats else user_model.objects.filter(is_staff=False).order_by('pk').first()
+        self.admin = user_model.objects.filter(is_staff=True).order_by('pk').first()
+        self.book_count = Book.objects.count()
+        books = list(Book.objects.filter(pk__in=self.sample_ids(Book.objects.all())).values_list(
+            'pk', 'title', 'year_published'
+        ))
+        self.samples = {
+            'book': [pk for pk, _, _ in books],
+            'unread_book': list(Book.objects.exclude(pk__in=UserBookRelation.objects.filter(user=self.user).values(
+                'book_id'
+            )).values_list('pk', flat=True)[:self.sample_size]),
+            'term': [title.split()[0].lower() for _, title, _ in books if title.strip()],
+            'title_prefix': [title[:3].lower() for _, title, _ in books if title.strip()],
+            'year': [year for _, _, year in books if year is not None],
+            'author': self.sample_ids(Author.objects.all()),
+            'author_prefix': [name[:3].lower() for name in Author.objects.filter(
+                pk__in=self.sample_ids(Author.objects.all())
+            ).values_list('name', flat=True) if name],
+            'category': self.sample_ids(Category.objects.all()),
+            'reader': self.sample_ids(user_model.objects.filter(is_staff=False)),
+            'relation': list(UserBookRelation.objects.filter(user=self.user).order_by('pk').values_list(
+                'pk', flat=True
+            )[:self.sample_size]),
+        }
+
+    def pick(self, name):
+        if not self.samples[name]:
+            raise LookupError('No {} in the dataset'.format(name.replace('_', ' ')))
+        return self.rng.choice(self.samples[name])
+
+    def send(self, client, endpoint, url, data):
+        response = getattr(client, endpoint.method)(url, data)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def request(self, client, endpoint):
+        url, data = endpoint.build(self)
+        started = time.perf_counter()
+        try:
+            if endpoint.method == 'get':
+                response = self.send(client, endpoint, url, data)
+            else:
+                with transaction.atomic():
+                    response = self.send(client, endpoint, url, data)
+                    transaction.set_rollback(True)
+            failed = response.status_code >= 400
+        except DatabaseError:
+            # e.g. a locked SQLite database under concurrent writes
+            failed = True
+        return time.perf_counter() - started, failed
+
+    def get_client(self, user):
+        client = APIClient(SERVER_NAME=self.host)
+        if user:
+            client.force_authenticate(user)
+        return client
+
+    def run_endpoint(self, endpoint):
+        user = getattr(self, endpoint.user) if endpoint.user else None
+        try:
+            endpoint.build(self)
+        except LookupError:
+            return None
+        if endpoint.user and user is None:
+            return None
+        client = self.get_client(user)
+        for _ in range(self.warmup):
+            self.request(client, endpoint)
+        counter, latencies, errors = itertools.count(), [], []
+
+        def worker(client):
+            while next(counter) < self.requests:
+                elapsed, failed = self.request(client, endpoint)
+                latencies.append(elapsed)
+                errors.extend([elapsed] if failed else [])
+
+        def thread_worker():
+            try:
+                worker(self.get_client(user))
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        if self.concurrency > 1:
+            threads = [threading.Thread(target=thread_worker) for _ in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            worker(client)
+        seconds = time.perf_counter() - started
+        latencies.sort()
+        return OrderedDict([
+            ('requests', len(latencies)),
+            ('errors', len(errors)),
+            ('p50', percentile(latencies, 50)),
+            ('p95', percentile(latencies, 95)),
+            ('p99', percentile(latencies, 99)),
+            ('mean', sum(latencies) / len(latencies)),
+            ('throughput', len(latencies) / seconds),
+        ])
+
+    def run(self, on_result=None):
+        results = OrderedDict()
+        for endpoint in self.endpoints:
+            results[endpoint.name] = self.run_endpoint(endpoint)
+            if on_result:
+                on_result(endpoint, results[endpoint.name])
+        return results
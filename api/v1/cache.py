@@ -0,0 +1,136 @@
+import uuid
+import zlib
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+from rest_framework.serializers import BaseSerializer, ListSerializer
+
+PROCESS_LOCAL_BACKENDS = (LocMemCache, DummyCache)
+
+
+def serialize_fields(instance, fields):
+    ret = OrderedDict()
+    for field in fields:
+        try:
+            attribute = field.get_attribute(instance)
+        except SkipField:
+            continue
+        check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+        ret[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+    return ret
+
+
+class RepresentationCache(object):
+    """
+    Caches the user independent part of serialized books. Every book has a version token of its own, replaced on
+    invalidation, so stale representations are simply never read again and expire with the timeout.
+    """
+    version_key = 'book_representation:version:{}'
+    representation_key = 'book_representation:{}:{}:{}'
+    counter_key = 'book_representation:{}'
+
+    @property
+    def cache(self):
+        alias = getattr(settings, 'BOOK_REPRESENTATION_CACHE', None)
+        if not alias:
+            return None
+        cache = caches[alias]
+        # an invalidation in one worker process would never reach the copies of the others
+        return None if isinstance(cache, PROCESS_LOCAL_BACKENDS) else cache
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'BOOK_REPRESENTATION_CACHE_TIMEOUT', 60 * 60)
+
+    def get_versions(self, book_ids):
+        keys = {book_id: self.version_key.format(book_id) for book_id in book_ids}
+        found = self.cache.get_many(keys.values())
+        versions = {}
+        for book_id, key in keys.items():
+            if key not in found:
+                # add() never replaces a token set by a concurrent invalidation
+                self.cache.add(key, uuid.uuid4().hex, None)
+                found[key] = self.cache.get(key)
+            versions[book_id] = found[key]
+        return versions
+
+    def invalidate(self, book_ids):
+        if self.cache is None or not book_ids:
+            return
+        self.cache.set_many({self.version_key.format(book_id): uuid.uuid4().hex for book_id in book_ids}, None)
+
+    def count(self, counter, delta):
+        if not delta:
+            return
+        key = self.counter_key.format(counter)
+        try:
+            self.cache.incr(key, delta)
+        except ValueError:
+            if not self.cache.add(key, delta, None):
+                self.cache.incr(key, delta)
+
+    def get_stats(self):
+        counters = self.cache.get_many([self.counter_key.format('hits'), self.counter_key.format('misses')])
+        return {counter: counters.get(self.counter_key.format(counter), 0) for counter in ('hits', 'misses')}
+
+    def reset_stats(self):
+        self.cache.delete_many([self.counter_key.format('hits'), self.counter_key.format('misses')])
+
+    def represent(self, serializer, instances):
+        fields = list(serializer._readable_fields)
+        shared_fields = [field for field in fields if serializer.is_field_cacheable(field)]
+        if self.cache is None or not shared_fields:
+            return [serializer.serialize_fields(instance, fields) for instance in instances]
+        variant = '{:x}'.format(zlib.crc32('{}:{}'.format(
+            type(serializer).__name__, ','.join(field.field_name for field in shared_fields)
+        ).encode('utf-8')))
+        versions = self.get_versions({instance.pk for instance in instances})
+        keys = {instance.pk: self.representation_key.format(instance.pk, versions[instance.pk], variant)
+                for instance in instances}
+        cached = self.cache.get_many(keys.values())
+        missed = {}
+        result = []
+        for instance in instances:
+            shared = cached.get(keys[instance.pk])
+            if shared is None:
+                shared = missed[keys[instance.pk]] = serializer.serialize_fields(instance, shared_fields)
+            representation = OrderedDict()
+            for field in fields:
+                if field.field_name in shared:
+                    representation[field.field_name] = shared[field.field_name]
+                elif not serializer.is_field_cacheable(field):
+                    representation.update(serializer.serialize_fields(instance, [field]))
+            result.append(representation)
+        if missed:
+            self.cache.set_many(missed, self.timeout)
+        self.count('hits', len(instances) - len(missed))
+        self.count('misses', len(missed))
+        return result
+
+
+representation_cache = RepresentationCache()
+
+
+class CachedRepresentationListSerializer(ListSerializer):
+    def to_representation(self, data):
+        return representation_cache.represent(self.child, list(data.all() if hasattr(data, 'all') else data))
+
+
+class CachedRepresentationSerializerMixin(object):
+    # per-user fields, merged into the cached representation on every request
+    uncached_fields = ()
+
+    def is_field_cacheable(self, field):
+        return field.field_name not in self.uncached_fields and not isinstance(field, BaseSerializer)
+
+    def serialize_fields(self, instance, fields):
+        return serialize_fields(instance, fields)
+
+    def to_representation(self, instance):
+        if self.parent is not None:
+            return super().to_representation(instance)
+        return representation_cache.represent(self, [instance])[0]
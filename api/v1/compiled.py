@@ -0,0 +1,280 @@
+import decimal
+from collections import OrderedDict
+from types import SimpleNamespace
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import fields, relations, serializers
+from rest_framework.settings import api_settings
+from .cache import CachedRepresentationListSerializer, CachedRepresentationSerializerMixin
+
+# to_representation() of the serializers rendering their readable fields one after the other
+FIELD_BY_FIELD_REPRESENTATIONS = (
+    serializers.Serializer.to_representation,
+    serializers.ListSerializer.to_representation,
+    CachedRepresentationSerializerMixin.to_representation,
+    CachedRepresentationListSerializer.to_representation,
+)
+
+
+class NotCompilable(Exception):
+    pass
+
+
+def identity(value):
+    return value
+
+
+def decimal_converter(field):
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if not coerce_to_string or field.localize or field.decimal_places is None or field.max_digits is None:
+        return field.to_representation
+    exponent, max_digits = -field.decimal_places, field.max_digits
+
+    def convert(value):
+        # a column of the same scale is already quantized, anything else goes through the field
+        if type(value) is decimal.Decimal:
+            _, digits, value_exponent = value.as_tuple()
+            if value_exponent == exponent and len(digits) <= max_digits:
+                return '{:f}'.format(value)
+        return field.to_representation(value)
+    return convert
+
+
+def value_converter(field):
+    field_type = type(field)
+    if field_type is fields.IntegerField:
+        return int
+    if field_type is fields.FloatField:
+        return float
+    if field_type is fields.CharField:
+        return str
+    if field_type is fields.DecimalField:
+        return decimal_converter(field)
+    return field.to_representation
+
+
+def column_getter(index, convert):
+    if convert is identity:
+        return lambda row, page: row[index]
+
+    def get(row, page):
+        value = row[index]
+        return None if value is None else convert(value)
+    return get
+
+
+def property_getter(fget, presence, dependencies, convert):
+    def get(row, page):
+        if presence is not None and row[presence] is None:
+            return None
+        value = fget(SimpleNamespace(**{attr: row[index] for attr, index in dependencies}))
+        return None if value is None else convert(value)
+    return get
+
+
+def user_data_getter(index, key, default):
+    def get(row, page):
+        relation = page['user_book_relations'].get(row[index])
+        return relation[key] if relation else default
+    return get
+
+
+def nested_getter(presence, getters):
+    def get(row, page):
+        if row[presence] is None:
+            return None
+        return OrderedDict([(name, getter(row, page)) for name, getter in getters])
+    return get
+
+
+def many_getter(index, loader, getters):
+    if getters is None:
+        return lambda row, page: [related[1] for related in page[loader].get(row[index], ())]
+
+    def get(row, page):
+        return [OrderedDict([(name, getter(related, page)) for name, getter in getters])
+                for related in page[loader].get(row[index], ())]
+    return get
+
+
+def prefetch_querysets(queryset):
+    # relation -> queryset of its Prefetch, the related rows are read the way they would have been prefetched
+    return {lookup.prefetch_to: lookup.queryset for lookup in queryset._prefetch_related_lookups
+            if isinstance(lookup, Prefetch) and lookup.queryset is not None}
+
+
+def compile_list(serializer):
+    # None when the list can't be rendered from rows the same way
+    if type(serializer).to_representation not in FIELD_BY_FIELD_REPRESENTATIONS:
+        return None
+    try:
+        return CompiledRepresentation(serializer.child)
+    except NotCompilable:
+        return None
+
+
+class ManyRelationLoader(object):
+    # rows of a many-to-many relation for a whole page, each one starting with the pk of the row it belongs to
+    def __init__(self, lookup, model_field, paths):
+        self.lookup = lookup
+        self.model = model_field.related_model
+        self.query_name = model_field.related_query_name()
+        self.paths = paths
+
+    def load(self, ids, querysets):
+        queryset = querysets.get(self.lookup, self.model._default_manager.all())
+        related = {}
+        for row in queryset.filter(**{self.query_name + '__in': ids}).values_list(self.query_name, *self.paths):
+            related.setdefault(row[0], []).append(row)
+        return related
+
+
+class CompiledRepresentation(object):
+    """
+    The representation of a read-only serializer compiled into getters of values_list() rows: each field becomes a
+    column, or the columns of a property, and the conversion its field applies, so a list page is rendered from
+    tuples without model instances or the field machinery, exactly as the serializer would render it. Many-to-many
+    relations are read for the whole page by a query each. Raises NotCompilable for anything it can't render the same.
+
+    Serializers declare what the compiler can't guess: the model fields their property fields are computed from
+    (property_field_dependencies) and the user_book_relations values behind their SerializerMethodFields
+    (user_data_fields).
+    """
+
+    def __init__(self, serializer, model=None, leading_paths=()):
+        self.model = model or serializer.Meta.model
+        self.paths = list(leading_paths)
+        self.loaders = []
+        self.getters = self.compile_serializer(serializer, self.model, '')
+        self.pk_index = self.add_path(self.model._meta.pk.name)
+
+    def add_path(self, path):
+        if path not in self.paths:
+            self.paths.append(path)
+        return self.paths.index(path)
+
+    def column(self, rows, path):
+        index = self.paths.index(path)
+        return [row[index] for row in rows]
+
+    def values(self, queryset):
+        return queryset.prefetch_related(None).values_list(*self.paths)
+
+    def represent(self, rows, context, querysets=None):
+        page = dict(context)
+        if self.loaders:
+            ids = [row[self.pk_index] for row in rows]
+            for loader in self.loaders:
+                page[loader] = loader.load(ids, querysets or {})
+        getters = self.getters
+        return [OrderedDict([(name, getter(row, page)) for name, getter in getters]) for row in rows]
+
+    @staticmethod
+    def get_model_field(model, attr):
+        try:
+            return model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            return None
+
+    def compile_serializer(self, serializer, model, prefix):
+        if type(serializer).to_representation not in FIELD_BY_FIELD_REPRESENTATIONS:
+            raise NotCompilable('{} has its own to_representation()'.format(type(serializer).__name__))
+        return [(field.field_name, self.compile_field(serializer, field, model, prefix))
+                for field in serializer._readable_fields]
+
+    def compile_field(self, serializer, field, model, prefix):
+        field_type = type(field)
+        if field_type is serializers.SerializerMethodField:
+            return self.compile_user_data(serializer, field, model, prefix)
+        if field_type is relations.PrimaryKeyRelatedField and field.pk_field is None:
+            model_field = self.get_relation(field, model, ('many_to_one', 'one_to_one'))
+            return column_getter(self.add_path(prefix + model_field.name), identity)
+        if field_type is relations.ManyRelatedField and type(field.child_relation) is relations.PrimaryKeyRelatedField \
+                and field.child_relation.pk_field is None:
+            return self.compile_many(field, None, model, prefix)
+        if isinstance(field, serializers.ListSerializer):
+            return self.compile_many(field, field.child, model, prefix)
+        if isinstance(field, serializers.BaseSerializer):
+            return self.compile_nested(field, model, prefix)
+        if field_type.get_attribute is not fields.Field.get_attribute or field.source == '*':
+            raise NotCompilable('{} reads its own attribute'.format(field.field_name))
+        return self.compile_value(serializer, field, model, prefix)
+
+    def get_relation(self, field, model, kinds):
+        if len(field.source_attrs) != 1:
+            raise NotCompilable('{} is not a relation of {}'.format(field.field_name, model.__name__))
+        model_field = self.get_model_field(model, field.source)
+        if model_field is None or not model_field.is_relation or not model_field.concrete or \
+                not any(getattr(model_field, kind) for kind in kinds):
+            raise NotCompilable('{} is not a relation of {}'.format(field.field_name, model.__name__))
+        return model_field
+
+    def compile_user_data(self, serializer, field, model, prefix):
+        user_data = getattr(serializer, 'user_data_fields', {})
+        if field.field_name not in user_data or field.method_name != 'get_{}'.format(field.field_name):
+            raise NotCompilable('{} is computed by {}'.format(field.field_name, field.method_name))
+        key, default = user_data[field.field_name]
+        return user_data_getter(self.add_path(prefix + model._meta.pk.name), key, default)
+
+    def compile_many(self, field, child, model, prefix):
+        if prefix:
+            raise NotCompilable('{} is a nested many-to-many relation'.format(field.field_name))
+        model_field = self.get_relation(field, model, ('many_to_many',))
+        if child is None:
+            loader = ManyRelationLoader(field.source, model_field, [model_field.related_model._meta.pk.name])
+            getters = None
+        else:
+            if type(field).to_representation not in FIELD_BY_FIELD_REPRESENTATIONS:
+                raise NotCompilable('{} has its own to_representation()'.format(type(field).__name__))
+            # the pk of the row the related row belongs to comes first
+            compiled = CompiledRepresentation(child, model_field.related_model, [model_field.related_query_name()])
+            if compiled.loaders:
+                raise NotCompilable('{} has many-to-many relations'.format(field.field_name))
+            loader = ManyRelationLoader(field.source, model_field, compiled.paths[1:])
+            getters = compiled.getters
+        self.loaders.append(loader)
+        return many_getter(self.add_path(prefix + model._meta.pk.name), loader, getters)
+
+    def compile_nested(self, field, model, prefix):
+        if len(field.source_attrs) != 1:
+            raise NotCompilable('{} is not a relation of {}'.format(field.field_name, model.__name__))
+        model_field = self.get_single_relation(model, field.source)
+        nested_prefix = '{}{}__'.format(prefix, field.source)
+        getters = self.compile_serializer(field, model_field.related_model, nested_prefix)
+        return nested_getter(self.add_path(nested_prefix + 'pk'), getters)
+
+    def get_single_relation(self, model, attr):
+        # a foreign key or a one-to-one relation of either side, reverse ones under their accessor name
+        model_field = self.get_model_field(model, attr)
+        if model_field is None or not model_field.is_relation or \
+                not (model_field.many_to_one or model_field.one_to_one) or \
+                not model_field.concrete and model_field.get_accessor_name() != attr:
+            raise NotCompilable('{} is not a single relation of {}'.format(attr, model.__name__))
+        return model_field
+
+    def compile_value(self, serializer, field, model, prefix):
+        owner, owner_prefix = model, prefix
+        for attr in field.source_attrs[:-1]:
+            model_field = self.get_single_relation(owner, attr)
+            if model_field.concrete and model_field.null:
+                # a missing object skips the field instead of rendering None
+                raise NotCompilable('{} reads through the nullable {}'.format(field.field_name, attr))
+            owner, owner_prefix = model_field.related_model, '{}{}__'.format(owner_prefix, attr)
+        attr = field.source_attrs[-1]
+        model_field = self.get_model_field(owner, attr)
+        if model_field is not None:
+            if model_field.is_relation or not model_field.concrete or model_field.attname != attr:
+                raise NotCompilable('{} is not a column of {}'.format(field.field_name, owner.__name__))
+            return column_getter(self.add_path(owner_prefix + attr), value_converter(field))
+        dependencies = getattr(serializer, 'property_field_dependencies', {}).get(field.field_name)
+        attribute = getattr(owner, attr, None)
+        if dependencies is None or not isinstance(attribute, property):
+            raise NotCompilable('{} reads {}.{}'.format(field.field_name, owner.__name__, attr))
+        for dependency in dependencies:
+            model_field = self.get_model_field(owner, dependency)
+            if model_field is None or model_field.is_relation or not model_field.concrete:
+                raise NotCompilable('{} depends on {}'.format(field.field_name, dependency))
+        presence = self.add_path(owner_prefix + 'pk') if owner_prefix != prefix else None
+        return property_getter(attribute.fget, presence,
+                               [(dependency, self.add_path(owner_prefix + dependency)) for dependency in dependencies],
+                               value_converter(field))
@@ -0,0 +1,84 @@
+import csv
+from collections import OrderedDict
+from django.core.serializers.json import DjangoJSONEncoder
+from catalog.models import Book
+
+
+class Echo(object):
+    def write(self, value):
+        return value
+
+
+class Exporter(object):
+    """
+    Dumps a queryset as NDJSON or CSV in primary key ordered chunks, reading plain value tuples instead of model
+    instances and serializers, so memory stays flat however many rows are exported.
+    """
+    # the primary key has to come first
+    fields = ('id',)
+    formats = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv',
+    }
+
+    def __init__(self, queryset, chunk_size=2000):
+        self.queryset = queryset
+        self.chunk_size = chunk_size
+
+    def iter_chunks(self):
+        queryset, last_pk = self.queryset.order_by('pk').values_list(*self.fields), None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            rows = [OrderedDict(zip(self.fields, row)) for row in chunk[:self.chunk_size]]
+            if not rows:
+                return
+            self.prepare_chunk(rows)
+            yield rows
+            last_pk = rows[-1][self.fields[0]]
+
+    def prepare_chunk(self, rows):
+        pass
+
+    def get_columns(self):
+        return list(self.fields)
+
+    def iter_ndjson(self):
+        encoder = DjangoJSONEncoder(ensure_ascii=False)
+        for rows in self.iter_chunks():
+            yield ''.join(encoder.encode(row) + '\n' for row in rows)
+
+    def iter_csv(self):
+        writer = csv.writer(Echo())
+        columns = self.get_columns()
+        yield writer.writerow(columns)
+        for rows in self.iter_chunks():
+            yield ''.join(writer.writerow([self.csv_value(row[column]) for column in columns]) for row in rows)
+
+    @staticmethod
+    def csv_value(value):
+        if isinstance(value, (list, tuple)):
+            return '|'.join(str(item) for item in value)
+        return '' if value is None else value
+
+    def iter_format(self, output_format):
+        return self.iter_csv() if output_format == 'csv' else self.iter_ndjson()
+
+
+class BookExporter(Exporter):
+    fields = ('id', 'title', 'title_original', 'year_published', 'description', 'isbn', 'cover_type',
+              'price_original', 'discount', 'discount_total', 'price', 'author', 'publisher', 'discount_group')
+
+    def prepare_chunk(self, rows):
+        categories = {row['id']: [] for row in rows}
+        memberships = Book.categories.through.objects.filter(book_id__in=list(categories)).order_by('category_id')
+        for book_id, category_id in memberships.values_list('book_id', 'category_id'):
+            categories[book_id].append(category_id)
+        for row in rows:
+            row['categories'] = categories[row['id']]
+
+    def get_columns(self):
+        return super().get_columns() + ['categories']
+
+
+class UserBookRelationExporter(Exporter):
+    fields = ('id', 'user', 'book', 'in_bookmarks', 'in_wishlist', 'rating', 'updated_at')
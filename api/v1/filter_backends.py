@@ -1,6 +1,7 @@
 from django_filters.rest_framework import FilterSet
 from rest_framework.filters import BaseFilterBackend
-from catalog.models import UserBookRelation
+from catalog.models import Book, UserBookRelation
+from .pagination import order_keyset
 
 
 class StaffAccessFilter(BaseFilterBackend):
@@ -10,7 +11,20 @@ class StaffAccessFilter(BaseFilterBackend):
         return queryset
 
 
+class KeysetOrderingFilter(BaseFilterBackend):
+    def filter_queryset(self, request, queryset, view):
+        if 'ordering' not in request.query_params:
+            return queryset
+        return order_keyset(queryset, view.get_keyset_ordering())
+
+
 class UserBookRelationFilter(FilterSet):
     class Meta:
         model = UserBookRelation
-        fields = ('user', 'book')
+        fields = ('user', 'book', 'in_bookmarks', 'in_wishlist')
+
+
+class BookFilter(FilterSet):
+    class Meta:
+        model = Book
+        fields = ('isbn', 'year_published', 'title', 'categories')
@@ -1,18 +1,308 @@
+import hashlib
+from django.conf import settings
+from django.db.models import Model, Prefetch, QuerySet
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework import viewsets
+from rest_framework.decorators import list_route
+from rest_framework.response import Response
+from rest_framework.utils.serializer_helpers import ReturnList
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.exceptions import ParseError
 from catalog.models import UserBookRelation
+from library import routers
+from ..compiled import compile_list, prefetch_querysets
+from ..pagination import KeysetPagination
+
+
+class ExpandRelation(object):
+    def __init__(self, lookup, queryset=None, collapsed_queryset=None):
+        # relations with a queryset are prefetched, the rest are joined with select_related;
+        # collapsed_queryset is prefetched when the relation is rendered without being expanded (e.g. pk lists)
+        self.lookup = lookup
+        self.queryset = queryset
+        self.collapsed_queryset = collapsed_queryset
+
+
+class SparseFieldsetViewSetMixin(viewsets.GenericViewSet):
+    # serializer field -> model fields it reads, for fields not backed by a model field of the same name
+    sparse_field_dependencies = {}
+
+    def get_sparse_fieldset(self):
+        if self.request.method not in SAFE_METHODS:
+            return None, None
+        if not hasattr(self, '_sparse_fieldset'):
+            fieldset = []
+            for param in ('fields', 'omit'):
+                value = self.request.query_params.get(param)
+                fieldset.append(None if value is None else {name.strip() for name in value.split(',') if name.strip()})
+            if fieldset != [None, None]:
+                available = set(self.get_serializer_class()().fields)
+                unknown = set().union(*(names for names in fieldset if names)) - available
+                if unknown:
+                    raise ParseError('Unknown fields: {}'.format(', '.join(sorted(unknown))))
+            self._sparse_fieldset = tuple(fieldset)
+        return self._sparse_fieldset
+
+    def is_field_requested(self, field_name):
+        fields, omit = self.get_sparse_fieldset()
+        return (fields is None or field_name in fields) and (omit is None or field_name not in omit)
+
+    def get_deferred_fields(self, model):
+        fields, omit = self.get_sparse_fieldset()
+        if fields is None and omit is None:
+            return []
+        required = set()
+        for field_name, field in self.get_serializer_class()().fields.items():
+            if not self.is_field_requested(field_name):
+                continue
+            if field_name in self.sparse_field_dependencies:
+                required.update(self.sparse_field_dependencies[field_name])
+            elif field.source != '*':
+                required.add(field.source.split('.')[0])
+        model_fields = {field.name for field in model._meta.concrete_fields}
+        if not required <= model_fields | {field.name for field in model._meta.get_fields()}:
+            # something is read from a property we know nothing about, loading every column is the safe choice
+            return []
+        return [field.name for field in model._meta.concrete_fields
+                if not field.primary_key and not field.is_relation and field.name not in required]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        deferred = self.get_deferred_fields(queryset.model)
+        return queryset.defer(*deferred) if deferred else queryset
+
+    def get_serializer(self, *args, **kwargs):
+        fields, omit = self.get_sparse_fieldset()
+        if fields is not None:
+            kwargs['fields'] = fields
+        if omit is not None:
+            kwargs['omit'] = omit
+        return super().get_serializer(*args, **kwargs)
 
 
 class ExpandableViewSetMixin(viewsets.GenericViewSet):
     serializer_expanded_class = None
+    # expand selector (e.g. 'book.author') -> ExpandRelation
+    expandable_relations = {}
+    expand_all_values = ('1', 'true', 'True', 'yes')
+
+    def get_expand(self):
+        value = self.request.GET.get('expand', '')
+        if not value:
+            return frozenset()
+        if value in self.expand_all_values:
+            return frozenset(self.serializer_expanded_class.default_expand)
+        selectors = {selector.strip() for selector in value.split(',') if selector.strip()}
+        unknown = selectors - set(self.expandable_relations)
+        if unknown:
+            raise ParseError('Unknown expand selectors: {}'.format(', '.join(sorted(unknown))))
+        for selector in list(selectors):
+            while '.' in selector:
+                selector = selector.rpartition('.')[0]
+                selectors.add(selector)
+        return frozenset(selectors)
 
     def should_expand(self):
-        return self.request.GET.get('expand', False)
+        return bool(self.get_expand())
+
+    def is_field_requested(self, field_name):
+        # overridden by SparseFieldsetViewSetMixin, which has to precede this mixin
+        return True
+
+    def plan_expand(self, queryset, expand):
+        select_related, prefetch_related = [], []
+        for selector, relation in sorted(self.expandable_relations.items()):
+            parent = selector.rpartition('.')[0]
+            if parent and parent not in expand or not self.is_field_requested(selector.split('.')[0]):
+                continue
+            if selector not in expand:
+                if relation.collapsed_queryset is not None:
+                    prefetch_related.append(Prefetch(relation.lookup, queryset=relation.collapsed_queryset.all()))
+            elif relation.queryset is not None:
+                prefetch_related.append(Prefetch(relation.lookup, queryset=relation.queryset.all()))
+            else:
+                select_related.append(relation.lookup)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+    def get_queryset(self):
+        return self.plan_expand(super().get_queryset(), self.get_expand())
 
     def get_serializer_class(self):
         if self.should_expand():
             return self.serializer_expanded_class
         return super().get_serializer_class()
 
+    def get_serializer(self, *args, **kwargs):
+        if self.should_expand():
+            kwargs['expand'] = self.get_expand()
+        return super().get_serializer(*args, **kwargs)
+
+
+class KeysetPaginationViewSetMixin(viewsets.GenericViewSet):
+    keyset_pagination_class = KeysetPagination
+    # public ordering name -> ORM path; every ordering is tie-broken by the primary key, or by the (path, tie-break
+    # path) pair given: a column of a related table is tie-broken by that table's key, so its index can drive the scan
+    keyset_orderings = {'id': 'id'}
+    default_keyset_ordering = 'id'
+    keyset_pagination_actions = ('list',)
+
+    def use_keyset_pagination(self):
+        if self.action not in self.keyset_pagination_actions:
+            return False
+        query_params = self.request.query_params
+        return query_params.get('pagination') == 'cursor' or 'cursor' in query_params
+
+    @property
+    def paginator(self):
+        if not self.use_keyset_pagination():
+            return super().paginator
+        if not isinstance(getattr(self, '_paginator', None), self.keyset_pagination_class):
+            self._paginator = self.keyset_pagination_class()
+        return self._paginator
+
+    def get_keyset_ordering_name(self):
+        name = self.request.query_params.get('ordering', self.default_keyset_ordering)
+        if name.lstrip('-') not in self.keyset_orderings:
+            raise ParseError('Unknown ordering: {}'.format(name))
+        return name
+
+    def get_keyset_ordering(self):
+        name = self.get_keyset_ordering_name()
+        descending = name.startswith('-')
+        path = self.keyset_orderings[name.lstrip('-')]
+        path, tie_break = path if isinstance(path, tuple) else (path, 'id')
+        ordering = [(path, descending)]
+        if path != 'id':
+            ordering.append((tie_break, descending))
+        return ordering
+
+
+class NotModified(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+class ConditionalGetViewSetMixin(viewsets.GenericViewSet):
+    """
+    ETag validation of list and detail responses, fingerprinting the (pk, updated_at) of the rows being served: a
+    list page is validated once it has been read, before it is serialized, so only its own rows are looked at.
+    """
+    # index of the pk in the values_list() rows paginated instead of instances
+    row_pk_index = None
+    validate_page = False
+    etag = None
+
+    def get_validator_querysets(self, queryset):
+        # every queryset whose rows end up in the response, given the queryset of the served instances
+        return [queryset]
+
+    def get_validator(self, queryset):
+        # (pk, updated_at) lists see changed and deleted rows alike, so there is an ETag and no Last-Modified
+        parts = [self.request.get_full_path(), self.request.META.get('HTTP_ACCEPT', ''), self.request.user.pk]
+        if self.validate_page:
+            parts.extend(getattr(self.paginator, name, None) for name in ('count', 'has_next', 'has_previous'))
+        for validator_queryset in self.get_validator_querysets(queryset):
+            parts.append(list(validator_queryset.order_by('pk').values_list('pk', 'updated_at')))
+        return quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+    def check_validator(self, queryset):
+        self.etag = self.get_validator(queryset)
+        response = get_conditional_response(self.request, etag=self.etag)
+        if response is not None:
+            raise NotModified(response)
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if self.validate_page:
+            if page is None:
+                served = queryset.values('pk')
+            elif self.row_pk_index is None:
+                served = [obj.pk for obj in page]
+            else:
+                served = [row[self.row_pk_index] for row in page]
+            self.check_validator(queryset.model._default_manager.filter(pk__in=served))
+        return page
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        try:
+            response = handler(request, *args, **kwargs)
+        except NotModified as not_modified:
+            response = not_modified.response
+        if self.etag is not None:
+            response['ETag'] = self.etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        self.validate_page = True
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        def handler(request, *args, **kwargs):
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            self.check_validator(self.filter_queryset(self.get_queryset()).filter(
+                **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+            ))
+            return super(ConditionalGetViewSetMixin, self).retrieve(request, *args, **kwargs)
+        return self.conditional_response(handler, request, *args, **kwargs)
+
+
+class AutocompleteViewSetMixin(viewsets.GenericViewSet):
+    # catalog.autocomplete.PrefixIndex serving the autocomplete route
+    autocomplete_index = None
+    autocomplete_limit = 10
+    autocomplete_max_limit = 50
+
+    def get_autocomplete_limit(self):
+        try:
+            limit = int(self.request.query_params.get('limit', self.autocomplete_limit))
+        except ValueError:
+            raise ParseError('Invalid limit')
+        return max(1, min(limit, self.autocomplete_max_limit))
+
+    @list_route()
+    def autocomplete(self, request):
+        matches = self.autocomplete_index.lookup(request.query_params.get('q', ''), self.get_autocomplete_limit())
+        return Response([{'id': pk, 'label': label} for pk, label in matches])
+
+
+class ExportViewSetMixin(viewsets.GenericViewSet):
+    # api.v1.export.Exporter subclass streaming the rows of the viewset queryset
+    exporter_class = None
+    export_chunk_size = 2000
+    export_permission_classes = None
+
+    def get_permissions(self):
+        if self.action == 'export' and self.export_permission_classes is not None:
+            return [permission() for permission in self.export_permission_classes]
+        return super().get_permissions()
+
+    @list_route()
+    def export(self, request):
+        # "format" is taken by the renderer negotiation
+        output_format = request.query_params.get('output', 'ndjson')
+        if output_format not in self.exporter_class.formats:
+            raise ParseError('Unknown output: {}'.format(output_format))
+        exporter = self.exporter_class(self.filter_queryset(self.queryset.all()), self.export_chunk_size)
+        response = StreamingHttpResponse(exporter.iter_format(output_format),
+                                         content_type=self.exporter_class.formats[output_format])
+        response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+            self.queryset.model._meta.model_name, output_format
+        )
+        return response
+
+
+class ReplicaViewSetMixin(viewsets.GenericViewSet):
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # the user is only known after the authentication
+        routers.use_primary_after_write(request.user)
+
 
 class StaffViewSetMixin(viewsets.GenericViewSet):
     staff_serializer_class = None
@@ -23,21 +313,90 @@ class StaffViewSetMixin(viewsets.GenericViewSet):
         return super().get_serializer_class()
 
 
+class UserBookRelationIndex(object):
+    def __init__(self, relations):
+        self.relations = relations
+        self._index = None
+
+    def get(self, book_id):
+        if self._index is None:
+            self._index = {relation['book_id']: relation for relation in self.relations}
+        return self._index.get(book_id)
+
+
 class PrefetchUserData(viewsets.GenericViewSet):
+    # attribute of the serialized instance holding the id of the book the user data is fetched for
+    user_data_book_field = 'id'
+
     @classmethod
-    def get_extra_context(cls, user=None):
-        context = {
-            'user_book_relations': UserBookRelation.objects.none()
-        }
+    def get_extra_context(cls, user=None, book_ids=None):
+        relations = UserBookRelation.objects.none()
         if user and user.pk:
-            context.update({
-                'user_book_relations': UserBookRelation.objects.filter(user=user).values(
-                    'book__id', 'user__id', 'in_bookmarks', 'in_wishlist', 'rating'
-                )
-            })
-        return context
-
-    def get_serializer_context(self):
-        context = super().get_serializer_context()
-        context.update(PrefetchUserData.get_extra_context(self.request.user))
-        return context
+            relations = UserBookRelation.objects.filter(user=user)
+            if book_ids is not None:
+                relations = relations.filter(book_id__in=book_ids)
+        return {
+            'user_book_relations': UserBookRelationIndex(
+                relations.values('book_id', 'user_id', 'in_bookmarks', 'in_wishlist', 'rating')
+            )
+        }
+
+    def get_user_data_book_ids(self, instance):
+        if instance is None:
+            return []
+        if isinstance(instance, QuerySet):
+            return instance.values(self.user_data_book_field)
+        if isinstance(instance, Model):
+            instance = [instance]
+        return [getattr(obj, self.user_data_book_field) for obj in instance]
+
+    def get_serializer(self, *args, **kwargs):
+        serializer_class = self.get_serializer_class()
+        kwargs['context'] = self.get_serializer_context()
+        instance = args[0] if args else kwargs.get('instance')
+        kwargs['context'].update(self.get_extra_context(self.request.user, self.get_user_data_book_ids(instance)))
+        return serializer_class(*args, **kwargs)
+
+
+class CompiledListViewSetMixin(viewsets.GenericViewSet):
+    """
+    Renders the list pages from values_list() rows with the serializer compiled by api.v1.compiled, skipping model
+    instances and the serializer fields. Lists whose serializer can't be compiled, or all of them when
+    API_COMPILED_LISTS is off, are rendered by the serializer.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        # unordered rows come in the order of the query plan, which changes with the columns read: both renderings
+        # have to page through the same order
+        if self.action == 'list' and not queryset.ordered:
+            queryset = queryset.order_by('pk')
+        return queryset
+
+    def get_compiled_representation(self):
+        if not getattr(settings, 'API_COMPILED_LISTS', True):
+            return None, None
+        serializer = self.get_serializer(many=True)
+        return serializer, compile_list(serializer)
+
+    def list(self, request, *args, **kwargs):
+        serializer, compiled = self.get_compiled_representation()
+        if compiled is None:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        if isinstance(self, PrefetchUserData):
+            compiled.add_path(self.user_data_book_field)
+        if isinstance(self.paginator, KeysetPagination):
+            # the cursors are read from the rows
+            for path, _ in self.get_keyset_ordering():
+                compiled.add_path(path)
+            self.paginator.row_paths = compiled.paths
+        self.row_pk_index = compiled.pk_index
+        rows = compiled.values(queryset)
+        page = self.paginate_queryset(rows)
+        rows = list(rows) if page is None else page
+        context = serializer.context
+        if isinstance(self, PrefetchUserData):
+            context.update(self.get_extra_context(request.user, compiled.column(rows, self.user_data_book_field)))
+        data = ReturnList(compiled.represent(rows, context, prefetch_querysets(queryset)), serializer=serializer)
+        return Response(data) if page is None else self.get_paginated_response(data)
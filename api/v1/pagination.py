@@ -0,0 +1,167 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import F, Q
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def order_by_expressions(model, ordering):
+    # NULL sorts as the smallest value on every backend so the keyset filters stay the same; explicit NULLS
+    # FIRST/LAST is only requested where the backend differs, since SQLite emulates it and loses the index
+    expressions = []
+    for path, descending in ordering:
+        if connection.features.nulls_order_largest and is_nullable(model, path):
+            expressions.append(F(path).desc(nulls_last=True) if descending else F(path).asc(nulls_first=True))
+        else:
+            expressions.append(F(path).desc() if descending else F(path).asc())
+    return expressions
+
+
+def order_keyset(queryset, ordering):
+    # a tie-break on a related table needs the row of that table, the inner join lets its index lead the scan
+    for path, descending in ordering[1:]:
+        if '__' in path:
+            queryset = queryset.filter(**{path + '__isnull': False})
+    return queryset.order_by(*order_by_expressions(queryset.model, ordering))
+
+
+def resolve_path(instance, path):
+    for attr in path.split('__'):
+        instance = getattr(instance, attr, None)
+    return instance
+
+
+def get_path_field(model, path):
+    field = None
+    for attr in path.split('__'):
+        field = model._meta.get_field(attr)
+        model = field.related_model
+    return field
+
+
+def is_nullable(model, path):
+    return get_path_field(model, path).null
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a stable (field, pk) ordering: every page is an index range scan
+    starting right after the last row of the previous page, and no count query is run.
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    default_limit = api_settings.PAGE_SIZE
+    max_limit = 1000
+    invalid_cursor_message = _('Invalid cursor')
+    template = None
+    # paths of the columns when values_list() rows are paginated instead of instances
+    row_paths = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.base_url = request.build_absolute_uri()
+        self.ordering = view.get_keyset_ordering()
+        self.ordering_name = view.get_keyset_ordering_name()
+        self.cursor = self.decode_cursor(request, queryset.model)
+        reverse = bool(self.cursor and self.cursor['reverse'])
+        ordering = [(path, descending != reverse) for path, descending in self.ordering]
+
+        queryset = order_keyset(queryset, ordering)
+        if self.cursor:
+            queryset = queryset.filter(self.get_keyset_filter(queryset.model, ordering, self.cursor['position']))
+        results = list(queryset[:self.limit + 1])
+        self.page = results[:self.limit]
+        has_more = len(results) > self.limit
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    def get_keyset_filter(self, model, ordering, position):
+        # rows strictly after `position`: after(c1) or (c1 equal and after(c2, ...)), where NULL is the smallest value;
+        # the leading column is kept as a single range condition so the ordering index can be used
+        condition = None
+        for (path, descending), value in reversed(list(zip(ordering, position))):
+            if value is None:
+                after = None if descending else Q(**{path + '__isnull': False})
+                equal = Q(**{path + '__isnull': True})
+            else:
+                after = Q(**{path + ('__lt' if descending else '__gt'): value})
+                equal = Q(**{path: value})
+            tail = equal & condition if condition is not None else None
+            if value is not None and tail is not None:
+                condition = Q(**{path + ('__lte' if descending else '__gte'): value}) & (after | tail)
+            elif after is not None and tail is not None:
+                condition = after | tail
+            else:
+                condition = after if after is not None else tail
+            if value is not None and descending and is_nullable(model, path):
+                condition |= Q(**{path + '__isnull': True})
+        return condition
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(request.query_params[self.limit_query_param], strict=True, cutoff=self.max_limit)
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    def get_position(self, instance):
+        position = []
+        for path, descending in self.ordering:
+            if self.row_paths is None:
+                value = resolve_path(instance, path)
+            else:
+                value = instance[self.row_paths.index(path)]
+            position.append(str(value) if isinstance(value, Decimal) else value)
+        return position
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            if cursor['ordering'] != self.ordering_name or len(cursor['position']) != len(self.ordering):
+                raise ValueError(cursor)
+            cursor['reverse'] = bool(cursor['reverse'])
+            # a tampered position fails here rather than in the query
+            cursor['position'] = [None if value is None else get_path_field(model, path).to_python(value)
+                                  for (path, _), value in zip(self.ordering, cursor['position'])]
+        except (TypeError, ValueError, KeyError, UnicodeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, instance, reverse):
+        cursor = {'ordering': self.ordering_name, 'position': self.get_position(instance), 'reverse': reverse}
+        encoded = urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
@@ -1,43 +1,114 @@
 from rest_framework import serializers
-from catalog.models import Book, Author, Category, UserBookRelation
+from catalog.models import Book, Author, Category, UserBookRelation, UserLibraryStats
 from catalog import logic as catalog_logic
+from .cache import CachedRepresentationListSerializer, CachedRepresentationSerializerMixin
+
+
+class ExpandableSerializerMixin(object):
+    # field name -> (serializer class, serializer kwargs) used when the field is expanded
+    expandable_fields = {}
+    default_expand = ()
+
+    def __init__(self, *args, **kwargs):
+        expand = kwargs.pop('expand', None)
+        self.expand = frozenset(self.default_expand if expand is None else expand)
+        super().__init__(*args, **kwargs)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        for field_name, (serializer_class, kwargs) in self.expandable_fields.items():
+            if field_name not in self.expand:
+                continue
+            if issubclass(serializer_class, ExpandableSerializerMixin):
+                prefix = field_name + '.'
+                kwargs = dict(kwargs, expand={selector[len(prefix):] for selector in self.expand
+                                              if selector.startswith(prefix)})
+            fields[field_name] = serializer_class(**kwargs)
+        return fields
+
+
+class SparseFieldsetSerializerMixin(object):
+    def __init__(self, *args, **kwargs):
+        self.sparse_fields = kwargs.pop('fields', None)
+        self.sparse_omit = kwargs.pop('omit', None)
+        super().__init__(*args, **kwargs)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        for field_name in list(fields):
+            if self.sparse_fields is not None and field_name not in self.sparse_fields or \
+                    self.sparse_omit is not None and field_name in self.sparse_omit:
+                del fields[field_name]
+        return fields
+
+
+class AuthorSerializer(SparseFieldsetSerializerMixin, serializers.ModelSerializer):
+    # field read from a model property -> model fields the property reads, for api.v1.compiled
+    property_field_dependencies = {
+        'full_name': ('name', 'family_name'),
+    }
 
-
-class AuthorSerializer(serializers.ModelSerializer):
     class Meta:
         model = Author
         fields = ('id', 'name', 'family_name', 'full_name', 'about')
 
 
-class CategorySerializer(serializers.ModelSerializer):
-    book_average_price = serializers.DecimalField(max_digits=6, decimal_places=2, read_only=True)
-    book_count = serializers.IntegerField(read_only=True)
+class CategorySerializer(SparseFieldsetSerializerMixin, serializers.ModelSerializer):
+    book_average_price = serializers.DecimalField(max_digits=6, decimal_places=2, read_only=True,
+                                                  source='stats.book_average_price')
+    book_count = serializers.IntegerField(read_only=True, source='stats.book_count')
+    property_field_dependencies = {
+        'book_average_price': ('book_price_sum', 'book_priced_count'),
+    }
 
     class Meta:
         model = Category
         fields = ('id', 'name', 'description', 'book_average_price', 'book_count')
 
 
-class BookSerializer(serializers.ModelSerializer):
+class BookSerializer(SparseFieldsetSerializerMixin, ExpandableSerializerMixin, CachedRepresentationSerializerMixin,
+                     serializers.ModelSerializer):
+    # user data and the relation aggregates change without touching the book, so they are never cached
+    uncached_fields = ('in_bookmarks', 'rating', 'in_wishlist', 'rating_avg', 'rating_count', 'rating_histogram',
+                       'bookmark_count', 'wishlist_count')
+    expandable_fields = {
+        'author': (AuthorSerializer, {'read_only': True}),
+        'categories': (CategorySerializer, {'many': True, 'read_only': True}),
+    }
+    property_field_dependencies = {
+        'rating_histogram': tuple('rating_{}_count'.format(value) for value in catalog_logic.RATINGS),
+    }
+    # SerializerMethodField -> (key of the user_book_relations entry, value without an entry), for api.v1.compiled
+    user_data_fields = {
+        'in_bookmarks': ('in_bookmarks', False),
+        'rating': ('rating', None),
+        'in_wishlist': ('in_wishlist', False),
+    }
     in_bookmarks = serializers.SerializerMethodField()
     in_wishlist = serializers.SerializerMethodField()
     rating = serializers.SerializerMethodField()
     discount_total = serializers.DecimalField(max_digits=6, decimal_places=2, read_only=True)
     price = serializers.DecimalField(max_digits=6, decimal_places=2, read_only=True)
+    rating_avg = serializers.FloatField(read_only=True, source='stats.rating_avg')
+    rating_count = serializers.IntegerField(read_only=True, source='stats.rating_count')
+    rating_histogram = serializers.DictField(child=serializers.IntegerField(), read_only=True,
+                                             source='stats.rating_histogram')
+    bookmark_count = serializers.IntegerField(read_only=True, source='stats.bookmark_count')
+    wishlist_count = serializers.IntegerField(read_only=True, source='stats.wishlist_count')
 
     class Meta:
         model = Book
         fields = (
             'id', 'title', 'title_original', 'year_published', 'description', 'author', 'categories', 'in_bookmarks',
-            'rating', 'in_wishlist', 'price', 'discount', 'discount_total', 'price_original'
+            'rating', 'in_wishlist', 'price', 'discount', 'discount_total', 'price_original', 'rating_avg',
+            'rating_count', 'rating_histogram', 'bookmark_count', 'wishlist_count'
         )
+        list_serializer_class = CachedRepresentationListSerializer
 
     def get_relation(self, book):
         if 'user_book_relations' not in self.context:
             raise NotImplementedError('User data relation not prefetched; prefetch data to avoid N+1 problem')
-        for relation in self.context['user_book_relations']:
-            if relation['book__id'] == book.id:
-                return relation
+        return self.context['user_book_relations'].get(book.id)
 
     def get_in_bookmarks(self, book):
         relation = self.get_relation(book)
@@ -54,11 +125,13 @@ class BookSerializer(serializers.ModelSerializer):
 
 
 class ExpandedBookSerializer(BookSerializer):
-    author = AuthorSerializer(read_only=True)
-    categories = CategorySerializer(many=True, read_only=True)
+    default_expand = ('author', 'categories')
 
 
-class UserBookRelationSerializer(serializers.ModelSerializer):
+class UserBookRelationSerializer(SparseFieldsetSerializerMixin, ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {
+        'book': (BookSerializer, {'read_only': True}),
+    }
     user = serializers.HiddenField(default=serializers.CurrentUserDefault())
 
     class Meta:
@@ -67,7 +140,7 @@ class UserBookRelationSerializer(serializers.ModelSerializer):
 
 
 class ExpandedUserBookRelationSerializer(UserBookRelationSerializer):
-    book = BookSerializer(read_only=True)
+    default_expand = ('book',)
 
 
 class StaffBookRelationSerializer(UserBookRelationSerializer):
@@ -76,3 +149,17 @@ class StaffBookRelationSerializer(UserBookRelationSerializer):
     class Meta:
         model = UserBookRelation
         fields = ('id', 'user', 'book', 'in_wishlist', 'in_bookmarks', 'rating')
+
+
+class BulkUserBookRelationSerializer(serializers.Serializer):
+    # the book id is resolved for the whole batch at once by UserBookRelation.objects.bulk_upsert()
+    book = serializers.IntegerField(min_value=1)
+    in_bookmarks = serializers.BooleanField(required=False)
+    in_wishlist = serializers.BooleanField(required=False)
+    rating = serializers.ChoiceField(choices=UserBookRelation.RATING_CHOICES, allow_null=True, required=False)
+
+
+class UserLibraryStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UserLibraryStats
+        fields = ('bookmark_count', 'wishlist_count', 'rating_count', 'updated_at')
@@ -0,0 +1,48 @@
+from django.db.models.signals import pre_delete, post_delete, post_save, m2m_changed
+from django.dispatch import receiver
+from catalog.models import Author, Book, Category, DiscountGroup, books_bulk_changed
+from .cache import representation_cache
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def invalidate_book(sender, instance, **kwargs):
+    representation_cache.invalidate([instance.pk])
+
+
+@receiver(books_bulk_changed, sender=Book)
+def invalidate_bulk_changed_books(sender, book_ids, **kwargs):
+    representation_cache.invalidate(book_ids)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=DiscountGroup)
+def invalidate_related_books(sender, instance, raw=False, **kwargs):
+    if not raw:
+        representation_cache.invalidate(list(instance.books.values_list('id', flat=True)))
+
+
+@receiver(pre_delete, sender=Category)
+@receiver(pre_delete, sender=DiscountGroup)
+def remember_related_books(sender, instance, **kwargs):
+    instance.invalidated_book_ids = list(instance.books.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=DiscountGroup)
+def invalidate_remembered_books(sender, instance, **kwargs):
+    representation_cache.invalidate(instance.invalidated_book_ids)
+
+
+@receiver(m2m_changed, sender=Book.categories.through)
+def invalidate_book_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance.invalidated_book_ids = list(instance.books.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            representation_cache.invalidate([instance.pk])
+        elif action == 'post_clear':
+            representation_cache.invalidate(instance.invalidated_book_ids)
+        else:
+            representation_cache.invalidate(pk_set)
@@ -0,0 +1,83 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+# path of the JSON report with the query count and wall time of every endpoint at every size
+REPORT_ENV = 'API_BUDGET_REPORT'
+
+
+class QueryBudgetMixin(object):
+    """
+    Requests every api.v1.benchmark.Endpoint after seeding the database at each of budget_sizes and fails when the
+    number of queries of an endpoint changes with the size, which is how an N+1 query shows up. Every request runs in
+    a rolled back savepoint with cold caches, so writes can be measured as well and sizes only differ by what seed()
+    adds.
+    """
+    budget_sizes = (3, 6, 12)
+    budget_endpoints = ()
+    # requests per endpoint and size, the fastest is reported
+    budget_repeat = 3
+
+    def seed(self, size):
+        raise NotImplementedError('seed() must grow the test data to the given size')
+
+    def reset_caches(self):
+        pass
+
+    def request_endpoint(self, endpoint):
+        # a fresh client, logging out of the previous one would create a session
+        client = self.client_class()
+        if endpoint.user:
+            client.force_authenticate(getattr(self, endpoint.user))
+        url, data = endpoint.build(self)
+        response = getattr(client, endpoint.method)(url, data)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def measure(self, endpoint):
+        queries, seconds = None, None
+        for _ in range(self.budget_repeat):
+            self.reset_caches()
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = self.request_endpoint(endpoint)
+                    elapsed = time.perf_counter() - started
+                transaction.set_rollback(True)
+            self.assertLess(response.status_code, 400, '{} failed: {}'.format(endpoint.name, response.status_code))
+            if queries is None:
+                queries = [query['sql'] for query in captured.captured_queries]
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        return queries, seconds
+
+    def test_query_budgets(self):
+        results = OrderedDict((endpoint.name, OrderedDict()) for endpoint in self.budget_endpoints)
+        queries = {}
+        for size in self.budget_sizes:
+            self.seed(size)
+            for endpoint in self.budget_endpoints:
+                queries[endpoint.name, size], seconds = self.measure(endpoint)
+                results[endpoint.name][size] = {'queries': len(queries[endpoint.name, size]), 'seconds': seconds}
+        self.write_report(results)
+        smallest = self.budget_sizes[0]
+        for endpoint in self.budget_endpoints:
+            for size in self.budget_sizes[1:]:
+                with self.subTest(endpoint=endpoint.name, size=size):
+                    self.assertEqual(
+                        len(queries[endpoint.name, smallest]), len(queries[endpoint.name, size]),
+                        'Query count of {} grows with the data:\n{}'.format(
+                            endpoint.name, '\n'.join(queries[endpoint.name, size])
+                        )
+                    )
+
+    def write_report(self, results):
+        path = os.environ.get(REPORT_ENV)
+        if not path:
+            return
+        report = {'database': connection.vendor, 'endpoints': results}
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
@@ -53,10 +53,9 @@ class BookFactory(DjangoModelFactory):
                 self.categories.add(category)
             return
 
-        categories = Category.objects.all()
-        n = random.choice(range(categories.count()))
-        for i in range(n):
-            self.categories.add(random.choice(categories))
+        categories = list(Category.objects.values_list('id', flat=True))
+        n = random.choice(range(len(categories)))
+        self.categories.add(*{random.choice(categories) for i in range(n)})
 
     class Meta:
         model = Book
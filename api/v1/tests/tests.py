@@ -1,10 +1,39 @@
 from rest_framework.test import APITestCase
 from django.test.testcases import TestCase
-from catalog.models import Book, UserBookRelation, Author, Category
+from catalog.models import Book, BookStats, UserBookRelation, Author, Category, LeaderboardEntry, SimilarBook, \
+    UserBookRelationQuerySet, UserLibraryStats
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from django.db import connection, connections, router, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.core.cache import cache, caches
+from django.utils import timezone
+from django.utils.http import http_date
+from catalog.models import DiscountGroup
+from ..cache import representation_cache
+from catalog.autocomplete import author_index, book_index
+import base64
+import itertools
+import json
+import os
+import re
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from .factories import UserFactory, BookFactory, UserBookRelationFactory, AuthorFactory, CategoryFactory
+from .budgets import QueryBudgetMixin
+from ..benchmark import BENCHMARK_ENDPOINTS, BenchmarkRunner, Endpoint
+from library.profiling import ProfileSpool, StackSampler, stack_functions
+from library.metrics import INITIAL_SIZE, METRICS_SUFFIX, MetricsFile, MetricsRecorder
+from library.slow_queries import fingerprint, read_logs
+from library import routers
 from ..mixins.views import PrefetchUserData
+from ..compiled import CompiledRepresentation, compile_list, decimal_converter
+from rest_framework import serializers
+from decimal import Decimal
 from api.v1.serializers import BookSerializer, UserBookRelationSerializer, StaffBookRelationSerializer, \
     AuthorSerializer, CategorySerializer, ExpandedUserBookRelationSerializer, ExpandedBookSerializer
 import status, pdb, random
@@ -52,6 +81,25 @@ class BooksEndpointTestCase(APITestCase):
             "Data mismatch in book detail"
         )
 
+    def test_book_list_user_data(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('api:v1:book-list'), {'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Book list failed to load")
+        self.assertEqual(
+            response.json()['results'], self.get_serializer(Book.objects.all()[:2], self.user, many=True).data,
+            "Data mismatch in book list with user data"
+        )
+
+    def test_book_user_data_page_scoped(self):
+        book = random.choice(self.books)
+        relations = PrefetchUserData.get_extra_context(self.user, [book.id])['user_book_relations']
+        with self.assertNumQueries(1):
+            self.assertEqual(relations.get(book.id)['book_id'], book.id)
+            self.assertEqual(
+                [other.id for other in self.books if relations.get(other.id)], [book.id],
+                "User data should only be loaded for the requested books"
+            )
+
     def test_book_create_user_unauthorized(self):
         new_book = BookFactory.build()
         response = self.client.post(reverse('api:v1:book-list'), self.get_serializer(new_book).data)
@@ -74,6 +122,7 @@ class BooksEndpointTestCase(APITestCase):
         new_book = BookFactory.build(price_original=1000, discount=25)
         new_book.price = 750
         new_book.discount_total = 25
+        new_book.stats = BookStats()
         book_data = self.get_serializer(new_book, self.admin).data
         response = self.client.post(reverse('api:v1:book-list'), book_data)
         self.assertEqual(
@@ -166,6 +215,207 @@ class BooksEndpointTestCase(APITestCase):
         )
 
 
+    def test_expand_selectors(self):
+        response = self.client.get(reverse('api:v1:book-list'), {'expand': 'author'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Partially expanded book list failed to load")
+        expected_data = BookSerializer(
+            Book.objects.all(), many=True, expand={'author'}, context=PrefetchUserData.get_extra_context()
+        ).data
+        self.assertEqual(response.json()['results'], expected_data, "Data mismatch for partially expanded list")
+        self.assertIsInstance(response.json()['results'][0]['author'], dict, "Author should be expanded")
+        self.assertIsInstance(response.json()['results'][0]['categories'], list, "Categories should be pk list")
+
+    def test_expand_unknown_selector(self):
+        response = self.client.get(reverse('api:v1:book-list'), {'expand': 'author,publisher'})
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST,
+            "Unknown expand selectors should return 400 Bad Request"
+        )
+
+    def test_expanded_query_count_constant(self):
+        self.client.force_authenticate(self.user)
+        for expand in ('', 'author', 'categories', 'author,categories', 'true'):
+            with CaptureQueriesContext(connection) as small_page:
+                self.client.get(reverse('api:v1:book-list'), {'expand': expand, 'limit': 1})
+            with CaptureQueriesContext(connection) as large_page:
+                self.client.get(reverse('api:v1:book-list'), {'expand': expand, 'limit': 5})
+            self.assertEqual(
+                len(small_page), len(large_page),
+                "Query count for expand={!r} should not depend on the page size".format(expand)
+            )
+
+    def walk_cursor_pages(self, params):
+        ids, url, pages = [], reverse('api:v1:book-list'), []
+        params = dict(params, pagination='cursor')
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, "Cursor page failed to load")
+            self.assertFalse(
+                any('COUNT(' in query['sql'] and 'MAX(' not in query['sql'] for query in queries.captured_queries),
+                "Cursor pagination should not count rows beyond the validator aggregate"
+            )
+            pages.append(response.json())
+            ids.extend(book['id'] for book in response.json()['results'])
+            url, params = response.json()['next'], {}
+        return ids, pages
+
+    def test_cursor_pagination_orderings(self):
+        BookFactory.create_batch(3, title='Duplicate', price_original=None, year_published=None)
+        BookFactory.create_batch(3, title='Duplicate', price_original=10, year_published=2000)
+        for book, rating in zip(Book.objects.order_by('-id'), (3, 3, 5, 1)):
+            UserBookRelationFactory.create(book=book, rating=rating)
+        books = list(Book.objects.select_related('stats'))
+
+        def null_first(value):
+            return (value is not None, value)
+
+        for ordering, key in (('id', lambda book: book.id),
+                              ('title', lambda book: (book.title, book.id)),
+                              ('price', lambda book: (null_first(book.price), book.id)),
+                              ('year_published', lambda book: (null_first(book.year_published), book.id)),
+                              ('rating_avg', lambda book: (null_first(book.stats.rating_avg), book.id))):
+            for descending in (False, True):
+                expected_ids = [book.id for book in sorted(books, key=key, reverse=descending)]
+                actual_ids, pages = self.walk_cursor_pages({
+                    'ordering': ('-' if descending else '') + ordering, 'limit': 2
+                })
+                self.assertEqual(
+                    expected_ids, actual_ids,
+                    "Cursor pages out of order for ordering {}{}".format('-' if descending else '', ordering)
+                )
+                previous_page = self.client.get(pages[-1]['previous']).json()
+                self.assertEqual(pages[-2]['results'], previous_page['results'], "Previous cursor mismatch")
+
+    def test_cursor_pagination_invalid_cursor(self):
+        response = self.client.get(reverse('api:v1:book-list'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, "Invalid cursor should return 404")
+        response = self.client.get(reverse('api:v1:book-list'), {'pagination': 'cursor', 'ordering': 'description'})
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST, "Unknown ordering should return 400 Bad Request"
+        )
+
+    def test_cursor_pagination_tampered_cursor(self):
+        for ordering, position in (('id', ['abc']), ('id', [{}]), ('id', [[1, 2]]), ('price', ['abc', 1]),
+                                   ('-rating_avg', [[1], 1]), ('year_published', [1999, 'x'])):
+            cursor = base64.urlsafe_b64encode(json.dumps(
+                {'ordering': ordering, 'position': position, 'reverse': False}
+            ).encode('utf-8')).decode('ascii')
+            response = self.client.get(reverse('api:v1:book-list'), {'cursor': cursor, 'ordering': ordering})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND,
+                             "Tampered cursor position {} should return 404".format(position))
+
+    def test_search(self):
+        BookFactory.create_batch(3, title='Zanzibar chronicles')
+        title_match = BookFactory.create(title='Zanzibar')
+        response = self.client.get(reverse('api:v1:book-search'), {'q': 'zanz*', 'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Book search failed")
+        self.assertEqual(4, response.json()['count'])
+        self.assertEqual(title_match.id, response.json()['results'][0]['id'], "Shorter title should rank first")
+        self.assertEqual(2, len(response.json()['results']))
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(2, len(response.json()['results']))
+
+        response = self.client.get(reverse('api:v1:book-search'), {'q': ' '})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, "Empty query should be rejected")
+
+    def test_top(self):
+        UserBookRelation.objects.update(in_wishlist=False)
+        UserBookRelation.objects.filter(book=self.books[3]).update(in_wishlist=True)
+        UserBookRelation.objects.filter(book=self.books[1], user=self.user).update(in_wishlist=True)
+        self.categories[0].books.add(self.books[1])
+        call_command('rebuild_book_stats', stdout=StringIO())
+        call_command('rebuild_leaderboards', stdout=StringIO())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:v1:book-top'), {'by': 'wishlist', 'limit': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Leaderboard failed to load")
+        self.assertEqual(
+            [(1, 2.0, self.books[3].id), (2, 1.0, self.books[1].id)],
+            [(entry['position'], entry['score'], entry['book']['id']) for entry in response.json()['results']]
+        )
+        self.assertEqual(2, response.json()['results'][0]['book']['wishlist_count'])
+        self.assertEqual(3, len(queries), "The board entries, their books and the book categories should be queried")
+
+        response = self.client.get(reverse('api:v1:book-top'), {'by': 'wishlist', 'category': self.categories[0].id})
+        self.assertIn(self.books[1].id, [entry['book']['id'] for entry in response.json()['results']])
+        for params in ({'by': 'price'}, {'period': 'year'}, {'author': 'x'}, {'author': 1, 'category': 1}):
+            response = self.client.get(reverse('api:v1:book-top'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, "Invalid {} accepted".format(params))
+
+    def test_similar(self):
+        book, first, second = self.books[:3]
+        now = timezone.now()
+        SimilarBook.objects.bulk_create([
+            SimilarBook(book=book, similar=second, position=2, score=0.5, computed_at=now),
+            SimilarBook(book=book, similar=first, position=1, score=0.9, computed_at=now),
+            SimilarBook(book=first, similar=book, position=1, score=0.9, computed_at=now),
+        ])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:v1:book-similar', args=(book.id,)))
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Similar books failed to load")
+        self.assertEqual(
+            [(1, 0.9, first.id), (2, 0.5, second.id)],
+            [(entry['position'], entry['score'], entry['book']['id']) for entry in response.json()['results']]
+        )
+        self.assertEqual(2, len(queries), "The neighbour books and their categories should be queried")
+
+        response = self.client.get(reverse('api:v1:book-similar', args=(second.id,)))
+        self.assertEqual([], response.json()['results'])
+        response = self.client.get(reverse('api:v1:book-similar', args=(Book.objects.latest('id').id + 1,)))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, "Unknown book should return 404")
+
+    def test_export(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:v1:book-export'))
+            rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Book export failed")
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        self.assertEqual(list(Book.objects.order_by('id').values_list('id', flat=True)), [row['id'] for row in rows])
+        book = Book.objects.get(id=rows[0]['id'])
+        self.assertEqual(str(book.price), rows[0]['price'])
+        self.assertEqual(sorted(book.categories.values_list('id', flat=True)), rows[0]['categories'])
+        self.assertEqual(3, len(queries), "One chunk of books, its categories and the terminating query")
+
+        response = self.client.get(reverse('api:v1:book-export'), {'output': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, "Unknown output should be rejected")
+
+    def test_export_command(self):
+        out = StringIO()
+        call_command('export_catalog', 'books', output_format='csv', chunk_size=2, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(Book.objects.count() + 1, len(lines))
+        self.assertTrue(lines[0].startswith('id,title,') and lines[0].endswith(',categories'))
+
+    def test_sparse_fieldset(self):
+        self.client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:v1:book-list'), {'fields': 'id,title,price,author'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Sparse book list failed to load")
+        expected_data = BookSerializer(
+            Book.objects.all(), many=True, fields={'id', 'title', 'price', 'author'},
+            context=PrefetchUserData.get_extra_context(self.user)
+        ).data
+        self.assertEqual(response.json()['results'], expected_data, "Data mismatch in sparse book list")
+        self.assertEqual(['id', 'title', 'author', 'price'], list(response.json()['results'][0]))
+        self.assertEqual(
+            5, len(queries), "Only the validator aggregates, the count and the book rows should be queried"
+        )
+        self.assertNotIn('description', queries[4]['sql'], "Unrequested columns should be deferred")
+
+    def test_sparse_fieldset_omit(self):
+        response = self.client.get(reverse('api:v1:book-list'), {'omit': 'description,categories', 'expand': 'author'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Sparse book list failed to load")
+        book = response.json()['results'][0]
+        self.assertNotIn('description', book)
+        self.assertNotIn('categories', book)
+        self.assertIsInstance(book['author'], dict, "Author should still be expanded")
+
+    def test_sparse_fieldset_unknown_field(self):
+        response = self.client.get(reverse('api:v1:book-list'), {'fields': 'id,secret'})
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST, "Unknown fields should return 400 Bad Request"
+        )
+
 class UserBookRelationsEndpointTestCase(APITestCase):
     def setUp(self):
         self.admin = UserFactory.create(is_superuser=True, is_staff=True)
@@ -490,6 +740,130 @@ class UserBookRelationsEndpointTestCase(APITestCase):
         )
 
 
+    def test_expand_nested_selectors(self):
+        self.client.force_authenticate(self.user)
+        relations = UserBookRelation.objects.filter(user=self.user)
+        expected_data = UserBookRelationSerializer(
+            relations, many=True, expand={'book', 'book.author'}, context=PrefetchUserData.get_extra_context(self.user)
+        ).data
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:v1:userbookrelation-list'), {'expand': 'book.author'})
+        self.assertEqual(
+            response.status_code, status.HTTP_200_OK,
+            "Attempting to access expanded relations list should return 200 OK"
+        )
+        self.assertEqual(expected_data, response.json()['results'], "Data mismatch for nested expanded list")
+        self.assertIsInstance(response.json()['results'][0]['book']['author'], dict, "Book author should be expanded")
+        self.assertLessEqual(len(queries), 4, "Nested expansion should not query per relation")
+
+    def test_cursor_pagination(self):
+        self.client.force_authenticate(self.admin)
+        ids, url, params = [], reverse('api:v1:userbookrelation-list'), {'pagination': 'cursor', 'limit': 3}
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, "Cursor page failed to load")
+            ids.extend(relation['id'] for relation in response.json()['results'])
+            url, params = response.json()['next'], {}
+        self.assertEqual(list(UserBookRelation.objects.order_by('id').values_list('id', flat=True)), ids)
+
+    def test_export(self):
+        url = reverse('api:v1:userbookrelation-export')
+        self.client.force_authenticate(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN, "Relations export should be staff only")
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(url, {'output': 'csv'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Relations export failed")
+        self.assertEqual('text/csv', response['Content-Type'])
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual('id,user,book,in_bookmarks,in_wishlist,rating,updated_at', lines[0])
+        self.assertEqual(len(self.relations) + 1, len(lines))
+        self.assertTrue(lines[1].startswith('{},{},{},'.format(
+            self.relations[0].id, self.relations[0].user_id, self.relations[0].book_id
+        )))
+
+    def test_bulk_upsert(self):
+        self.client.force_authenticate(self.user)
+        existing = UserBookRelation.objects.get(user=self.user, book=self.books[0])
+        new_book = BookFactory.create()
+        missing_id = Book.objects.order_by('-id')[0].id + 1
+        response = self.client.post(reverse('api:v1:userbookrelation-bulk'), [
+            {'book': self.books[0].id, 'rating': 5 if existing.rating != 5 else 4, 'in_bookmarks': True},
+            {'book': self.books[1].id, 'in_wishlist': self.relations[2].in_wishlist},
+            {'book': new_book.id, 'in_wishlist': True},
+            {'book': missing_id, 'rating': 3},
+            {'book': self.books[2].id, 'rating': 10},
+            {'book': new_book.id, 'rating': 1},
+        ], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Bulk upsert failed")
+        self.assertEqual(['updated', 'unchanged', 'created', 'invalid', 'invalid', 'invalid'],
+                         [result['status'] for result in response.json()])
+        self.assertIn('rating', response.json()[4]['errors'])
+
+        existing.refresh_from_db()
+        self.assertEqual((5 if existing.rating == 5 else 4, True), (existing.rating, existing.in_bookmarks))
+        created = UserBookRelation.objects.get(user=self.user, book=new_book)
+        self.assertEqual((True, False, None), (created.in_wishlist, created.in_bookmarks, created.rating))
+        self.assertFalse(UserBookRelation.objects.filter(user=self.admin, book=new_book).exists())
+
+        response = self.client.post(reverse('api:v1:userbookrelation-bulk'), {'book': new_book.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, "Bulk upsert expects a list")
+
+    def test_summary(self):
+        self.client.force_authenticate(self.user)
+        relations = UserBookRelation.objects.filter(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('api:v1:userbookrelation-summary'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Library summary failed to load")
+        self.assertEqual(
+            {'bookmark_count': relations.filter(in_bookmarks=True).count(),
+             'wishlist_count': relations.filter(in_wishlist=True).count(),
+             'rating_count': relations.filter(rating__isnull=False).count()},
+            {field: response.json()[field] for field in ('bookmark_count', 'wishlist_count', 'rating_count')}
+        )
+        self.client.force_authenticate(None)
+        response = self.client.get(reverse('api:v1:userbookrelation-summary'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN, "Summary requires authentication")
+
+    def test_bulk_upsert_query_count(self):
+        self.client.force_authenticate(self.user)
+        books = BookFactory.create_batch(495)
+        items = [{'book': book.id, 'rating': 1 + book.id % 5, 'in_bookmarks': True} for book in self.books + books]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('api:v1:userbookrelation-bulk'), items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Bulk upsert failed")
+        # plus a book statistics update per distinct delta: one per new rating, at most one per updated relation
+        self.assertLessEqual(len(queries), 12 + 5 + len(self.relations) // 2,
+                             "Bulk upsert should batch its lookups and writes")
+        self.assertEqual(
+            [(book['book'], book['rating'], True) for book in items],
+            list(UserBookRelation.objects.filter(user=self.user).order_by('book_id').values_list(
+                'book_id', 'rating', 'in_bookmarks'
+            ))
+        )
+
+    def test_bulk_upsert_concurrent_create(self):
+        self.client.force_authenticate(self.user)
+        book = BookFactory.create()
+        url = reverse('api:v1:userbookrelation-bulk')
+        response = self.client.post(url, [{'book': book.id, 'rating': 2}], format='json')
+        self.assertEqual([{'book': book.id, 'status': 'created'}], response.json())
+
+        # the second request looked the pair up before the first one created it
+        lookups, select_for_update = [], UserBookRelationQuerySet.select_for_update
+
+        def stale_select_for_update(queryset, *args, **kwargs):
+            lookups.append(queryset)
+            return select_for_update(queryset, *args, **kwargs) if len(lookups) > 1 else queryset.none()
+
+        with mock.patch.object(UserBookRelationQuerySet, 'select_for_update', stale_select_for_update):
+            response = self.client.post(url, [{'book': book.id, 'rating': 4}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "A concurrently created relation should be updated")
+        self.assertEqual([{'book': book.id, 'status': 'updated'}], response.json())
+        self.assertEqual(2, len(lookups))
+        self.assertEqual(4, UserBookRelation.objects.get(user=self.user, book=book).rating)
+
+
 class AuthorsEndpointTestCase(APITestCase):
     def setUp(self):
         self.admin = UserFactory.create(is_superuser=True, is_staff=True)
@@ -616,6 +990,26 @@ class AuthorsEndpointTestCase(APITestCase):
         self.assertEqual(updated_author.name, 'NewName', "Failed to properly modify resource")
 
 
+    def test_author_autocomplete(self):
+        author_index.clear()
+        author = AuthorFactory.create(name='Zanzibar', family_name='Quintus')
+        response = self.client.get(reverse('api:v1:author-autocomplete'), {'q': 'quin'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Author autocomplete failed")
+        self.assertEqual([{'id': author.id, 'label': 'Zanzibar Quintus'}], response.json())
+        response = self.client.get(reverse('api:v1:book-autocomplete'), {'q': 'zanzibar'})
+        self.assertEqual([], response.json())
+
+    def test_author_sparse_fieldset(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:v1:author-list'), {'fields': 'id,full_name'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Sparse author list failed to load")
+        self.assertEqual(
+            response.json()['results'], self.get_serializer(self.authors, many=True, fields={'id', 'full_name'}).data,
+            "Data mismatch in sparse author list"
+        )
+        self.assertEqual(3, len(queries), "Properties should not trigger deferred field loads")
+        self.assertNotIn('about', queries[2]['sql'], "Unrequested columns should be deferred")
+
 class CategoriesEndpointTestCase(APITestCase):
     def setUp(self):
         self.admin = UserFactory.create(is_superuser=True, is_staff=True)
@@ -768,9 +1162,20 @@ class SerializersTestCase(TestCase):
             'discount': "{:.2f}".format(book.discount),
             'discount_total': "{:.2f}".format(book.discount_total),
         }
+        expected_data.update(self.get_expected_stats(relation))
         actual_data = BookSerializer(book, context=PrefetchUserData.get_extra_context(user)).data
         self.assertEqual(expected_data, actual_data)
 
+    @staticmethod
+    def get_expected_stats(relation):
+        return {
+            'rating_avg': None if relation.rating is None else float(relation.rating),
+            'rating_count': 0 if relation.rating is None else 1,
+            'rating_histogram': {str(value): int(value == relation.rating) for value in range(1, 6)},
+            'bookmark_count': int(relation.in_bookmarks),
+            'wishlist_count': int(relation.in_wishlist),
+        }
+
     def test_expanded_book_serializer(self):
         CategoryFactory.create_batch(3)
         author = AuthorFactory.create()
@@ -794,6 +1199,7 @@ class SerializersTestCase(TestCase):
             'discount': "{:.2f}".format(book.discount),
             'discount_total': "{:.2f}".format(book.discount_total),
         }
+        expected_data.update(self.get_expected_stats(relation))
         actual_data = ExpandedBookSerializer(book, context=PrefetchUserData.get_extra_context(user)).data
         self.assertEqual(expected_data, actual_data)
 
@@ -816,8 +1222,8 @@ class SerializersTestCase(TestCase):
             'id': category.id,
             'name': category.name,
             'description': category.description,
-            'book_average_price': category.book_average_price,
-            'book_count': category.book_count,
+            'book_average_price': category.stats.book_average_price,
+            'book_count': category.stats.book_count,
         }
         actual_data = CategorySerializer(category).data
         self.assertEqual(expected_data, actual_data)
@@ -872,3 +1278,864 @@ class SerializersTestCase(TestCase):
         actual_data = ExpandedUserBookRelationSerializer(relation,
                                                          context=PrefetchUserData.get_extra_context(user)).data
         self.assertEqual(expected_data, actual_data)
+
+
+@override_settings(API_COMPILED_LISTS=False, BOOK_REPRESENTATION_CACHE='representations', CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'representations': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'library-representation-cache-tests'),
+    },
+})
+class RepresentationCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        caches['representations'].clear()
+        self.addCleanup(caches['representations'].clear)
+        self.user = UserFactory.create()
+        self.author = AuthorFactory.create()
+        self.category = CategoryFactory.create()
+        self.books = BookFactory.create_batch(3, author=self.author, categories=(self.category,))
+        UserBookRelationFactory.create(user=self.user, book=self.books[0])
+
+    def get_books(self):
+        response = self.client.get(reverse('api:v1:book-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Book list failed to load")
+        return response.json()['results']
+
+    def test_hits_and_misses(self):
+        representation_cache.reset_stats()
+        self.get_books()
+        self.assertEqual({'hits': 0, 'misses': 3}, representation_cache.get_stats())
+        self.get_books()
+        self.assertEqual({'hits': 3, 'misses': 3}, representation_cache.get_stats())
+
+    def test_user_fields_merged(self):
+        self.get_books()
+        self.client.force_authenticate(self.user)
+        self.assertEqual(
+            self.get_books(),
+            BookSerializer(Book.objects.all(), many=True, context=PrefetchUserData.get_extra_context(self.user)).data,
+            "Cached representation should carry the current user's relation fields"
+        )
+
+    def test_invalidation(self):
+        self.get_books()
+        book = self.books[0]
+        book.title = 'TitleModified'
+        book.save()
+        self.assertEqual('TitleModified', self.get_books()[0]['title'])
+
+        other_category = CategoryFactory.create()
+        other_category.books.add(book)
+        self.assertIn(other_category.id, self.get_books()[0]['categories'])
+        self.category.delete()
+        self.assertEqual([[other_category.id], [], []], [book['categories'] for book in self.get_books()])
+
+        discount_group = DiscountGroup.objects.create(name='DG1', discount=0)
+        Book.objects.filter(id=book.id).update(discount_group=discount_group, discount=0, price_original=100)
+        Book.objects.filter(id=book.id).recalculate_prices()
+        discount_group.discount = 10
+        discount_group.save()
+        self.assertEqual('90.00', self.get_books()[0]['price'])
+
+    def test_bulk_write_commands(self):
+        self.get_books()
+        Book.objects.filter(id=self.books[0].id).update(price_original=100, discount=10)
+        call_command('recalculate_prices', stdout=StringIO())
+        self.assertEqual('90.00', self.get_books()[0]['price'])
+
+        # the id a deleted book may have left behind, imported books start there
+        next_id = self.books[-1].id + 1
+        version = representation_cache.get_versions([next_id])[next_id]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'feed.jsonl')
+            with open(path, 'w', encoding='utf-8') as feed:
+                feed.write(json.dumps({'title': 'Imported', 'title_original': 'Imported', 'author_name': 'Lev'}))
+            call_command('import_books', path, stdout=StringIO())
+        self.assertEqual(next_id, Book.objects.get(title='Imported').id)
+        self.assertNotEqual(version, representation_cache.get_versions([next_id])[next_id])
+
+    @override_settings(BOOK_REPRESENTATION_CACHE='default')
+    def test_process_local_cache_disabled(self):
+        self.assertIsNone(representation_cache.cache)
+        self.assertEqual(self.get_books(), self.get_books())
+        self.assertIsNone(cache.get(representation_cache.version_key.format(self.books[0].id)),
+                          "A process local cache can't be invalidated in the other workers")
+
+
+class CompiledListTestCase(APITestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+        authors = [AuthorFactory.create(), AuthorFactory.create(family_name=None, about=None)]
+        self.categories = CategoryFactory.create_batch(3)
+        self.books = [
+            BookFactory.create(author=authors[number % 2], categories=self.categories[number % 3:][::-1],
+                               year_published=1990 + number % 2)
+            for number in range(7)
+        ]
+        Book.objects.filter(pk=self.books[1].pk).update(price_original=None, discount=None, price=None,
+                                                        description=None)
+        Book.objects.filter(pk=self.books[2].pk).update(price_original='1234.5', discount=0)
+        self.books[3].categories.clear()
+        BookStats.objects.filter(book=self.books[4]).delete()
+        self.categories[1].stats.delete()
+        for number, book in enumerate(self.books[:5]):
+            UserBookRelationFactory.create(user=self.user, book=book, rating=number or None)
+
+    def get_pages(self, params, user=None, compiled=True):
+        client = self.client_class()
+        client.force_authenticate(user)
+        pages, url = [], reverse('api:v1:book-list')
+        with override_settings(API_COMPILED_LISTS=compiled), \
+                mock.patch.object(CompiledRepresentation, 'represent', autospec=True,
+                                  side_effect=CompiledRepresentation.represent) as represent:
+            while url:
+                response = client.get(url, params)
+                self.assertEqual(response.status_code, status.HTTP_200_OK, "Book list failed to load")
+                pages.append(response.content)
+                url, params = response.json().get('next'), None
+        self.assertEqual(compiled, represent.called, "Compiled representation should render the list when enabled")
+        return pages
+
+    def test_parity(self):
+        for params in ({}, {'limit': 3}, {'offset': 2, 'limit': 4}, {'expand': '1'}, {'expand': 'author'},
+                       {'expand': 'categories', 'limit': 2}, {'fields': 'id,title,categories'},
+                       {'omit': 'rating_histogram,author,in_bookmarks'}, {'fields': 'id,price,rating', 'expand': '1'},
+                       {'categories': self.categories[2].id}, {'year_published': 1990},
+                       {'pagination': 'cursor', 'limit': 2}, {'pagination': 'cursor', 'ordering': '-rating_avg'},
+                       {'pagination': 'cursor', 'ordering': 'price', 'limit': 3, 'expand': 'categories'}):
+            for user in (None, self.user):
+                self.assertEqual(self.get_pages(params, user, compiled=False), self.get_pages(params, user),
+                                 "Compiled list should render {} the same".format(params))
+
+    def test_fallback(self):
+        self.client.force_authenticate(self.user)
+        with mock.patch('api.v1.mixins.views.compile_list', return_value=None):
+            self.assertEqual(self.get_pages({'expand': '1'}, self.user, compiled=False)[0],
+                             self.client.get(reverse('api:v1:book-list'), {'expand': '1'}).content)
+
+    def test_not_compilable(self):
+        context = PrefetchUserData.get_extra_context()
+        self.assertIsNotNone(compile_list(ExpandedBookSerializer(many=True, context=context)))
+
+        class PublisherBookSerializer(BookSerializer):
+            publisher_name = serializers.CharField(source='publisher.name', read_only=True)
+            title_length = serializers.SerializerMethodField()
+
+            class Meta(BookSerializer.Meta):
+                fields = ('id', 'publisher_name', 'title_length')
+
+            def get_title_length(self, book):
+                return len(book.title)
+
+        for omit in ('publisher_name', 'title_length'):
+            # a missing publisher skips the field, a method is opaque
+            self.assertIsNone(compile_list(PublisherBookSerializer(many=True, omit={omit}, context=context)))
+        self.assertIsNotNone(compile_list(PublisherBookSerializer(many=True, fields={'id'}, context=context)))
+
+    def test_decimals(self):
+        convert = decimal_converter(serializers.DecimalField(max_digits=6, decimal_places=2))
+        for value in (Decimal('12.30'), Decimal('1.5'), Decimal('-0.00'), Decimal('7'), 3, 2.5, '4.125'):
+            self.assertEqual(serializers.DecimalField(max_digits=6, decimal_places=2).to_representation(value),
+                             convert(value))
+
+
+class ConditionalGetTestCase(APITestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.author = AuthorFactory.create()
+        self.category = CategoryFactory.create()
+        self.books = BookFactory.create_batch(3, author=self.author, categories=(self.category,))
+
+    def assertNotModified(self, url, response, **params):
+        with CaptureQueriesContext(connection) as queries:
+            repeated = self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(repeated.status_code, status.HTTP_304_NOT_MODIFIED, "Unchanged data should not be resent")
+        self.assertEqual(response['ETag'], repeated['ETag'])
+        return queries
+
+    def assertModified(self, url, response, **params):
+        repeated = self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(repeated.status_code, status.HTTP_200_OK, "Changed data should be resent")
+        self.assertNotEqual(response['ETag'], repeated['ETag'])
+        return repeated
+
+    def test_book_list(self):
+        url = reverse('api:v1:book-list')
+        response = self.client.get(url)
+        queries = self.assertNotModified(url, response)
+        self.assertEqual(4, len(queries), "Validation should read the page, then the rows of its books and their stats")
+
+        self.books[0].title = 'TitleModified'
+        self.books[0].save()
+        response = self.assertModified(url, response)
+        self.assertModified(url, response, limit=1)
+
+        CategoryFactory.create().books.add(self.books[1])
+        response = self.assertModified(url, response)
+        self.books[2].delete()
+        self.assertModified(url, response)
+
+    def test_book_list_validates_page_only(self):
+        url = reverse('api:v1:book-list')
+        self.client.force_authenticate(self.user)
+        params = {'pagination': 'cursor', 'limit': 2, 'expand': 'author,categories'}
+        response = self.client.get(url, params)
+        queries = self.assertNotModified(url, response, **params)
+        self.assertEqual([], [query['sql'] for query in queries.captured_queries
+                              if re.search(r'\b(MAX|COUNT)\(', query['sql'])],
+                         "Validation should only read the rows of the page, not aggregate the tables")
+        self.books[2].save()
+        self.assertNotModified(url, response, **params)
+        self.books[1].save()
+        self.assertModified(url, response, **params)
+
+    def test_deletion_not_hidden_by_last_modified(self):
+        url = reverse('api:v1:book-list')
+        self.client.force_authenticate(self.user)
+        relation = UserBookRelationFactory.create(user=self.user, book=self.books[0], in_bookmarks=True)
+        UserBookRelationFactory.create(user=self.user, book=self.books[1])
+        response = self.client.get(url)
+        self.assertNotIn('Last-Modified', response, "Max(updated_at) misses deletions, it can't validate")
+        since = http_date(time.time() + 60)
+        for deleted in (relation, self.books[2]):
+            deleted.delete()
+            repeated = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+            self.assertEqual(repeated.status_code, status.HTTP_200_OK, "Deleted rows should be noticed")
+            self.assertNotEqual(response.content, repeated.content)
+            response = repeated
+
+    def test_book_detail(self):
+        url = reverse('api:v1:book-detail', args=(self.books[0].id,))
+        response = self.client.get(url)
+        self.assertNotModified(url, response)
+        self.books[1].save()
+        self.assertNotModified(url, response)
+        self.books[0].save()
+        self.assertModified(url, response)
+
+    def test_book_list_expanded(self):
+        url = reverse('api:v1:book-list')
+        response = self.client.get(url, {'expand': 'author'})
+        self.category.save()
+        self.assertNotModified(url, response, expand='author')
+        self.author.save()
+        self.assertModified(url, response, expand='author')
+
+    def test_book_list_user_relations(self):
+        url = reverse('api:v1:book-list')
+        anonymous = self.client.get(url)
+        self.client.force_authenticate(self.user)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=anonymous['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Validators should be per user")
+        self.assertNotModified(url, response)
+        relation = UserBookRelationFactory.create(user=self.user, book=self.books[0])
+        response = self.assertModified(url, response)
+        relation.in_bookmarks = not relation.in_bookmarks
+        relation.save()
+        response = self.assertModified(url, response)
+        UserBookRelationFactory.create(user=UserFactory.create(), book=self.books[0])
+        self.assertModified(url, response)
+
+    def test_category_list(self):
+        url = reverse('api:v1:category-list')
+        response = self.client.get(url)
+        self.assertNotModified(url, response)
+        BookFactory.create(categories=(self.category,))
+        self.assertModified(url, response)
+
+    def test_author_detail(self):
+        url = reverse('api:v1:author-detail', args=(self.author.id,))
+        response = self.client.get(url)
+        self.assertNotModified(url, response)
+        self.author.name = 'NameModified'
+        self.author.save()
+        self.assertModified(url, response)
+
+
+class QueryPlanTestCase(APITestCase):
+    """
+    Runs the queries the v1 endpoints issue through the database's EXPLAIN and fails on full scans of the tables
+    that grow with the catalog and its users.
+    """
+    large_tables = ('catalog_book', 'catalog_book_categories', 'catalog_userbookrelation', 'catalog_bookstats',
+                    'catalog_leaderboardentry', 'catalog_similarbook', 'catalog_userlibrarystats')
+    sqlite_scan_re = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(.*)$')
+    # SQLite names the aliased tables of subqueries (U0, T3...) by their alias
+    sql_alias_re = re.compile(r'(?:FROM|JOIN) "(\w+)" (?:AS )?(?!ON\b)(\w+)')
+    # the count of offset pagination reads every row of the list, the reason cursor pagination exists
+    offset_count_re = re.compile(r'^SELECT COUNT\(\*\) AS "__count" FROM ')
+    postgresql_scan_re = re.compile(r'(?:Seq Scan|Index Only Scan|Index Scan)(?: Backward)?(?: using \w+)? on (\w+)')
+
+    def setUp(self):
+        self.admin = UserFactory.create(is_superuser=True, is_staff=True)
+        self.user = UserFactory.create()
+        AuthorFactory.create_batch(2)
+        self.category = CategoryFactory.create()
+        self.books = BookFactory.create_batch(5, categories=(self.category,))
+        for book in self.books:
+            UserBookRelationFactory.create(user=self.user, book=book)
+        book_index.lookup('a')
+
+    def get_full_scans(self, sql, params):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # rules out the sequential scans the planner prefers on small tables
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql, params)
+                return self.get_postgresql_full_scans([row[0] for row in cursor.fetchall()])
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            # (id, parent, notused, detail) rows of the plan tree, in the order the loops nest
+            plan = cursor.fetchall()
+        # a scan in index order stopped by the LIMIT of the statement only reads the rows it returns: the outer loop
+        # of the statement, when nothing is sorted after it. Any other scan, through an index or not, reads it all.
+        limited = None
+        if re.search(r'\bLIMIT\b', sql) and not any('TEMP B-TREE' in row[-1] for row in plan):
+            outer = [row for row in plan if row[1] == 0]
+            if outer and self.sqlite_scan_re.match(outer[0][-1]):
+                limited = outer[0][0]
+        aliases = {alias: table for table, alias in self.sql_alias_re.findall(sql)}
+        scans = []
+        for row in plan:
+            match = self.sqlite_scan_re.match(row[-1])
+            table = match and aliases.get(match.group(1), match.group(1))
+            if table in self.large_tables and row[0] != limited:
+                scans.append(table)
+        return scans
+
+    def get_postgresql_full_scans(self, plan):
+        scans = []
+        for number, line in enumerate(plan):
+            match = self.postgresql_scan_re.search(line)
+            if not match or match.group(1) not in self.large_tables:
+                continue
+            # an index scan without a condition reads the whole index, unless the Limit on top stops it
+            details = itertools.takewhile(lambda detail: '->' not in detail, plan[number + 1:])
+            limited = number == 1 and plan[0].startswith('Limit')
+            if 'Seq Scan' in line or not limited and not any('Index Cond' in detail for detail in details):
+                scans.append(match.group(1))
+        return scans
+
+    def assertNoFullScans(self, method, url, params=None, user=None, allowed=None, **kwargs):
+        self.client.force_authenticate(user)
+        # keeps the statements and their parameters apart, so they are explained with the same bound values
+        with mock.patch.object(connection.ops, 'last_executed_query', lambda cursor, sql, params: (sql, params)), \
+                CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, params, **kwargs)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 400, "{} {} failed".format(method.upper(), url))
+        for query in queries.captured_queries:
+            sql, sql_params = query['sql']
+            if not sql.startswith(('SELECT', 'UPDATE', 'DELETE')) or allowed and allowed.match(sql):
+                continue
+            scans = self.get_full_scans(sql, sql_params)
+            self.assertFalse(scans, "Full scan of {} for {} {}: {}".format(
+                ', '.join(scans), method.upper(), url, sql % tuple(sql_params or ())
+            ))
+
+    def test_full_scans_are_detected(self):
+        for queryset in (Book.objects.filter(description='Unindexed'),
+                         UserBookRelation.objects.filter(rating=5)):
+            sql, params = queryset.query.sql_with_params()
+            self.assertEqual([queryset.model._meta.db_table], self.get_full_scans(sql, params))
+        sql, params = Book.objects.filter(isbn='978-3-16-148410-0').query.sql_with_params()
+        self.assertEqual([], self.get_full_scans(sql, params))
+        # reading a whole index is a full scan too, LIMIT only bounds the outer loop it stops
+        self.assertEqual(['catalog_book'], self.get_full_scans(
+            'SELECT MAX("updated_at"), COUNT("id") FROM "catalog_book"', ()
+        ))
+        rated = Book.objects.filter(id__in=UserBookRelation.objects.filter(rating=5).values('book_id'))
+        sql, params = rated.order_by('id')[:10].query.sql_with_params()
+        self.assertEqual(['catalog_userbookrelation'], self.get_full_scans(sql, params))
+        for queryset in (Book.objects.order_by('id'), Book.objects.order_by('title')):
+            sql, params = queryset[:10].query.sql_with_params()
+            self.assertEqual([], self.get_full_scans(sql, params))
+
+        self.assertEqual(['catalog_book'], self.get_postgresql_full_scans([
+            'Aggregate  (cost=0.15..60.40 rows=1 width=16)',
+            '  ->  Index Only Scan using catalog_book_updated_at_17463810 on catalog_book  (cost=0.15..55.40)',
+        ]))
+        self.assertEqual([], self.get_postgresql_full_scans([
+            'Limit  (cost=0.15..0.62 rows=10 width=8)',
+            '  ->  Index Scan using catalog_book_pkey on catalog_book  (cost=0.15..47.15 rows=1000 width=8)',
+        ]))
+        self.assertEqual([], self.get_postgresql_full_scans([
+            'Index Scan using catalog_book_pkey on catalog_book  (cost=0.15..8.17 rows=1 width=8)',
+            '  Index Cond: (id = 1)',
+        ]))
+
+    def test_book_endpoints(self):
+        book = self.books[0]
+        LeaderboardEntry.objects.rebuild()
+        for params in ({}, {'limit': 2, 'offset': 2}, {'expand': 'author,categories'}, {'fields': 'id,title'},
+                       {'isbn': '978-3-16-148410-0'}, {'year_published': 1999}, {'title': book.title},
+                       {'categories': self.category.id}):
+            self.assertNoFullScans('get', reverse('api:v1:book-list'), params, self.user, allowed=self.offset_count_re)
+            self.assertNoFullScans('get', reverse('api:v1:book-list'), dict(params, pagination='cursor'), self.user)
+        for ordering in ('id', '-title', 'price', '-year_published', '-rating_avg'):
+            self.assertNoFullScans('get', reverse('api:v1:book-list'), {'pagination': 'cursor', 'ordering': ordering})
+        self.assertNoFullScans('get', reverse('api:v1:book-detail', args=(book.id,)), {'expand': 'categories'})
+        self.assertNoFullScans('get', reverse('api:v1:book-search'), {'q': book.title.split()[0]})
+        self.assertNoFullScans('get', reverse('api:v1:book-autocomplete'), {'q': book.title[:3]})
+        self.assertNoFullScans('get', reverse('api:v1:book-top'), {'by': 'wishlist', 'category': self.category.id})
+        self.assertNoFullScans('get', reverse('api:v1:book-similar', args=(book.id,)))
+        self.assertNoFullScans('get', reverse('api:v1:book-export'), {'output': 'csv'})
+
+    def test_relation_endpoints(self):
+        url = reverse('api:v1:userbookrelation-list')
+        for params in ({}, {'in_bookmarks': 'true'}, {'in_wishlist': 'true'}, {'book': self.books[0].id},
+                       {'expand': 'book'}, {'pagination': 'cursor'}):
+            self.assertNoFullScans('get', url, params, self.user)
+        self.assertNoFullScans('get', reverse('api:v1:userbookrelation-summary'), user=self.user)
+        self.assertNoFullScans('post', reverse('api:v1:userbookrelation-bulk'), [
+            {'book': self.books[0].id, 'rating': 5}, {'book': self.books[1].id, 'in_wishlist': True}
+        ], self.user, format='json')
+        relation = UserBookRelation.objects.filter(user=self.user).first()
+        self.assertNoFullScans('patch', reverse('api:v1:userbookrelation-detail', args=(relation.id,)),
+                               {'rating': 1}, self.user, format='json')
+        self.assertNoFullScans('get', reverse('api:v1:userbookrelation-export'), user=self.admin)
+
+
+class EndpointQueryBudgetTestCase(QueryBudgetMixin, APITestCase):
+    books_url = 'api:v1:book-list'
+    relations_url = 'api:v1:userbookrelation-list'
+    budget_endpoints = (
+        Endpoint('authors', 'api:v1:author-list'),
+        Endpoint('author', 'api:v1:author-detail', lambda case: (case.books[0].author_id,)),
+        Endpoint('author autocomplete', 'api:v1:author-autocomplete', params={'q': 'bud'}),
+        Endpoint('categories', 'api:v1:category-list'),
+        Endpoint('category', 'api:v1:category-detail', lambda case: (case.categories[0].id,)),
+        Endpoint('books', books_url),
+        Endpoint('books as user', books_url, user='user'),
+        Endpoint('books expanded', books_url, params={'expand': '1'}, user='user'),
+        Endpoint('books with authors', books_url, params={'expand': 'author'}, user='user'),
+        Endpoint('books with categories', books_url, params={'expand': 'categories'}, user='user'),
+        Endpoint('books sparse', books_url, params={'fields': 'id,title,categories'}, user='user'),
+        Endpoint('books cursor', books_url, params={'pagination': 'cursor', 'ordering': '-rating_avg'}, user='user'),
+        Endpoint('books in category', books_url, params=lambda case: {'categories': case.categories[0].id},
+                 user='user'),
+        Endpoint('book', 'api:v1:book-detail', lambda case: (case.books[0].id,), user='user'),
+        Endpoint('book expanded', 'api:v1:book-detail', lambda case: (case.books[0].id,), {'expand': '1'},
+                 user='user'),
+        Endpoint('book update', 'api:v1:book-detail', lambda case: (case.books[0].id,),
+                 data={'title': 'Budget renamed'}, method='patch', user='admin'),
+        Endpoint('book search', 'api:v1:book-search', params={'q': 'budget'}, user='user'),
+        Endpoint('book autocomplete', 'api:v1:book-autocomplete', params={'q': 'bud'}),
+        Endpoint('similar books', 'api:v1:book-similar', lambda case: (case.books[0].id,), user='user'),
+        Endpoint('top books', 'api:v1:book-top', params={'by': 'rating', 'limit': 50}, user='user'),
+        Endpoint('book export', 'api:v1:book-export', params={'output': 'csv'}),
+        Endpoint('relations', relations_url, user='user'),
+        Endpoint('relations expanded', relations_url, params={'expand': '1'}, user='user'),
+        Endpoint('relations with nested book', relations_url, params={'expand': 'book.author,book.categories'},
+                 user='user'),
+        Endpoint('relations as staff', relations_url, user='admin'),
+        Endpoint('relations cursor', relations_url, params={'pagination': 'cursor'}, user='user'),
+        Endpoint('relation', 'api:v1:userbookrelation-detail', lambda case: (case.relations[0].id,), user='user'),
+        Endpoint('relation update', 'api:v1:userbookrelation-detail', lambda case: (case.relations[0].id,),
+                 data={'rating': 1, 'in_wishlist': True}, method='patch', user='user'),
+        Endpoint('relation create', relations_url, data=lambda case: {'book': case.unread_book.id}, method='post',
+                 user='user'),
+        Endpoint('relations bulk', 'api:v1:userbookrelation-bulk', method='post', user='user',
+                 data=lambda case: [{'book': book.id, 'rating': 5} for book in case.books[:3]]),
+        Endpoint('library summary', 'api:v1:userbookrelation-summary', user='user'),
+        Endpoint('relation export', 'api:v1:userbookrelation-export', user='admin'),
+    )
+
+    def setUp(self):
+        self.admin = UserFactory.create(is_superuser=True, is_staff=True)
+        self.user = UserFactory.create(is_superuser=False, is_staff=False)
+        self.readers, self.authors, self.books, self.relations = [], [], [], []
+        self.categories = [CategoryFactory.create()]
+        self.unread_book = BookFactory.create(author=AuthorFactory.create(name='Budget'), categories=self.categories)
+
+    def seed(self, size):
+        while len(self.books) < size:
+            number = len(self.books)
+            if number % 3 == 0:
+                self.readers.append(UserFactory.create())
+                self.authors.append(AuthorFactory.create(name='Budget {}'.format(number)))
+                self.categories.append(CategoryFactory.create())
+            book = BookFactory.create(title='Budget {}'.format(number), author=self.authors[-1],
+                                      categories=self.categories[-2:])
+            self.books.append(book)
+            for user in [self.user, self.admin] + self.readers:
+                relation = UserBookRelationFactory.create(user=user, book=book, rating=number % 5 + 1)
+                if user is self.user:
+                    self.relations.append(relation)
+            if number:
+                SimilarBook.objects.create(book=self.books[0], similar=book, position=number, score=1 / number,
+                                           computed_at=timezone.now())
+        LeaderboardEntry.objects.rebuild()
+
+    def reset_caches(self):
+        cache.clear()
+        author_index.clear()
+        book_index.clear()
+
+
+class BenchmarkTestCase(APITestCase):
+    def setUp(self):
+        call_command('seed_benchmark', books=80, users=6, relations=60, categories=3, seed=3, stdout=StringIO())
+        UserFactory.create(is_superuser=True, is_staff=True)
+
+    def test_benchmark_runner(self):
+        relations = list(UserBookRelation.objects.order_by('id').values_list('id', 'rating', 'in_wishlist'))
+        results = BenchmarkRunner(requests=2, warmup=1).run()
+        self.assertEqual([endpoint.name for endpoint in BENCHMARK_ENDPOINTS], list(results))
+        for name, result in results.items():
+            self.assertEqual((2, 0), (result['requests'], result['errors']), "{} failed".format(name))
+            self.assertLessEqual(result['p50'], result['p99'])
+        self.assertEqual(relations, list(UserBookRelation.objects.order_by('id').values_list(
+            'id', 'rating', 'in_wishlist'
+        )), "Benchmarked writes should be rolled back")
+
+    def test_benchmark_command(self):
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+            out = StringIO()
+            call_command('benchmark_api', endpoints=['books', 'relation update'], requests=3, warmup=0,
+                         output=output.name, stdout=out, stderr=StringIO())
+            report = json.load(output)
+        self.assertEqual(['books', 'relation update'], list(report['endpoints']))
+        self.assertEqual(3, report['endpoints']['books']['requests'])
+        self.assertTrue(report['compiled_lists'])
+        self.assertIn('relation update', out.getvalue())
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+            call_command('benchmark_api', endpoints=['books large page'], requests=1, warmup=0, serializers=True,
+                         output=output.name, stdout=StringIO(), stderr=StringIO())
+            self.assertFalse(json.load(output)['compiled_lists'])
+        with self.assertRaises(CommandError):
+            call_command('benchmark_api', endpoints=['unknown'], stdout=StringIO())
+
+
+class ProfilingTestCase(APITestCase):
+    def setUp(self):
+        self.spool_directory = tempfile.TemporaryDirectory()
+        self.spool = ProfileSpool(self.spool_directory.name)
+        AuthorFactory.create()
+        CategoryFactory.create_batch(2)
+        BookFactory.create_batch(3)
+
+    def tearDown(self):
+        self.spool_directory.cleanup()
+
+    def profiling(self, **kwargs):
+        return override_settings(**dict({'PROFILING_SPOOL_DIR': self.spool_directory.name, 'PROFILING_SAMPLE_RATE': 1,
+                                         'PROFILING_SLOW_REQUEST_SECONDS': None}, **kwargs))
+
+    def test_sampled_requests(self):
+        with self.profiling():
+            self.client.get(reverse('api:v1:book-list'))
+            self.client.get(reverse('api:v1:category-detail', args=(Category.objects.first().id,)))
+        book_list, category = self.spool.read()
+        self.assertEqual(('BookViewSet.list', 'sample', 200), (book_list['view'], book_list['trigger'],
+                                                              book_list['status']))
+        self.assertEqual('CategoryViewSet.retrieve', category['view'])
+        self.assertGreater(book_list['sql']['count'], 0)
+        self.assertIn('catalog_book', ' '.join(query['sql'] for query in book_list['sql']['slowest']))
+        self.assertTrue(any(label.startswith('api/v1/views.py:') for label, _, _, _ in book_list['functions']),
+                        "Profiled functions should be labelled relative to the project")
+
+        call_command('aggregate_profiles', spool=self.spool_directory.name, top=3, stdout=StringIO())
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+            call_command('aggregate_profiles', spool=self.spool_directory.name, views=['BookViewSet.list'], top=3,
+                         output=output.name, stdout=StringIO())
+            report = json.load(output)
+        self.assertEqual(['BookViewSet.list'], list(report))
+        self.assertEqual((1, 1, 0), (report['BookViewSet.list']['requests'], report['BookViewSet.list']['sampled'],
+                                     report['BookViewSet.list']['slow']))
+        self.assertEqual(3, len(report['BookViewSet.list']['functions']))
+
+    def test_slow_requests(self):
+        with self.profiling(PROFILING_SAMPLE_RATE=0, PROFILING_SLOW_REQUEST_SECONDS=0):
+            self.client.get(reverse('api:v1:author-list'))
+        # clients load the middleware once, a new one picks the new settings up
+        with self.profiling(PROFILING_SAMPLE_RATE=0, PROFILING_SLOW_REQUEST_SECONDS=60):
+            self.client_class().get(reverse('api:v1:book-list'))
+        profile, = self.spool.read()
+        self.assertEqual(('AuthorViewSet.list', 'slow', 'stack'), (profile['view'], profile['trigger'],
+                                                                   profile['profiler']))
+        self.assertNotIn('sql', profile)
+
+    def test_stack_sampler(self):
+        sampler = StackSampler(0.001)
+
+        def busy_profiled_function(seconds):
+            started = time.perf_counter()
+            while time.perf_counter() - started < seconds:
+                pass
+
+        sampler.start()
+        busy_profiled_function(0.1)
+        functions = {label.rpartition('(')[2]: (own, cumulative)
+                     for label, _, own, cumulative in stack_functions(sampler.stop(), sampler.interval)}
+        own, cumulative = functions['busy_profiled_function)']
+        self.assertGreater(own, 0)
+        self.assertGreaterEqual(functions['test_stack_sampler)'][1], cumulative)
+
+    def test_spool_rotation(self):
+        with self.profiling(PROFILING_SPOOL_MAX_FILES=2):
+            for _ in range(3):
+                self.client.get(reverse('api:v1:author-list'))
+        self.assertEqual(2, len(self.spool.paths()))
+
+    def test_disabled(self):
+        with self.profiling(PROFILING_SPOOL_DIR=None):
+            self.client.get(reverse('api:v1:author-list'))
+        self.assertEqual([], self.spool.paths())
+
+
+class MetricsTestCase(APITestCase):
+    def setUp(self):
+        self.admin = UserFactory.create(is_superuser=True, is_staff=True)
+        self.user = UserFactory.create(is_superuser=False, is_staff=False)
+        AuthorFactory.create()
+        CategoryFactory.create_batch(2)
+        BookFactory.create_batch(3)
+        self.metrics_directory = tempfile.TemporaryDirectory()
+        self.metrics = override_settings(METRICS_DIR=self.metrics_directory.name, METRICS_LATENCY_BUCKETS=(0.5, 60))
+        self.metrics.enable()
+
+    def tearDown(self):
+        self.metrics.disable()
+        self.metrics_directory.cleanup()
+
+    def get_metrics(self):
+        client = self.client_class()
+        client.force_authenticate(self.admin)
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Metrics failed")
+        self.assertEqual('text/plain; version=0.0.4; charset=utf-8', response['Content-Type'])
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_metrics(self):
+        self.client.get(reverse('api:v1:book-list'))
+        content = self.client.get(reverse('api:v1:book-list')).content
+        response = self.client.get(reverse('api:v1:book-export'))
+        exported = b''.join(response.streaming_content)
+        response.close()
+        self.client.post(reverse('api:v1:book-list'), {})
+        self.client.get('/unknown/')
+
+        samples = self.get_metrics()
+        books = 'view="api:v1:book-list",method="GET"'
+        self.assertEqual(2, samples['library_http_requests_total{{{}}}'.format(books)])
+        self.assertEqual(1, samples['library_http_requests_total{view="api:v1:book-list",method="POST"}'])
+        self.assertEqual(1, samples['library_http_requests_total{view="unresolved",method="GET"}'])
+        self.assertEqual(2 * len(content), samples['library_http_response_bytes_total{{{}}}'.format(books)])
+        self.assertEqual(len(exported),
+                         samples['library_http_response_bytes_total{view="api:v1:book-export",method="GET"}'],
+                         "Streamed responses should be counted once consumed")
+        self.assertGreater(samples['library_http_sql_queries_total{{{}}}'.format(books)], 0)
+        self.assertGreater(samples['library_http_sql_duration_seconds_total{{{}}}'.format(books)], 0)
+        self.assertEqual(2, samples['library_http_request_duration_seconds_bucket{{{},le="60.0"}}'.format(books)])
+        self.assertEqual(2, samples['library_http_request_duration_seconds_bucket{{{},le="+Inf"}}'.format(books)])
+        self.assertEqual(2, samples['library_http_request_duration_seconds_count{{{}}}'.format(books)])
+        self.assertGreater(samples['library_http_request_duration_seconds_sum{{{}}}'.format(books)], 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('api:v1:author-list'))
+        query_count = len(queries)
+        samples = self.get_metrics()
+        self.assertEqual(query_count, samples['library_http_sql_queries_total{view="api:v1:author-list",method="GET"}'])
+
+    def test_worker_processes(self):
+        self.client.get(reverse('api:v1:book-list'))
+        recorder = MetricsRecorder(self.metrics_directory.name, (0.5, 60))
+        # another worker, its file outgrowing the initial size
+        path = os.path.join(self.metrics_directory.name, '{}{}'.format(os.getpid() + 1, METRICS_SUFFIX))
+        worker = MetricsFile(path)
+        for number in range(INITIAL_SIZE // 128 + 1):
+            index = worker.position('view="view-{}",method="GET"'.format(number), recorder.value_count)
+            worker.values[index] += 1
+        index = worker.position('view="api:v1:book-list",method="GET"', recorder.value_count)
+        worker.values[index] += 3
+        worker.close()
+        worker = MetricsFile(path)
+        self.assertEqual(index, worker.position('view="api:v1:book-list",method="GET"', recorder.value_count),
+                         "Reopened files should carry on")
+        worker.close()
+
+        series = recorder.collect()
+        self.assertEqual(4, series['view="api:v1:book-list",method="GET"'][0])
+        self.assertEqual(1, series['view="view-0",method="GET"'][0])
+        self.assertEqual(4, self.get_metrics()['library_http_requests_total{view="api:v1:book-list",method="GET"}'])
+
+    def test_permissions(self):
+        self.assertEqual(status.HTTP_403_FORBIDDEN, self.client.get('/metrics').status_code)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(status.HTTP_403_FORBIDDEN, self.client.get('/metrics').status_code)
+        self.client.force_authenticate(self.admin)
+        with override_settings(METRICS_DIR=None):
+            self.assertEqual(status.HTTP_404_NOT_FOUND, self.client.get('/metrics').status_code)
+
+
+class SlowQueryTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory.create()
+        AuthorFactory.create()
+        CategoryFactory.create_batch(2)
+        BookFactory.create_batch(3)
+        self.log_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.log_directory.cleanup()
+
+    def slow_queries(self, seconds=0):
+        return override_settings(SLOW_QUERY_LOG_DIR=self.log_directory.name, SLOW_QUERY_SECONDS=seconds)
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            'SELECT "t1"."id" FROM "catalog_book" WHERE ("t1"."id" IN (...) AND "t1"."title" = ? AND "rating" > ?) '
+            'LIMIT ?',
+            fingerprint('SELECT "t1"."id"  FROM "catalog_book"\nWHERE ("t1"."id" IN (%s, %s, %s) AND "t1"."title" = '
+                        '\'It\'\'s\' AND "rating" > 4.5) LIMIT 21')
+        )
+        self.assertEqual(fingerprint('INSERT INTO "t" ("a", "b") VALUES (%s, %s), (%s, %s)'),
+                         fingerprint('INSERT INTO "t" ("a", "b") VALUES (%s, %s)'))
+
+    def test_slow_query_log(self):
+        with self.slow_queries():
+            for _ in range(2):
+                self.client.get(reverse('api:v1:category-list'))
+                cache.clear()
+            self.client.get(reverse('api:v1:book-list'), {'expand': '1'})
+            response = self.client.get(reverse('api:v1:book-export'))
+            b''.join(response.streaming_content)
+            response.close()
+        Book.objects.count()
+        entries = list(read_logs(self.log_directory.name))
+        categories = [entry for entry in entries if 'api:v1:category-list' in entry['views']]
+        self.assertTrue(categories)
+        self.assertTrue(all(entry['views']['api:v1:category-list'] == 2 for entry in categories),
+                        "The statements should be grouped by fingerprint")
+        self.assertTrue(any('api:v1:book-export' in entry['views'] for entry in entries),
+                        "Statements of streamed responses should be logged")
+        self.assertFalse(any(entry['views'].get('') for entry in entries),
+                         "Statements out of the requests should not be logged")
+        select = next(entry for entry in categories if entry['sql'].startswith('SELECT'))
+        self.assertTrue(select['plan'] and all(isinstance(line, str) for line in select['plan']))
+        self.assertGreaterEqual(select['seconds'], select['max_seconds'])
+
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+            call_command('slow_queries', log_dir=self.log_directory.name, view='api:v1:category-list', plans=True,
+                         top=100, output=output.name, stdout=StringIO())
+            worst = json.load(output)
+        self.assertEqual(sorted(entry['id'] for entry in categories), sorted(entry['id'] for entry in worst))
+        self.assertEqual(sorted((entry['seconds'] for entry in worst), reverse=True),
+                         [entry['seconds'] for entry in worst])
+        with override_settings(SLOW_QUERY_LOG_DIR=None), self.assertRaises(CommandError):
+            call_command('slow_queries', stdout=StringIO())
+
+    def test_threshold(self):
+        with self.slow_queries(seconds=60):
+            self.client.get(reverse('api:v1:category-list'))
+        self.assertEqual([], list(read_logs(self.log_directory.name)))
+
+
+class ReplicaTestCase(APITestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+        author = AuthorFactory.create()
+        CategoryFactory.create()
+        self.book = BookFactory.create(author=author)
+        self.relation = UserBookRelationFactory.create(user=self.user, book=BookFactory.create(author=author))
+        # the replica is the test database itself, the queries it gets are told apart by the router spy
+        connections.databases['replica'] = connections.databases['default']
+        connections['replica'] = connections['default']
+        self.replicas = override_settings(REPLICA_DATABASES=['replica'], REPLICA_STICKY_SECONDS=10,
+                                          REPLICA_WRITES_CACHE='writes', CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'writes': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': os.path.join(tempfile.gettempdir(), 'library-replica-writes-tests'),
+            },
+        })
+        self.replicas.enable()
+        caches['writes'].clear()
+        self.addCleanup(caches['writes'].clear)
+
+    def tearDown(self):
+        self.replicas.disable()
+        del connections['replica']
+        del connections.databases['replica']
+        routers.local.replica = None
+
+    def read_aliases(self, method, url, data=None):
+        aliases, original = [], routers.read_replica
+
+        def read_replica():
+            aliases.append(original())
+            return aliases[-1]
+
+        with mock.patch('library.routers.read_replica', side_effect=read_replica):
+            response = getattr(self.client, method)(url, data)
+        self.assertLess(response.status_code, 400, "{} {} failed".format(method.upper(), url))
+        return set(aliases)
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual({'replica'}, self.read_aliases('get', reverse('api:v1:book-list')))
+        self.assertEqual({'replica'}, self.read_aliases('head', reverse('api:v1:book-detail', args=(self.book.id,))))
+        self.assertEqual({None}, self.read_aliases('get', reverse('add_book')),
+                         "Other views should read from the primary")
+        self.assertEqual(None, routers.local.replica)
+
+    def test_summary_rebuild_reads_primary(self):
+        self.client.force_authenticate(self.user)
+        UserLibraryStats.objects.filter(user=self.user).delete()
+        url = reverse('api:v1:userbookrelation-summary')
+        self.assertEqual({'replica', None}, self.read_aliases('get', url),
+                         "Missing statistics should be rebuilt and read back on the primary")
+        self.assertEqual(1, self.client.get(url).json()['rating_count'])
+
+    def test_writes_stick_to_primary(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual({'replica'}, self.read_aliases('get', reverse('api:v1:userbookrelation-list')))
+        url = reverse('api:v1:userbookrelation-detail', args=(self.relation.id,))
+        self.assertEqual({None}, self.read_aliases('patch', url, {'in_bookmarks': True}))
+        self.assertIn(routers.STICKY_COOKIE, self.client.cookies)
+        self.assertEqual({None}, self.read_aliases('get', reverse('api:v1:userbookrelation-list')),
+                         "Reads should stay on the primary after a write")
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + 11):
+            self.assertEqual({'replica'}, self.read_aliases('get', reverse('api:v1:userbookrelation-list')))
+
+    def test_writes_stick_to_primary_without_cookie(self):
+        other = UserFactory.create()
+        self.client.force_authenticate(self.user)
+        url = reverse('api:v1:userbookrelation-detail', args=(self.relation.id,))
+        self.assertEqual({None}, self.read_aliases('patch', url, {'in_bookmarks': True}))
+        # a token client ignoring the cookie
+        self.client.cookies.clear()
+        self.assertEqual({None}, self.read_aliases('get', reverse('api:v1:userbookrelation-list')),
+                         "Reads should stay on the primary after a write")
+        self.client.force_authenticate(other)
+        self.assertEqual({'replica'}, self.read_aliases('get', reverse('api:v1:userbookrelation-list')),
+                         "The writes of other users should not move reads to the primary")
+        self.client.force_authenticate(self.user)
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertEqual({'replica'}, self.read_aliases('get', reverse('api:v1:userbookrelation-list')))
+
+    def test_writes_untracked_without_shared_cache(self):
+        with override_settings(REPLICA_WRITES_CACHE='default'):
+            self.assertEqual({'replica'}, self.read_aliases('get', reverse('api:v1:book-list')))
+            self.client.force_authenticate(self.user)
+            self.assertEqual({None}, self.read_aliases('get', reverse('api:v1:book-list')),
+                             "Authenticated users may have written in another worker process")
+
+    def test_router(self):
+        self.assertEqual('default', Book.objects.all().db)
+        routers.local.replica, routers.local.transaction_state = 'replica', routers.transaction_state()
+        book = Book.objects.get(pk=self.book.pk)
+        self.assertEqual('replica', book._state.db)
+        self.assertEqual('default', router.db_for_write(Book, instance=book))
+        with transaction.atomic():
+            self.assertEqual('default', Book.objects.all().db, "Reads within a transaction should see its writes")
+        self.relation.book = book
+        self.relation.save()
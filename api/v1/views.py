@@ -1,44 +1,202 @@
 from rest_framework import viewsets
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from .serializers import AuthorSerializer, BookSerializer, ExpandedBookSerializer, CategorySerializer, \
-    UserBookRelationSerializer, ExpandedUserBookRelationSerializer, StaffBookRelationSerializer
-from catalog.models import Author, Book, Category
-from .filter_backends import StaffAccessFilter, UserBookRelationFilter
+    UserBookRelationSerializer, ExpandedUserBookRelationSerializer, StaffBookRelationSerializer, \
+    BulkUserBookRelationSerializer, UserLibraryStatsSerializer
+from catalog.models import Author, Book, BookStats, Category, CategoryStats, LeaderboardEntry
+from .filter_backends import BookFilter, KeysetOrderingFilter, StaffAccessFilter, UserBookRelationFilter
 from django_filters.rest_framework import DjangoFilterBackend
-from .mixins.views import ExpandableViewSetMixin, PrefetchUserData, StaffViewSetMixin
-from catalog.models import UserBookRelation
+from .mixins.views import AutocompleteViewSetMixin, CompiledListViewSetMixin, ConditionalGetViewSetMixin, \
+    ExpandableViewSetMixin, ExpandRelation, ExportViewSetMixin, KeysetPaginationViewSetMixin, PrefetchUserData, \
+    ReplicaViewSetMixin, SparseFieldsetViewSetMixin, StaffViewSetMixin
+from .export import BookExporter, UserBookRelationExporter
+from catalog.models import UserBookRelation, UserLibraryStats
+from catalog.search import get_search_backend
+from catalog.autocomplete import author_index, book_index
 
 
-class AuthorViewSet(viewsets.ModelViewSet):
+class AuthorViewSet(ReplicaViewSetMixin, SparseFieldsetViewSetMixin, ConditionalGetViewSetMixin,
+                    AutocompleteViewSetMixin, viewsets.ModelViewSet):
     queryset = Author.objects.all()
     serializer_class = AuthorSerializer
+    autocomplete_index = author_index
+    sparse_field_dependencies = {
+        'full_name': ('name', 'family_name'),
+    }
 
 
-class BookViewSet(ExpandableViewSetMixin, PrefetchUserData, viewsets.ModelViewSet):
-    queryset = Book.objects.select_related('author')
+class BookViewSet(ReplicaViewSetMixin, SparseFieldsetViewSetMixin, ExpandableViewSetMixin, PrefetchUserData,
+                  KeysetPaginationViewSetMixin, ConditionalGetViewSetMixin, CompiledListViewSetMixin,
+                  AutocompleteViewSetMixin, ExportViewSetMixin, viewsets.ModelViewSet):
+    queryset = Book.objects.select_related('stats')
     serializer_class = BookSerializer
+    autocomplete_index = book_index
+    exporter_class = BookExporter
     serializer_expanded_class = ExpandedBookSerializer
+    filter_backends = (DjangoFilterBackend, KeysetOrderingFilter)
+    filter_class = BookFilter
+    keyset_orderings = {
+        'id': 'id',
+        'title': 'title',
+        'price': 'price',
+        'year_published': 'year_published',
+        'rating_avg': ('stats__rating_avg', 'stats__book_id'),
+    }
+    expandable_relations = {
+        'author': ExpandRelation('author'),
+        'categories': ExpandRelation(
+            'categories', queryset=Category.objects.select_related('stats'),
+            collapsed_queryset=Category.objects.only('id')
+        ),
+    }
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        if not self.should_expand():
-            queryset = queryset.prefetch_related('categories')
-        return queryset
+    def get_validator_querysets(self, queryset):
+        querysets = super().get_validator_querysets(queryset)
+        querysets.append(BookStats.objects.filter(book__in=queryset.values('pk')))
+        expand = self.get_expand()
+        if 'author' in expand:
+            querysets.append(Author.objects.filter(books__in=queryset.values('pk')).distinct())
+        if 'categories' in expand:
+            querysets.extend((Category.objects.filter(books__in=queryset.values('pk')).distinct(),
+                              CategoryStats.objects.filter(category__books__in=queryset.values('pk')).distinct()))
+        if self.request.user.is_authenticated:
+            querysets.append(UserBookRelation.objects.filter(user=self.request.user, book__in=queryset.values('pk')))
+        return querysets
 
+    @list_route()
+    def search(self, request):
+        query = request.query_params.get('q', '')
+        if not query.strip():
+            raise ParseError('Search query is required')
+        results = get_search_backend().search(query, self.get_queryset())
+        page = self.paginate_queryset(results)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
 
-class CategoryViewSet(viewsets.ModelViewSet):
-    queryset = Category.objects.all()
+    @detail_route()
+    def similar(self, request, pk=None):
+        # a single read of the (book, position) index joined to the neighbour books
+        books = list(self.get_queryset().filter(similar_entries__book_id=pk).annotate(
+            similarity_position=F('similar_entries__position'), similarity_score=F('similar_entries__score')
+        ).order_by('similarity_position'))
+        if not books and not Book.objects.filter(pk=pk).exists():
+            raise NotFound()
+        data = self.get_serializer(books, many=True).data
+        return Response({
+            'results': [{'position': book.similarity_position, 'score': book.similarity_score, 'book': item}
+                        for book, item in zip(books, data)],
+        })
+
+    def get_top_params(self):
+        params = self.request.query_params
+        metric = params.get('by', LeaderboardEntry.METRIC_RATING)
+        period = params.get('period', LeaderboardEntry.PERIOD_ALL)
+        if metric not in dict(LeaderboardEntry.METRIC_CHOICES):
+            raise ParseError('Unknown leaderboard: {}'.format(metric))
+        if period not in LeaderboardEntry.PERIODS:
+            raise ParseError('Unknown period: {}'.format(period))
+        try:
+            category, author = (int(params[name]) if params.get(name) else None for name in ('category', 'author'))
+            limit = int(params.get('limit', 10))
+        except ValueError:
+            raise ParseError('Invalid category, author or limit')
+        if category and author:
+            raise ParseError('Leaderboards are either per category or per author')
+        return metric, period, category, author, max(1, min(limit, getattr(settings, 'CATALOG_LEADERBOARD_SIZE', 100)))
+
+    @list_route()
+    def top(self, request):
+        metric, period, category, author, limit = self.get_top_params()
+        entries = list(LeaderboardEntry.objects.board(metric, period, category, author).values_list(
+            'book_id', 'position', 'score', 'computed_at'
+        )[:limit])
+        books = {book.pk: book for book in self.get_queryset().filter(pk__in=[entry[0] for entry in entries])}
+        entries = [entry for entry in entries if entry[0] in books]
+        data = self.get_serializer([books[entry[0]] for entry in entries], many=True).data
+        return Response({
+            'by': metric,
+            'period': period,
+            'computed_at': entries[0][3] if entries else None,
+            'results': [{'position': position, 'score': score, 'book': book}
+                        for (_, position, score, _), book in zip(entries, data)],
+        })
+
+
+class CategoryViewSet(ReplicaViewSetMixin, SparseFieldsetViewSetMixin, ConditionalGetViewSetMixin,
+                      viewsets.ModelViewSet):
+    queryset = Category.objects.select_related('stats')
     serializer_class = CategorySerializer
 
+    def get_validator_querysets(self, queryset):
+        querysets = super().get_validator_querysets(queryset)
+        return querysets + [CategoryStats.objects.filter(category__in=queryset.values('pk'))]
 
-class UserBookRelationViewSet(ExpandableViewSetMixin, PrefetchUserData, StaffViewSetMixin, viewsets.ModelViewSet):
+
+class UserBookRelationViewSet(ReplicaViewSetMixin, SparseFieldsetViewSetMixin, ExpandableViewSetMixin,
+                              PrefetchUserData, StaffViewSetMixin, KeysetPaginationViewSetMixin, ExportViewSetMixin,
+                              viewsets.ModelViewSet):
     serializer_class = UserBookRelationSerializer
     serializer_expanded_class = ExpandedUserBookRelationSerializer
     staff_serializer_class = StaffBookRelationSerializer
     permission_classes = (IsAuthenticated,)
-    filter_backends = (DjangoFilterBackend, StaffAccessFilter,)
+    filter_backends = (DjangoFilterBackend, StaffAccessFilter, KeysetOrderingFilter)
     filter_class = UserBookRelationFilter
     queryset = UserBookRelation.objects.all()
+    user_data_book_field = 'book_id'
+    exporter_class = UserBookRelationExporter
+    export_permission_classes = (IsAdminUser,)
+    expandable_relations = {
+        'book': ExpandRelation('book__stats'),
+        'book.author': ExpandRelation('book__author'),
+        'book.categories': ExpandRelation(
+            'book__categories', queryset=Category.objects.select_related('stats'),
+            collapsed_queryset=Category.objects.only('id')
+        ),
+    }
+    bulk_max_items = 1000
+
+    @list_route(methods=['post'])
+    def bulk(self, request):
+        if not isinstance(request.data, list):
+            raise ParseError('Expected a list of relations')
+        if len(request.data) > self.bulk_max_items:
+            raise ParseError('At most {} relations can be sent at once'.format(self.bulk_max_items))
+        results, values = [], {}
+        for item in request.data:
+            serializer = BulkUserBookRelationSerializer(data=item)
+            if not serializer.is_valid():
+                results.append({'book': item.get('book') if isinstance(item, dict) else None, 'status': 'invalid',
+                                'errors': serializer.errors})
+                continue
+            book_id = serializer.validated_data.pop('book')
+            if book_id in values:
+                results.append({'book': book_id, 'status': 'invalid', 'errors': {'book': ['Duplicate book']}})
+                continue
+            values[book_id] = serializer.validated_data
+            results.append({'book': book_id, 'status': None})
+        statuses = UserBookRelation.objects.bulk_upsert(request.user, values)
+        for result in results:
+            if result['status'] is None:
+                result['status'] = statuses[result['book']]
+                if result['status'] == 'missing':
+                    result.update(status='invalid', errors={'book': ['Book does not exist']})
+        return Response(results)
+
+    @list_route()
+    def summary(self, request):
+        # counters of the requesting user, whatever the staff access filter lets them list
+        stats = UserLibraryStats.objects.filter(user=request.user).first()
+        if stats is None:
+            # the reads of a transaction go to the primary rebuild() writes to, see library.routers
+            with transaction.atomic():
+                UserLibraryStats.objects.rebuild([request.user.pk])
+                stats = UserLibraryStats.objects.get(user=request.user)
+        return Response(UserLibraryStatsSerializer(stats).data)
 
 
 class ExpandedBookRelationViewSet(UserBookRelationViewSet):
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from . import models
+from .widgets import AutocompleteWidget
 
 
 @admin.register(models.Author)
@@ -15,6 +16,11 @@ class BookAdmin(admin.ModelAdmin):
     list_display_links = ('id', 'title')
     search_fields = ('id', 'title', 'title_original', 'isbn', 'author__name', 'author__family_name', 'publisher__name')
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'author':
+            kwargs['widget'] = AutocompleteWidget(models.Author, 'api:v1:author-autocomplete')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
 
 @admin.register(models.Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -0,0 +1,131 @@
+import threading
+import time
+import uuid
+from bisect import bisect_left, insort
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from .models import Author, Book
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+class PrefixIndex(object):
+    """
+    In-process prefix index: a sorted array of (key, id) pairs searched with bisect, with one key per word of
+    the label so that "tolst" finds "Leo Tolstoy". Built lazily on the first lookup, updated incrementally from
+    signals and rebuilt after CATALOG_AUTOCOMPLETE_TTL seconds to pick up writes made by other processes. Bulk
+    writes, which skip the signals, call invalidate(): every process sharing CATALOG_AUTOCOMPLETE_CACHE rebuilds
+    its index on the next lookup, the others only after the TTL.
+    """
+    version_key = 'autocomplete:version:{}'
+
+    def __init__(self, name, load):
+        self.name = name
+        self.load = load
+        self.lock = threading.RLock()
+        self.built_at = None
+        self.version = None
+        self.keys = []
+        self.labels = {}
+
+    @staticmethod
+    def get_keys(label):
+        words = normalize(label).split(' ')
+        return [' '.join(words[i:]) for i in range(len(words)) if words[i]]
+
+    @property
+    def cache(self):
+        alias = getattr(settings, 'CATALOG_AUTOCOMPLETE_CACHE', None)
+        if not alias:
+            return None
+        cache = caches[alias]
+        # a version replaced in one worker process would never reach the copies of the others
+        return None if isinstance(cache, (LocMemCache, DummyCache)) else cache
+
+    def get_version(self):
+        cache = self.cache
+        if cache is None:
+            return None
+        key = self.version_key.format(self.name)
+        # add() never replaces a version set by a concurrent invalidation
+        cache.add(key, uuid.uuid4().hex, None)
+        return cache.get(key)
+
+    def is_stale(self):
+        ttl = getattr(settings, 'CATALOG_AUTOCOMPLETE_TTL', 5 * 60)
+        if self.built_at is None or ttl is not None and time.monotonic() - self.built_at > ttl:
+            return True
+        return self.get_version() != self.version
+
+    def build(self):
+        # read first, an invalidation during the load leaves the index stale
+        version = self.get_version()
+        labels = {pk: label for pk, label in self.load()}
+        keys = sorted((key, pk) for pk, label in labels.items() for key in self.get_keys(label))
+        with self.lock:
+            self.labels, self.keys, self.built_at, self.version = labels, keys, time.monotonic(), version
+
+    def clear(self):
+        with self.lock:
+            self.labels, self.keys, self.built_at = {}, [], None
+
+    def invalidate(self):
+        self.clear()
+        if self.cache is not None:
+            self.cache.set(self.version_key.format(self.name), uuid.uuid4().hex, None)
+
+    def _remove(self, pk):
+        label = self.labels.pop(pk, None)
+        if label is None:
+            return
+        for key in self.get_keys(label):
+            i = bisect_left(self.keys, (key, pk))
+            if i < len(self.keys) and self.keys[i] == (key, pk):
+                del self.keys[i]
+
+    def update(self, pk, label):
+        with self.lock:
+            if self.built_at is None:
+                return
+            self._remove(pk)
+            self.labels[pk] = label
+            for key in self.get_keys(label):
+                insort(self.keys, (key, pk))
+
+    def remove(self, pk):
+        with self.lock:
+            self._remove(pk)
+
+    def lookup(self, prefix, limit=10):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        if self.is_stale():
+            self.build()
+        results, seen = [], set()
+        with self.lock:
+            i = bisect_left(self.keys, (prefix,))
+            while i < len(self.keys) and len(results) < limit:
+                key, pk = self.keys[i]
+                if not key.startswith(prefix):
+                    break
+                if pk not in seen:
+                    seen.add(pk)
+                    results.append((pk, self.labels[pk]))
+                i += 1
+        return results
+
+
+def author_label(name, family_name):
+    return '{} {}'.format(name, family_name) if family_name else name
+
+
+author_index = PrefixIndex('authors', lambda: (
+    (pk, author_label(name, family_name)) for pk, name, family_name in
+    Author.objects.values_list('id', 'name', 'family_name').iterator()
+))
+book_index = PrefixIndex('books', lambda: Book.objects.values_list('id', 'title').iterator())
@@ -0,0 +1,12 @@
+from django import forms
+from .models import Author, Book
+from .widgets import AutocompleteWidget
+
+
+class BookForm(forms.ModelForm):
+    class Meta:
+        model = Book
+        fields = ['title', 'title_original', 'author', 'categories']
+        widgets = {
+            'author': AutocompleteWidget(Author, 'api:v1:author-autocomplete'),
+        }
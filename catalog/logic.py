@@ -1,5 +1,5 @@
 from django.contrib.auth.models import AnonymousUser
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
 
 
 def in_bookmarks(book, user):
@@ -7,3 +7,47 @@ def in_bookmarks(book, user):
         return False
     relation = book.userbookrelations.filter(user=user).first()
     return getattr(relation, 'in_bookmarks', False)
+
+
+def to_decimal(value):
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def discount_total(discount, group_discount):
+    return to_decimal(discount or 0) + to_decimal(group_discount or 0)
+
+
+def price(price_original, discount_total):
+    if price_original is None:
+        return None
+    price_original = to_decimal(price_original)
+    return (price_original - price_original * to_decimal(discount_total) / 100).quantize(
+        Decimal('0.01'), rounding=ROUND_HALF_UP
+    )
+
+
+def average_price(price_sum, priced_count):
+    if not priced_count:
+        return None
+    return (to_decimal(price_sum) / priced_count).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+RATINGS = range(1, 6)
+
+
+def relation_stats(rating, in_bookmarks, in_wishlist):
+    stats = {
+        'rating_count': 0 if rating is None else 1,
+        'rating_sum': rating or 0,
+        'bookmark_count': int(bool(in_bookmarks)),
+        'wishlist_count': int(bool(in_wishlist)),
+    }
+    for value in RATINGS:
+        stats['rating_{}_count'.format(value)] = int(rating == value)
+    return stats
+
+
+def stats_delta(previous, current):
+    return {field: current.get(field, 0) - previous.get(field, 0) for field in set(previous) | set(current)}
@@ -0,0 +1,32 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from catalog.similarity import SimilarityJob
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the "similar books" of every book from the ratings and bookmarks of the user book relations. '
+        'Requires numpy and scipy.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='Neighbours stored per book')
+        parser.add_argument('--chunk-size', type=int,
+                            help='Books compared per batch, bounds memory; all books at once by default')
+        parser.add_argument('--bookmark-weight', type=float, default=0.5,
+                            help='Weight of the bookmark similarity next to the rating similarity')
+        parser.add_argument('--load-chunk-size', type=int, default=100000, help='Relations read per query')
+
+    def handle(self, *args, **options):
+        try:
+            job = SimilarityJob(top_n=options['top'], chunk_size=options['chunk_size'],
+                                bookmark_weight=options['bookmark_weight'],
+                                load_chunk_size=options['load_chunk_size'])
+        except ImproperlyConfigured as error:
+            raise CommandError(error)
+        report = job.run()
+        for stage, seconds in report['timings'].items():
+            self.stdout.write('{}: {:.3f}s'.format(stage, seconds))
+        self.stdout.write(self.style.SUCCESS('Stored {} similar books for {} books from {} relations'.format(
+            report['entries'], report['books'], report['relations']
+        )))
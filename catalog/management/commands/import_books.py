@@ -0,0 +1,206 @@
+import csv
+import io
+import json
+import sys
+import time
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from catalog import logic
+from catalog.autocomplete import author_index
+from catalog.models import Author, Book, BookStats, Category, CategoryStats, DiscountGroup, Publisher, \
+    books_bulk_changed
+from catalog.search import get_search_backend
+
+BOOK_FIELDS = ('title', 'title_original', 'year_published', 'description', 'isbn', 'cover_type', 'price_original',
+               'discount')
+CATEGORY_SEPARATOR = '|'
+
+
+class RowError(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Streams books from a CSV or JSON lines feed into the catalog. Authors, publishers and categories are '
+        'resolved by name and created when missing, discount groups have to exist. Columns: {}, author_name, '
+        'author_family_name, publisher, discount_group and categories ("{}" separated in CSV, a list or a string '
+        'in JSON lines). Category statistics are rebuilt at the end, run rebuild_category_stats if the import '
+        'is interrupted. The autocomplete of the other processes shows the imported rows after '
+        'CATALOG_AUTOCOMPLETE_TTL unless they share CATALOG_AUTOCOMPLETE_CACHE.'.format(
+            ', '.join(BOOK_FIELDS), CATEGORY_SEPARATOR
+        )
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Feed file, "-" reads the standard input')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Feed format, guessed from the file extension by default')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of books inserted per transaction')
+        parser.add_argument('--rejects', help='File receiving the rejected rows as JSON lines, with the reason')
+
+    def handle(self, *args, **options):
+        path, self.batch_size = options['path'], options['batch_size']
+        feed_format = options['format'] or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+        self.load_lookups()
+        self.imported = self.rejected = 0
+        self.category_ids = set()
+        self.started = time.monotonic()
+        try:
+            feed = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if path == '-' else \
+                open(path, encoding='utf-8', newline='')
+        except OSError as error:
+            raise CommandError('Cannot read {}: {}'.format(path, error))
+        rejects = open(options['rejects'], 'w', encoding='utf-8') if options['rejects'] else None
+        try:
+            batch = []
+            for line_number, row in self.read_rows(feed, feed_format):
+                try:
+                    batch.append(self.parse_row(row))
+                except RowError as error:
+                    self.reject(rejects, line_number, row, error)
+                if len(batch) >= self.batch_size:
+                    self.import_batch(batch)
+                    batch = []
+            if batch:
+                self.import_batch(batch)
+        finally:
+            if path != '-':
+                feed.close()
+            if rejects:
+                rejects.close()
+        CategoryStats.objects.rebuild(self.category_ids)
+        self.stdout.write(self.style.SUCCESS('Done, {} books imported ({:.0f} rows/s), {} rows rejected'.format(
+            self.imported, self.rate(), self.rejected
+        )))
+
+    def load_lookups(self):
+        # a missing family name is None in the keys of the feed rows, whether it is stored as NULL or ''
+        self.authors = {(name, family_name or None): pk
+                        for pk, name, family_name in Author.objects.values_list('id', 'name', 'family_name')}
+        self.publishers = {name: pk for pk, name in Publisher.objects.values_list('id', 'name')}
+        self.categories = {name: pk for pk, name in Category.objects.values_list('id', 'name')}
+        self.discount_groups = {name: (pk, discount)
+                                for pk, name, discount in DiscountGroup.objects.values_list('id', 'name', 'discount')}
+
+    def read_rows(self, feed, feed_format):
+        if feed_format == 'csv':
+            reader = csv.DictReader(feed)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(feed, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = line.rstrip('\n')
+            yield line_number, row
+
+    def parse_row(self, row):
+        if not isinstance(row, dict):
+            raise RowError('Not a JSON object')
+        fields = {}
+        for name in BOOK_FIELDS:
+            field = Book._meta.get_field(name)
+            value = row.get(name)
+            if isinstance(value, str):
+                value = value.strip()
+            if value in (None, '') and field.null:
+                value = None
+            try:
+                fields[name] = field.clean(value, None)
+            except ValidationError as error:
+                raise RowError('{}: {}'.format(name, ' '.join(error.messages)))
+        author = (row.get('author_name') or '').strip(), (row.get('author_family_name') or '').strip() or None
+        if not author[0]:
+            raise RowError('author_name: This field cannot be blank.')
+        discount_group = (row.get('discount_group') or '').strip() or None
+        if discount_group is not None and discount_group not in self.discount_groups:
+            raise RowError('discount_group: Unknown discount group "{}".'.format(discount_group))
+        categories = row.get('categories') or []
+        if isinstance(categories, str):
+            categories = categories.split(CATEGORY_SEPARATOR)
+        categories = sorted({str(name).strip() for name in categories} - {''})
+        return fields, author, (row.get('publisher') or '').strip() or None, discount_group, categories
+
+    def import_batch(self, batch):
+        with transaction.atomic():
+            new_authors = self.create_missing(Author, self.authors, {author for _, author, _, _, _ in batch},
+                                              lambda key: Author(name=key[0], family_name=key[1]))
+            self.create_missing(Publisher, self.publishers, {publisher for _, _, publisher, _, _ in batch} - {None},
+                                lambda name: Publisher(name=name))
+            new_categories = self.create_missing(
+                Category, self.categories, {name for _, _, _, _, categories in batch for name in categories},
+                lambda name: Category(name=name)
+            )
+            # bulk_create skips the post_save handler creating the statistics row
+            CategoryStats.objects.bulk_create([CategoryStats(category=category) for category in new_categories])
+
+            books = []
+            for fields, author, publisher, discount_group, categories in batch:
+                group_id, group_discount = self.discount_groups[discount_group] if discount_group else (None, None)
+                book = Book(author_id=self.authors[author], publisher_id=self.publishers.get(publisher),
+                            discount_group_id=group_id, **fields)
+                book.discount_total = logic.discount_total(book.discount, group_discount)
+                book.price = logic.price(book.price_original, book.discount_total)
+                books.append(book)
+            self.bulk_create(Book, books)
+            BookStats.objects.bulk_create([BookStats(book_id=book.pk) for book in books])
+
+            memberships = [Book.categories.through(book_id=book.pk, category_id=self.categories[name])
+                           for book, (_, _, _, _, categories) in zip(books, batch) for name in categories]
+            Book.categories.through.objects.bulk_create(memberships)
+            self.category_ids.update(membership.category_id for membership in memberships)
+
+            book_ids = [book.pk for book in books]
+            get_search_backend().index_books(Book.objects.filter(id__gte=min(book_ids), id__lte=max(book_ids)))
+        # after the commit, the ids may have belonged to deleted books
+        books_bulk_changed.send(sender=Book, book_ids=book_ids)
+        if new_authors:
+            author_index.invalidate()
+        self.imported += len(books)
+        self.stdout.write('Imported {} books ({:.0f} rows/s), {} rows rejected'.format(
+            self.imported, self.rate(), self.rejected
+        ))
+
+    def create_missing(self, model, lookup, keys, build):
+        objs = [build(key) for key in sorted(keys - set(lookup), key=str)]
+        self.bulk_create(model, objs)
+        for obj in objs:
+            key = (obj.name, obj.family_name) if model is Author else obj.name
+            lookup[key] = obj.pk
+        return objs
+
+    def bulk_create(self, model, objs):
+        if not objs:
+            return
+        if not connection.features.can_return_ids_from_bulk_insert:
+            # the backend does not report the generated keys, which the relations of the batch need
+            for pk, obj in enumerate(objs, self.lock_last_id(model) + 1):
+                obj.pk = pk
+        # statements are sized by Django to the backend's query parameter limit
+        model.objects.bulk_create(objs)
+
+    def lock_last_id(self, model):
+        # the ids after the last one stay reserved for the batch until its transaction ends, a concurrent writer
+        # waits instead of taking them
+        if connection.vendor == 'sqlite':
+            # SQLite ignores FOR UPDATE, its single write lock is taken by any write statement
+            with connection.cursor() as cursor:
+                cursor.execute('UPDATE {0} SET id = id WHERE 0'.format(connection.ops.quote_name(model._meta.db_table)))
+        # locks the last row and the gap after it
+        return model.objects.select_for_update().order_by('-id').values_list('id', flat=True).first() or 0
+
+    def reject(self, rejects, line_number, row, error):
+        self.rejected += 1
+        if rejects:
+            rejects.write(json.dumps({'line': line_number, 'error': str(error), 'row': row}, ensure_ascii=False) +
+                          '\n')
+        if self.rejected <= 10:
+            self.stderr.write('Line {} rejected: {}'.format(line_number, error))
+
+    def rate(self):
+        return self.imported / max(time.monotonic() - self.started, 1e-6)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from catalog.models import BookStats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the per-book rating and engagement statistics from the user book relations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Number of books recomputed per query')
+
+    def handle(self, *args, **options):
+        rebuilt = BookStats.objects.rebuild(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt statistics for {} books'.format(rebuilt)))
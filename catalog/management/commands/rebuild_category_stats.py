@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from catalog.models import CategoryStats
+
+STATS_FIELDS = ('book_count', 'book_price_sum', 'book_priced_count')
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the materialized category statistics from scratch and verifies them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', dest='check_only',
+                            help='Only compare the stored statistics with freshly calculated ones')
+
+    def handle(self, *args, **options):
+        if not options['check_only']:
+            stats = CategoryStats.objects.rebuild()
+            self.stdout.write('Rebuilt statistics for {} categories'.format(len(stats)))
+        mismatches = self.find_mismatches()
+        for category_id, field, expected, actual in mismatches:
+            self.stdout.write('Category {}: {} is {}, expected {}'.format(category_id, field, actual, expected))
+        if mismatches:
+            raise CommandError('{} category statistics mismatches found'.format(len(mismatches)))
+        self.stdout.write(self.style.SUCCESS('Category statistics are consistent'))
+
+    def find_mismatches(self):
+        expected_stats = CategoryStats.objects.calculate()
+        stored_stats = CategoryStats.objects.in_bulk()
+        mismatches = []
+        for category_id, expected in expected_stats.items():
+            actual = stored_stats.get(category_id)
+            for field in STATS_FIELDS:
+                actual_value = getattr(actual, field) if actual else None
+                if actual_value != getattr(expected, field):
+                    mismatches.append((category_id, field, getattr(expected, field), actual_value))
+        return mismatches
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from catalog.models import LeaderboardEntry
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the top rated, most wishlisted and most bookmarked leaderboards (overall, per category and per '
+        'author) and reports what the run cost. Meant to be scheduled, the boards are stale in between.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', action='append', dest='periods', choices=sorted(LeaderboardEntry.PERIODS),
+                            help='Period to recompute, can be repeated, all periods by default')
+        parser.add_argument('--size', type=int, help='Books kept per leaderboard, CATALOG_LEADERBOARD_SIZE by default')
+
+    def handle(self, *args, **options):
+        report = LeaderboardEntry.objects.rebuild(options['periods'], options['size'])
+        for period, cost in sorted(report['periods'].items()):
+            self.stdout.write('{}: {} rows scanned, {} boards in {:.3f}s'.format(
+                period, cost['rows'], cost['boards'], cost['seconds']
+            ))
+        self.stdout.write(self.style.SUCCESS('Wrote {} entries in {:.3f}s, {:.3f}s in total'.format(
+            report['entries'], report['write_seconds'], report['seconds']
+        )))
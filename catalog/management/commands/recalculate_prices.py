@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models.aggregates import Max, Min
+from catalog.models import Book, CategoryStats
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the denormalized price and discount_total columns of books'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Number of book ids updated per query')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        bounds = Book.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            self.stdout.write('No books to recalculate')
+            return
+        updated = 0
+        for start in range(bounds['first'], bounds['last'] + 1, chunk_size):
+            updated += Book.objects.filter(id__gte=start, id__lt=start + chunk_size).recalculate_prices()
+            self.stdout.write('Recalculated {} books (up to id {})'.format(updated, start + chunk_size - 1))
+        CategoryStats.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS('Done, {} books recalculated'.format(updated)))
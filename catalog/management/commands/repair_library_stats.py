@@ -0,0 +1,48 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from catalog.models import UserLibraryStats
+
+STATS_FIELDS = ('bookmark_count', 'wishlist_count', 'rating_count')
+
+
+class Command(BaseCommand):
+    help = 'Compares the per-user library counters with the user book relations and rewrites the mismatching ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', dest='check_only',
+                            help='Only report the mismatching counters')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Number of users compared per query')
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.order_by('pk')
+        mismatches, last_id = 0, 0
+        while True:
+            chunk_ids = list(users.filter(pk__gt=last_id).values_list('pk', flat=True)[:options['chunk_size']])
+            if not chunk_ids:
+                break
+            stale = self.find_stale(UserLibraryStats.objects.calculate(chunk_ids))
+            mismatches += len(stale)
+            if stale and not options['check_only']:
+                with transaction.atomic():
+                    UserLibraryStats.objects.filter(user_id__in=[stats.user_id for stats in stale]).delete()
+                    UserLibraryStats.objects.bulk_create(stale)
+            last_id = chunk_ids[-1]
+        if mismatches and options['check_only']:
+            raise CommandError('{} users with stale library counters found'.format(mismatches))
+        self.stdout.write(self.style.SUCCESS('{} users with stale library counters repaired'.format(mismatches)))
+
+    def find_stale(self, expected_stats):
+        stored_stats = UserLibraryStats.objects.in_bulk(list(expected_stats))
+        stale = []
+        for user_id, expected in expected_stats.items():
+            actual = stored_stats.get(user_id)
+            values = [(getattr(expected, field), getattr(actual, field, None)) for field in STATS_FIELDS]
+            if any(expected_value != actual_value for expected_value, actual_value in values):
+                self.stdout.write('User {}: {}'.format(user_id, ', '.join(
+                    '{} is {}, expected {}'.format(field, actual_value, expected_value)
+                    for field, (expected_value, actual_value) in zip(STATS_FIELDS, values)
+                    if expected_value != actual_value
+                )))
+                stale.append(expected)
+        return stale
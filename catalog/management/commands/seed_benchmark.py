@@ -0,0 +1,230 @@
+import itertools
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models.aggregates import Max
+from django.utils import timezone
+from catalog import logic
+from catalog.autocomplete import author_index, book_index
+from catalog.models import Author, Book, BookStats, Category, CategoryStats, LeaderboardEntry, UserBookRelation, \
+    UserLibraryStats
+from catalog.search import get_search_backend
+
+WORDS = (
+    'shadow', 'river', 'garden', 'winter', 'silver', 'empire', 'letters', 'island', 'night', 'stone', 'harbor',
+    'storm', 'mirror', 'road', 'fire', 'glass', 'house', 'secret', 'summer', 'queen', 'wolf', 'orchard', 'station',
+    'lighthouse', 'forest', 'city', 'ghost', 'war', 'promise', 'journey', 'sea', 'memory', 'crown', 'map', 'bridge',
+    'clock', 'mountain', 'daughter', 'letter', 'song', 'machine', 'library', 'winterhall', 'desert', 'archive',
+)
+NAMES = ('Anna', 'Boris', 'Clara', 'Dmitry', 'Elena', 'Fyodor', 'Galina', 'Igor', 'Irina', 'Lev', 'Marina', 'Nikolai',
+         'Olga', 'Pavel', 'Sofia', 'Vera', 'Yuri', 'Zoya')
+FAMILY_NAMES = ('Ivanov', 'Petrova', 'Sidorov', 'Orlova', 'Volkov', 'Lebedeva', 'Sokolov', 'Kuznetsova', 'Popov',
+                'Morozova', 'Novikov', 'Fedorova', 'Pavlov', 'Egorova')
+# relative frequencies of the ratings 1 to 5, readers mostly rate what they liked
+RATING_WEIGHTS = (4, 7, 18, 36, 35)
+
+
+def zipf_cum_weights(size, exponent):
+    # cumulative weights of ranks 1..size, rank r being drawn in proportion to 1 / r ** exponent
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates a reproducible benchmark dataset with bulk inserts: authors, categories, books, users and their '
+        'book relations. Book popularity, author output and category size follow Zipf distributions and reading '
+        'activity a lognormal one, so a few books and readers carry most of the relations. The derived tables '
+        '(statistics, search index, leaderboards) are rebuilt at the end.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--relations', type=int, default=100000,
+                            help='Number of user book relations, at most books per user')
+        parser.add_argument('--authors', type=int, help='Number of authors, a tenth of the books by default')
+        parser.add_argument('--categories', type=int, default=50)
+        parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the popularity distributions')
+        parser.add_argument('--seed', type=int, default=1, help='Seed of the random generator')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Number of rows inserted per transaction')
+
+    def handle(self, *args, **options):
+        if min(options['books'], options['users'], options['categories']) < 1:
+            raise CommandError('At least one book, one user and one category are required')
+        self.rng = random.Random(options['seed'])
+        self.skew, self.batch_size = options['skew'], options['batch_size']
+        self.started = time.monotonic()
+        author_ids = self.create_authors(options['authors'] or max(options['books'] // 10, 1))
+        category_ids = self.create_categories(options['categories'])
+        book_ids = self.create_books(options['books'], author_ids, category_ids)
+        user_ids = self.create_users(options['users'])
+        self.create_relations(options['relations'], user_ids, book_ids)
+        self.reset_sequences(Author, Category, Book, get_user_model())
+        self.rebuild_derived(book_ids[0])
+        self.stdout.write(self.style.SUCCESS('Benchmark dataset seeded in {:.1f}s'.format(self.elapsed())))
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def next_ids(self, model, count):
+        # ids are assigned up front, the relations of later tables need them on every backend
+        first = (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        return range(first, first + count)
+
+    def insert(self, name, rows, total, write):
+        inserted, batch = 0, []
+        for row in itertools.chain(rows, [None]):
+            if row is not None:
+                batch.append(row)
+            if batch and (row is None or len(batch) >= self.batch_size):
+                with transaction.atomic():
+                    write(batch)
+                inserted += len(batch)
+                batch = []
+                self.stdout.write('{}: {}/{} ({:.1f}s)'.format(name, inserted, total, self.elapsed()))
+        return inserted
+
+    @staticmethod
+    def values_writer(model, field_names):
+        # executemany of database ready tuples, bulk_create spends most of its time preparing values and SQL
+        qn = connection.ops.quote_name
+        columns = [model._meta.get_field(name).column for name in field_names]
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            qn(model._meta.db_table), ', '.join(qn(column) for column in columns), ', '.join(['%s'] * len(columns))
+        )
+
+        def write(rows):
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, rows)
+        return write
+
+    @staticmethod
+    def reset_sequences(*models):
+        # the ids were given explicitly, sequence based backends have to be told about them
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+    def title(self):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(self.rng.randint(1, 4))).capitalize()
+
+    def create_authors(self, count):
+        ids = self.next_ids(Author, count)
+        self.insert('authors', (Author(pk=pk, name=self.rng.choice(NAMES), family_name=self.rng.choice(FAMILY_NAMES),
+                                       about=self.title()) for pk in ids), count, Author.objects.bulk_create)
+        return list(ids)
+
+    def create_categories(self, count):
+        ids = self.next_ids(Category, count)
+        self.insert('categories', (Category(pk=pk, name='{} {}'.format(self.title(), pk)) for pk in ids), count,
+                    Category.objects.bulk_create)
+        return list(ids)
+
+    def create_books(self, count, author_ids, category_ids):
+        ids = self.next_ids(Book, count)
+        # prolific authors and crowded categories, in a random order of ids
+        author_ids, category_ids = author_ids[:], category_ids[:]
+        self.rng.shuffle(author_ids)
+        self.rng.shuffle(category_ids)
+        author_weights = zipf_cum_weights(len(author_ids), self.skew)
+        category_weights = zipf_cum_weights(len(category_ids), self.skew)
+        memberships = []
+        updated_at = connection.ops.adapt_datetimefield_value(timezone.now())
+
+        def books():
+            for pk in ids:
+                price_original = Decimal(self.rng.randint(100, 99900)) / 100 if self.rng.random() < 0.95 else None
+                discount = Decimal(self.rng.choice((0, 0, 0, 5, 10, 15, 25)))
+                discount_total = logic.discount_total(discount, None)
+                categories = self.rng.choices(category_ids, cum_weights=category_weights, k=self.rng.randint(1, 3))
+                memberships.extend((pk, category_id) for category_id in sorted(set(categories)))
+                yield (
+                    pk, self.title(), self.title(), self.title(),
+                    self.rng.choices(author_ids, cum_weights=author_weights)[0],
+                    self.rng.randint(1850, 2020) if self.rng.random() < 0.9 else None,
+                    '978-{:010d}'.format(pk) if self.rng.random() < 0.8 else None,
+                    self.rng.choice(Book.COVER_TYPE_CHOICES)[0], price_original, discount,
+                    discount_total, logic.price(price_original, discount_total), updated_at
+                )
+
+        write_books = self.values_writer(Book, (
+            'id', 'title', 'title_original', 'description', 'author', 'year_published', 'isbn', 'cover_type',
+            'price_original', 'discount', 'discount_total', 'price', 'updated_at'
+        ))
+        write_memberships = self.values_writer(Book.categories.through, ('book', 'category'))
+
+        def write(batch):
+            write_books(batch)
+            write_memberships(memberships)
+            del memberships[:]
+
+        self.insert('books', books(), count, write)
+        return list(ids)
+
+    def create_users(self, count):
+        ids = self.next_ids(get_user_model(), count)
+        user_model = get_user_model()
+        # unusable passwords, benchmark requests authenticate without them
+        self.insert('users', (user_model(pk=pk, username='bench{}'.format(pk), password='!') for pk in ids), count,
+                    user_model.objects.bulk_create)
+        return list(ids)
+
+    def user_relation_counts(self, count, user_count, max_per_user):
+        # lognormal reading activity: most users have a handful of books, a few have thousands
+        weights = [self.rng.lognormvariate(0, 1.5) for _ in range(user_count)]
+        total_weight, counts, assigned, cum_weight = sum(weights), [], 0, 0
+        for weight in weights:
+            cum_weight += weight
+            counts.append(min(round(count * cum_weight / total_weight) - assigned, max_per_user))
+            assigned += counts[-1]
+        return counts
+
+    def create_relations(self, count, user_ids, book_ids):
+        # popular books are spread over the id range rather than being the first ones
+        books_by_rank = book_ids[:]
+        self.rng.shuffle(books_by_rank)
+        cum_weights = zipf_cum_weights(len(books_by_rank), self.skew)
+        counts = self.user_relation_counts(count, len(user_ids), len(book_ids))
+        # changes spread over the last year, for the weekly leaderboards to differ from the overall ones
+        now = timezone.now()
+        dates = [connection.ops.adapt_datetimefield_value(now - timedelta(days=days)) for days in range(365)]
+
+        def relations():
+            for user_id, user_count in zip(user_ids, counts):
+                books = set()
+                for _ in range(10):
+                    if len(books) >= user_count:
+                        break
+                    books.update(self.rng.choices(books_by_rank, cum_weights=cum_weights, k=user_count - len(books)))
+                else:
+                    # readers of most of the catalog get the unpopular books the skewed draws hardly ever reach
+                    rest = [book_id for book_id in books_by_rank if book_id not in books]
+                    books.update(self.rng.sample(rest, user_count - len(books)))
+                for book_id in sorted(books):
+                    rated = self.rng.random() < 0.6
+                    yield (user_id, book_id, self.rng.random() < 0.3, not rated and self.rng.random() < 0.4,
+                           self.rng.choices(logic.RATINGS, RATING_WEIGHTS)[0] if rated else None,
+                           self.rng.choice(dates))
+
+        self.insert('relations', relations(), sum(counts), self.values_writer(
+            UserBookRelation, ('user', 'book', 'in_bookmarks', 'in_wishlist', 'rating', 'updated_at')
+        ))
+
+    def rebuild_derived(self, first_book_id):
+        # bulk inserts bypass the signal handlers maintaining these tables
+        BookStats.objects.rebuild()
+        UserLibraryStats.objects.rebuild()
+        CategoryStats.objects.rebuild()
+        self.stdout.write('Statistics rebuilt ({:.1f}s)'.format(self.elapsed()))
+        get_search_backend().index_books(Book.objects.filter(id__gte=first_book_id))
+        self.stdout.write('Search index updated ({:.1f}s)'.format(self.elapsed()))
+        LeaderboardEntry.objects.rebuild()
+        self.stdout.write('Leaderboards rebuilt ({:.1f}s)'.format(self.elapsed()))
+        author_index.invalidate()
+        book_index.invalidate()
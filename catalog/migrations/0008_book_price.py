@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 20:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models.expressions import F, Func, Value
+from django.db.models.functions import Coalesce
+
+
+def price_expressions(group_discount):
+    def discount_total():
+        return Coalesce('discount', Value(0)) + Value(group_discount)
+
+    return {
+        'discount_total': discount_total(),
+        'price': Func(
+            F('price_original') - (F('price_original') * discount_total() / Value(100)), Value(2),
+            function='ROUND', output_field=models.DecimalField(max_digits=6, decimal_places=2)
+        )
+    }
+
+
+def calculate_prices(apps, schema_editor):
+    Book = apps.get_model('catalog', 'Book')
+    DiscountGroup = apps.get_model('catalog', 'DiscountGroup')
+    Book.objects.filter(discount_group__isnull=True).update(**price_expressions(0))
+    for discount_group_id, group_discount in DiscountGroup.objects.values_list('id', 'discount'):
+        Book.objects.filter(discount_group_id=discount_group_id).update(**price_expressions(group_discount))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0007_remove_book_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='discount_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=6, verbose_name='Итоговая скидка в процентах'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='price',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, editable=False, max_digits=6, null=True, verbose_name='Цена'),
+        ),
+        migrations.RunPython(calculate_prices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 20:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.aggregates import Count, Sum
+
+
+def calculate_category_stats(apps, schema_editor):
+    Book = apps.get_model('catalog', 'Book')
+    Category = apps.get_model('catalog', 'Category')
+    CategoryStats = apps.get_model('catalog', 'CategoryStats')
+    stats = {category_id: CategoryStats(category_id=category_id)
+             for category_id in Category.objects.values_list('id', flat=True)}
+    for row in Book.categories.through.objects.order_by().values('category_id').annotate(
+        book_count=Count('book_id'), book_price_sum=Sum('book__price'), book_priced_count=Count('book__price')
+    ):
+        stats[row['category_id']].book_count = row['book_count']
+        stats[row['category_id']].book_price_sum = row['book_price_sum'] or 0
+        stats[row['category_id']].book_priced_count = row['book_priced_count']
+    CategoryStats.objects.bulk_create(stats.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0008_book_price'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryStats',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='catalog.Category', verbose_name='Категория')),
+                ('book_count', models.PositiveIntegerField(default=0, verbose_name='Количество книг')),
+                ('book_price_sum', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Сумма цен книг')),
+                ('book_priced_count', models.PositiveIntegerField(default=0, verbose_name='Количество книг с ценой')),
+            ],
+            options={
+                'verbose_name': 'статистика категории',
+                'verbose_name_plural': 'статистика категорий',
+            },
+        ),
+        migrations.RunPython(calculate_category_stats, migrations.RunPython.noop),
+    ]
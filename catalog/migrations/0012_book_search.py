@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE catalog_book_search USING fts5("
+        "title, title_original, isbn, author, publisher, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    schema_editor.execute(
+        "INSERT INTO catalog_book_search (rowid, title, title_original, isbn, author, publisher) "
+        "SELECT b.id, b.title, b.title_original, COALESCE(b.isbn, ''), "
+        "a.name || ' ' || COALESCE(a.family_name, ''), COALESCE(p.name, '') "
+        "FROM catalog_book b INNER JOIN catalog_author a ON a.id = b.author_id "
+        "LEFT OUTER JOIN catalog_publisher p ON p.id = b.publisher_id"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS catalog_book_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0011_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
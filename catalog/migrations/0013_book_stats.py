@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 20:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def calculate_book_stats(apps, schema_editor):
+    Book = apps.get_model('catalog', 'Book')
+    BookStats = apps.get_model('catalog', 'BookStats')
+    UserBookRelation = apps.get_model('catalog', 'UserBookRelation')
+    stats = {book_id: BookStats(book_id=book_id) for book_id in Book.objects.values_list('id', flat=True)}
+    for book_id, rating, in_bookmarks, in_wishlist in UserBookRelation.objects.values_list(
+        'book_id', 'rating', 'in_bookmarks', 'in_wishlist'
+    ).iterator():
+        book_stats = stats[book_id]
+        if rating is not None:
+            book_stats.rating_count += 1
+            book_stats.rating_sum += rating
+            setattr(book_stats, 'rating_{}_count'.format(rating),
+                    getattr(book_stats, 'rating_{}_count'.format(rating)) + 1)
+        book_stats.bookmark_count += bool(in_bookmarks)
+        book_stats.wishlist_count += bool(in_wishlist)
+    for book_stats in stats.values():
+        if book_stats.rating_count:
+            book_stats.rating_avg = book_stats.rating_sum / book_stats.rating_count
+    BookStats.objects.bulk_create(stats.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0012_book_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookStats',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='catalog.Book', verbose_name='Книга')),
+                ('rating_count', models.PositiveIntegerField(default=0, verbose_name='Количество оценок')),
+                ('rating_sum', models.PositiveIntegerField(default=0, verbose_name='Сумма оценок')),
+                ('rating_avg', models.FloatField(blank=True, null=True, verbose_name='Средняя оценка')),
+                ('rating_1_count', models.PositiveIntegerField(default=0, verbose_name='Оценок «ужасно»')),
+                ('rating_2_count', models.PositiveIntegerField(default=0, verbose_name='Оценок «плохо»')),
+                ('rating_3_count', models.PositiveIntegerField(default=0, verbose_name='Оценок «так себе»')),
+                ('rating_4_count', models.PositiveIntegerField(default=0, verbose_name='Оценок «хорошо»')),
+                ('rating_5_count', models.PositiveIntegerField(default=0, verbose_name='Оценок «отлично»')),
+                ('bookmark_count', models.PositiveIntegerField(default=0, verbose_name='В закладках')),
+                ('wishlist_count', models.PositiveIntegerField(default=0, verbose_name='В списках желаний')),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True, verbose_name='Дата изменения')),
+            ],
+            options={
+                'verbose_name': 'статистика книги',
+                'verbose_name_plural': 'статистика книг',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='bookstats',
+            index=models.Index(fields=['rating_avg', 'book'], name='catalog_boo_rating__a4ddd9_idx'),
+        ),
+        migrations.RunPython(calculate_book_stats, migrations.RunPython.noop),
+    ]
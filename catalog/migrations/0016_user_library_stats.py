@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 20:44
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def calculate_library_stats(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    UserBookRelation = apps.get_model('catalog', 'UserBookRelation')
+    UserLibraryStats = apps.get_model('catalog', 'UserLibraryStats')
+    stats = {user_id: UserLibraryStats(user_id=user_id) for user_id in User.objects.values_list('pk', flat=True)}
+    for user_id, rating, in_bookmarks, in_wishlist in UserBookRelation.objects.values_list(
+        'user_id', 'rating', 'in_bookmarks', 'in_wishlist'
+    ).iterator():
+        user_stats = stats[user_id]
+        user_stats.bookmark_count += bool(in_bookmarks)
+        user_stats.wishlist_count += bool(in_wishlist)
+        user_stats.rating_count += rating is not None
+    UserLibraryStats.objects.bulk_create(stats.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalog', '0015_similar_books'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserLibraryStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='library_stats', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('bookmark_count', models.PositiveIntegerField(default=0, verbose_name='В закладках')),
+                ('wishlist_count', models.PositiveIntegerField(default=0, verbose_name='В списке желаний')),
+                ('rating_count', models.PositiveIntegerField(default=0, verbose_name='Оценено')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата изменения')),
+            ],
+            options={
+                'verbose_name': 'статистика библиотеки пользователя',
+                'verbose_name_plural': 'статистика библиотек пользователей',
+            },
+        ),
+        migrations.RunPython(calculate_library_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 20:48
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0016_user_library_stats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userbookrelation',
+            name='book',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='userbookrelations', to='catalog.Book', verbose_name='Книга'),
+        ),
+        migrations.AlterField(
+            model_name='userbookrelation',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='userbookrelations', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(fields=['user', 'in_bookmarks', 'book'], name='catalog_use_user_id_c47539_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(fields=['user', 'in_wishlist', 'book'], name='catalog_use_user_id_21c7dc_idx'),
+        ),
+        # isbn lookups, most books have none; the partial index is used for any comparison on the column
+        migrations.RunSQL(
+            'CREATE INDEX catalog_book_isbn_partial ON catalog_book (isbn) WHERE isbn IS NOT NULL',
+            'DROP INDEX catalog_book_isbn_partial',
+        ),
+        # books of a category, the unique (book_id, category_id) index only serves the book side
+        migrations.RunSQL(
+            'CREATE INDEX catalog_book_categories_category_book ON catalog_book_categories (category_id, book_id)',
+            'DROP INDEX catalog_book_categories_category_book',
+        ),
+    ]
@@ -1,9 +1,18 @@
-from django.db import models
+import heapq
+import time
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, connections, models, transaction
 from django.contrib.auth import get_user_model
+from django.dispatch import Signal
 from django.forms import ValidationError
-from django.db.models.aggregates import Avg, Count, Sum
-from django.db.models.expressions import F, Value
+from django.db.models.aggregates import Count, Sum
+from django.db.models import Q
+from django.db.models.expressions import Case, F, Func, Value, When
 from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
+from . import logic
 
 UserModel = get_user_model()
 
@@ -12,6 +21,7 @@ class Author(models.Model):
     name = models.CharField(max_length=255, verbose_name='Имя')
     family_name = models.CharField(max_length=255, blank=True, null=True, verbose_name='Фамилия')
     about = models.TextField(blank=True, null=True, verbose_name='Об авторе')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Дата изменения')
 
     class Meta:
         verbose_name = 'автор'
@@ -37,27 +47,10 @@ class Publisher(models.Model):
         return self.name
 
 
-class CategoryManager(models.Manager):
-    def get_queryset(self):
-        return super().get_queryset().annotate(
-            book_average_price=Avg(
-                Cast(
-                    F('books__price_original') - (F('books__price_original') * (
-                        Coalesce('books__discount', Value(0)) +
-                        Coalesce('books__discount_group__discount', Value(0))
-                    ) / Value(100)),
-                    models.DecimalField(max_digits=6, decimal_places=2)
-                )
-            ),
-            book_count=Count('books')
-        )
-
-
 class Category(models.Model):
     name = models.CharField(max_length=255, verbose_name='Название')
     description = models.TextField(blank=True, null=True, verbose_name='Описание')
-
-    objects = CategoryManager()
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Дата изменения')
 
     class Meta:
         verbose_name = 'категория'
@@ -67,6 +60,65 @@ class Category(models.Model):
         return self.name
 
 
+class CategoryStatsQuerySet(models.QuerySet):
+    def apply_delta(self, book_count=0, book_price_sum=0, book_priced_count=0):
+        return self.update(
+            book_count=F('book_count') + book_count,
+            book_price_sum=F('book_price_sum') + book_price_sum,
+            book_priced_count=F('book_priced_count') + book_priced_count,
+            updated_at=timezone.now()
+        )
+
+
+class CategoryStatsManager(models.Manager.from_queryset(CategoryStatsQuerySet)):
+    def calculate(self, category_ids=None):
+        categories = Category.objects.all()
+        memberships = Book.categories.through.objects.all()
+        if category_ids is not None:
+            categories = categories.filter(id__in=category_ids)
+            memberships = memberships.filter(category_id__in=category_ids)
+        stats = {category_id: CategoryStats(category_id=category_id)
+                 for category_id in categories.values_list('id', flat=True)}
+        for row in memberships.order_by().values('category_id').annotate(
+            book_count=Count('book_id'), book_price_sum=Sum('book__price'), book_priced_count=Count('book__price')
+        ):
+            if row['category_id'] in stats:
+                stats[row['category_id']].book_count = row['book_count']
+                stats[row['category_id']].book_price_sum = row['book_price_sum'] or 0
+                stats[row['category_id']].book_priced_count = row['book_priced_count']
+        return stats
+
+    def rebuild(self, category_ids=None, batch_size=1000):
+        stats = self.calculate(category_ids)
+        with transaction.atomic():
+            stale = self.all() if category_ids is None else self.filter(category_id__in=category_ids)
+            stale.delete()
+            self.bulk_create(stats.values(), batch_size=batch_size)
+        return stats
+
+
+class CategoryStats(models.Model):
+    category = models.OneToOneField(Category, on_delete=models.CASCADE, primary_key=True, related_name='stats',
+                                    verbose_name='Категория')
+    book_count = models.PositiveIntegerField(default=0, verbose_name='Количество книг')
+    book_price_sum = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='Сумма цен книг')
+    book_priced_count = models.PositiveIntegerField(default=0, verbose_name='Количество книг с ценой')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Дата изменения')
+
+    objects = CategoryStatsManager()
+
+    class Meta:
+        verbose_name = 'статистика категории'
+        verbose_name_plural = 'статистика категорий'
+
+    def __str__(self):
+        return str(self.category_id)
+
+    @property
+    def book_average_price(self):
+        return logic.average_price(self.book_price_sum, self.book_priced_count)
+
+
 class DiscountGroup(models.Model):
     name = models.CharField(max_length=255, verbose_name='Наименование')
     discount = models.DecimalField(max_digits=5, decimal_places=2, verbose_name='Скидка в процентах')
@@ -79,16 +131,50 @@ class DiscountGroup(models.Model):
     def __str__(self):
         return self.name
 
-
-class BookManager(models.Manager):
-    def get_queryset(self):
-        return super().get_queryset().annotate(
-            discount_total=Coalesce('discount', Value(0)) + Coalesce('discount_group__discount', Value(0)),
-            price=Cast(
-                F('price_original') - (F('price_original') * F('discount_total') / Value(100)),
-                models.DecimalField(max_digits=6, decimal_places=2)
+    def save(self, *args, **kwargs):
+        discount_changed = self.pk is not None and DiscountGroup.objects.filter(pk=self.pk).exclude(
+            discount=self.discount
+        ).exists()
+        super().save(*args, **kwargs)
+        if discount_changed:
+            self.books.all().recalculate_prices()
+            self.books.all().refresh_category_stats()
+
+
+# sent after writes to books bypassing post_save, BookQuerySet.recalculate_prices() updates and the bulk_create()
+# of the import_books command
+books_bulk_changed = Signal(providing_args=['book_ids'])
+
+
+class BookQuerySet(models.QuerySet):
+    @staticmethod
+    def price_expressions(group_discount):
+        def discount_total():
+            return Coalesce('discount', Value(0)) + Value(group_discount)
+
+        return {
+            'updated_at': timezone.now(),
+            'discount_total': discount_total(),
+            'price': Func(
+                F('price_original') - (F('price_original') * discount_total() / Value(100)), Value(2),
+                function='ROUND', output_field=models.DecimalField(max_digits=6, decimal_places=2)
             )
-        )
+        }
+
+    def recalculate_prices(self):
+        book_ids = list(self.values_list('id', flat=True))
+        updated = self.filter(discount_group__isnull=True).update(**self.price_expressions(0))
+        discount_groups = DiscountGroup.objects.filter(id__in=self.values('discount_group_id'))
+        for discount_group_id, group_discount in discount_groups.values_list('id', 'discount'):
+            updated += self.filter(discount_group_id=discount_group_id).update(
+                **self.price_expressions(group_discount)
+            )
+        books_bulk_changed.send(sender=self.model, book_ids=book_ids)
+        return updated
+
+    def refresh_category_stats(self):
+        category_ids = Book.categories.through.objects.filter(book__in=self).values_list('category_id', flat=True)
+        return CategoryStats.objects.rebuild(set(category_ids))
 
 
 class Book(models.Model):
@@ -110,6 +196,10 @@ class Book(models.Model):
                                          verbose_name='Цена без учета скидки')
     discount = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True,
                                    verbose_name='Скидка в процентах')
+    discount_total = models.DecimalField(max_digits=6, decimal_places=2, default=0, editable=False,
+                                         verbose_name='Итоговая скидка в процентах')
+    price = models.DecimalField(max_digits=6, decimal_places=2, blank=True, null=True, editable=False,
+                                db_index=True, verbose_name='Цена')
 
     author = models.ForeignKey(Author, on_delete=models.CASCADE, related_name='books', verbose_name='Автор')
     publisher = models.ForeignKey(Publisher, on_delete=models.SET_NULL, related_name='books', blank=True, null=True,
@@ -117,16 +207,100 @@ class Book(models.Model):
     categories = models.ManyToManyField(Category, blank=True, related_name='books', verbose_name='Категории')
     discount_group = models.ForeignKey(DiscountGroup, on_delete=models.SET_NULL, related_name='books', blank=True,
                                        null=True, verbose_name='Группа скидок')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Дата изменения')
 
-    objects = BookManager()
+    objects = BookQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'книга'
         verbose_name_plural = 'книги'
+        indexes = [
+            models.Index(fields=['title', 'id']),
+            models.Index(fields=['year_published', 'id']),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        self.recalculate_price()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'discount_total', 'price'}
+        super().save(*args, **kwargs)
+
+    def recalculate_price(self):
+        group_discount = self.discount_group.discount if self.discount_group_id else None
+        self.discount_total = logic.discount_total(self.discount, group_discount)
+        self.price = logic.price(self.price_original, self.discount_total)
+
+
+# sent inside the transaction of UserBookRelation.objects.bulk_upsert(), which bypasses post_save;
+# updated holds (relation, {field: previous value}) pairs for the changed fields only
+user_book_relations_bulk_changed = Signal(providing_args=['user', 'created', 'updated'])
+
+
+class UserBookRelationQuerySet(models.QuerySet):
+    def bulk_update(self, objs, fields, batch_size=None):
+        # one UPDATE ... SET field = CASE WHEN id = ... per batch, sized to the backend's query parameter limit
+        fields = [self.model._meta.get_field(name) for name in fields]
+        if batch_size is None:
+            # every row takes its pk in the IN list plus a pk and a value in each CASE
+            batch_size = max(connections[self.db].ops.bulk_batch_size(['pk'] + fields * 2, objs), 1)
+        updated = 0
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            updated += self.filter(pk__in=[obj.pk for obj in batch]).update(**{
+                field.attname: Case(*[
+                    When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch
+                ], output_field=field)
+                for field in fields
+            })
+        return updated
+
+    def bulk_upsert(self, user, values):
+        """
+        Creates or updates the relations of the user to the books in values ({book_id: {field: value}}) with one
+        lookup query and batched writes. Returns {book_id: 'created' | 'updated' | 'unchanged' | 'missing'}.
+        """
+        try:
+            return self.upsert(user, values)
+        except IntegrityError:
+            # a concurrent request created some of the relations after the lookup, which finds them the second time
+            return self.upsert(user, values)
+
+    def upsert(self, user, values):
+        results, created, updated, updated_fields = {}, [], [], set()
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            existing = {relation.book_id: relation
+                        for relation in self.select_for_update().filter(user=user, book_id__in=list(values))}
+            missing_ids = set(values) - set(existing)
+            book_ids = set()
+            if missing_ids:
+                book_ids = set(Book.objects.filter(id__in=missing_ids).values_list('id', flat=True))
+            for book_id, fields in values.items():
+                relation = existing.get(book_id)
+                if relation is None:
+                    if book_id in book_ids:
+                        created.append(self.model(user=user, book_id=book_id, **fields))
+                    results[book_id] = 'created' if book_id in book_ids else 'missing'
+                    continue
+                previous = {field: getattr(relation, field) for field, value in fields.items()
+                            if getattr(relation, field) != value}
+                if previous:
+                    for field in previous:
+                        setattr(relation, field, fields[field])
+                    relation.updated_at = now
+                    updated.append((relation, previous))
+                    updated_fields.update(previous)
+                results[book_id] = 'updated' if previous else 'unchanged'
+            self.bulk_create(created)
+            if updated:
+                self.bulk_update([relation for relation, previous in updated], sorted(updated_fields | {'updated_at'}))
+            if created or updated:
+                user_book_relations_bulk_changed.send(sender=self.model, user=user, created=created, updated=updated)
+        return results
+
 
 class UserBookRelation(models.Model):
     RATING_VERY_BAD = 1
@@ -143,15 +317,336 @@ class UserBookRelation(models.Model):
         (RATING_VERY_GOOD, 'Отлично'),
     )
 
-    user = models.ForeignKey(UserModel, on_delete=models.CASCADE, related_name='%(class)ss',
+    # both foreign keys are leading columns of the composite indexes below
+    user = models.ForeignKey(UserModel, on_delete=models.CASCADE, related_name='%(class)ss', db_index=False,
                              verbose_name='Пользователь')
-    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='%(class)ss', verbose_name='Книга')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='%(class)ss', db_index=False,
+                             verbose_name='Книга')
     in_bookmarks = models.BooleanField(default=False, verbose_name='В закладках')
     in_wishlist = models.BooleanField(default=False, verbose_name='В списке желаний')
     rating = models.PositiveSmallIntegerField(blank=True, null=True, choices=RATING_CHOICES, verbose_name='Рейтинг')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
+
+    objects = UserBookRelationQuerySet.as_manager()
 
     class Meta:
         unique_together = ('book', 'user')
+        indexes = [
+            models.Index(fields=['user', 'updated_at']),
+            # a user's bookmarks or wishlist; partial indexes would be smaller but SQLite ignores them for the
+            # bound boolean parameters of ORM queries
+            models.Index(fields=['user', 'in_bookmarks', 'book']),
+            models.Index(fields=['user', 'in_wishlist', 'book']),
+        ]
 
     def __str__(self):
         return str(self.book)
+
+
+def count_if(**condition):
+    return Sum(Case(When(then=Value(1), **condition), default=Value(0), output_field=models.IntegerField()))
+
+
+class BookStatsQuerySet(models.QuerySet):
+    def apply_delta(self, **deltas):
+        updates = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if not updates:
+            return 0
+        if 'rating_count' in updates or 'rating_sum' in updates:
+            # the right hand side of an UPDATE reads the old column values
+            updates['rating_avg'] = Cast(updates.get('rating_sum', F('rating_sum')), models.FloatField()) / Func(
+                updates.get('rating_count', F('rating_count')), Value(0), function='NULLIF'
+            )
+        return self.update(updated_at=timezone.now(), **updates)
+
+    def apply_deltas(self, deltas):
+        # deltas is {book_id: {field: delta}}, books whose counters move by the same amounts share one UPDATE
+        book_ids = defaultdict(list)
+        for book_id, delta in deltas.items():
+            delta = tuple(sorted((field, value) for field, value in delta.items() if value))
+            if delta:
+                book_ids[delta].append(book_id)
+        updated = 0
+        for delta, ids in book_ids.items():
+            # leaves room in the query parameter limit for the SET clause
+            batch_size = max(connections[self.db].ops.bulk_batch_size(['pk'], ids) - 3 * len(delta), 1)
+            for start in range(0, len(ids), batch_size):
+                updated += self.filter(book_id__in=ids[start:start + batch_size]).apply_delta(**dict(delta))
+        return updated
+
+
+class BookStatsManager(models.Manager.from_queryset(BookStatsQuerySet)):
+    @staticmethod
+    def relation_totals(relations):
+        # the statistics fields of the given relations, summed per book
+        counters = {'rating_{}_count'.format(value): count_if(rating=value) for value in logic.RATINGS}
+        return relations.order_by().values('book_id').annotate(
+            rating_count=Count('rating'), rating_sum=Sum('rating'), bookmark_count=count_if(in_bookmarks=True),
+            wishlist_count=count_if(in_wishlist=True), **counters
+        )
+
+    def calculate(self, book_ids):
+        rows = self.relation_totals(UserBookRelation.objects.filter(book_id__in=book_ids))
+        stats = {book_id: self.model(book_id=book_id) for book_id in book_ids}
+        for row in rows:
+            book_stats = stats[row.pop('book_id')]
+            for field, value in row.items():
+                setattr(book_stats, field, value or 0)
+            if book_stats.rating_count:
+                book_stats.rating_avg = book_stats.rating_sum / book_stats.rating_count
+        return stats
+
+    def rebuild(self, book_ids=None, chunk_size=10000):
+        # one aggregated pass over the relations, chunked by book id ranges to keep memory bounded
+        books = Book.objects.order_by('id')
+        if book_ids is not None:
+            books = books.filter(id__in=book_ids)
+        rebuilt, last_id = 0, 0
+        while True:
+            chunk_ids = list(books.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+            if not chunk_ids:
+                return rebuilt
+            stats = self.calculate(chunk_ids)
+            with transaction.atomic():
+                self.filter(book_id__in=chunk_ids).delete()
+                self.bulk_create(stats.values())
+            rebuilt, last_id = rebuilt + len(chunk_ids), chunk_ids[-1]
+
+
+class BookStats(models.Model):
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='stats',
+                                verbose_name='Книга')
+    rating_count = models.PositiveIntegerField(default=0, verbose_name='Количество оценок')
+    rating_sum = models.PositiveIntegerField(default=0, verbose_name='Сумма оценок')
+    rating_avg = models.FloatField(blank=True, null=True, verbose_name='Средняя оценка')
+    rating_1_count = models.PositiveIntegerField(default=0, verbose_name='Оценок «ужасно»')
+    rating_2_count = models.PositiveIntegerField(default=0, verbose_name='Оценок «плохо»')
+    rating_3_count = models.PositiveIntegerField(default=0, verbose_name='Оценок «так себе»')
+    rating_4_count = models.PositiveIntegerField(default=0, verbose_name='Оценок «хорошо»')
+    rating_5_count = models.PositiveIntegerField(default=0, verbose_name='Оценок «отлично»')
+    bookmark_count = models.PositiveIntegerField(default=0, verbose_name='В закладках')
+    wishlist_count = models.PositiveIntegerField(default=0, verbose_name='В списках желаний')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Дата изменения')
+
+    objects = BookStatsManager()
+
+    class Meta:
+        verbose_name = 'статистика книги'
+        verbose_name_plural = 'статистика книг'
+        indexes = [
+            models.Index(fields=['rating_avg', 'book']),
+        ]
+
+    def __str__(self):
+        return str(self.book_id)
+
+    @property
+    def rating_histogram(self):
+        return {value: getattr(self, 'rating_{}_count'.format(value)) for value in logic.RATINGS}
+
+
+class UserLibraryStatsQuerySet(models.QuerySet):
+    def apply_delta(self, bookmark_count=0, wishlist_count=0, rating_count=0):
+        return self.update(
+            bookmark_count=F('bookmark_count') + bookmark_count,
+            wishlist_count=F('wishlist_count') + wishlist_count,
+            rating_count=F('rating_count') + rating_count,
+            updated_at=timezone.now()
+        )
+
+
+class UserLibraryStatsManager(models.Manager.from_queryset(UserLibraryStatsQuerySet)):
+    def calculate(self, user_ids):
+        stats = {user_id: self.model(user_id=user_id) for user_id in user_ids}
+        rows = UserBookRelation.objects.filter(user_id__in=user_ids).order_by().values('user_id').annotate(
+            bookmark_count=count_if(in_bookmarks=True), wishlist_count=count_if(in_wishlist=True),
+            rating_count=Count('rating')
+        )
+        for row in rows:
+            user_stats = stats[row.pop('user_id')]
+            for field, value in row.items():
+                setattr(user_stats, field, value or 0)
+        return stats
+
+    def rebuild(self, user_ids=None, chunk_size=10000):
+        # one aggregated pass over the relations, chunked by user id ranges to keep memory bounded
+        users = UserModel.objects.order_by('pk')
+        if user_ids is not None:
+            users = users.filter(pk__in=user_ids)
+        rebuilt, last_id = 0, 0
+        while True:
+            chunk_ids = list(users.filter(pk__gt=last_id).values_list('pk', flat=True)[:chunk_size])
+            if not chunk_ids:
+                return rebuilt
+            stats = self.calculate(chunk_ids)
+            with transaction.atomic():
+                self.filter(user_id__in=chunk_ids).delete()
+                self.bulk_create(stats.values())
+            rebuilt, last_id = rebuilt + len(chunk_ids), chunk_ids[-1]
+
+
+class UserLibraryStats(models.Model):
+    user = models.OneToOneField(UserModel, on_delete=models.CASCADE, primary_key=True, related_name='library_stats',
+                                verbose_name='Пользователь')
+    bookmark_count = models.PositiveIntegerField(default=0, verbose_name='В закладках')
+    wishlist_count = models.PositiveIntegerField(default=0, verbose_name='В списке желаний')
+    rating_count = models.PositiveIntegerField(default=0, verbose_name='Оценено')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
+
+    objects = UserLibraryStatsManager()
+
+    class Meta:
+        verbose_name = 'статистика библиотеки пользователя'
+        verbose_name_plural = 'статистика библиотек пользователей'
+
+    def __str__(self):
+        return str(self.user_id)
+
+
+class LeaderboardEntryQuerySet(models.QuerySet):
+    def board(self, metric, period, category=None, author=None):
+        return self.filter(metric=metric, period=period, category=category, author=author).order_by('position')
+
+
+class LeaderboardEntryManager(models.Manager.from_queryset(LeaderboardEntryQuerySet)):
+    def source_rows(self, period):
+        # (book_id, rating_avg, rating_count, wishlist_count, bookmark_count) of the books with relations in the period
+        since = self.model.PERIODS[period]
+        if since is None:
+            return BookStats.objects.filter(
+                Q(rating_count__gt=0) | Q(wishlist_count__gt=0) | Q(bookmark_count__gt=0)
+            ).values_list('book_id', 'rating_avg', 'rating_count', 'wishlist_count', 'bookmark_count').iterator()
+        relations = UserBookRelation.objects.filter(updated_at__gte=timezone.now() - since)
+        return ((row['book_id'], row['rating_sum'] / row['rating_count'] if row['rating_count'] else None,
+                 row['rating_count'], row['wishlist_count'], row['bookmark_count'])
+                for row in BookStats.objects.relation_totals(relations).iterator())
+
+    def calculate(self, period, size, min_ratings, authors, categories):
+        """
+        Ranks the books of one period on every board in a single pass over the source rows, keeping a bounded
+        heap of the size best (score, -book_id) keys per board. Returns ({(metric, category_id, author_id):
+        [(score, book_id), ...]}, number of rows scanned).
+        """
+        boards, rows = defaultdict(list), 0
+        for book_id, rating_avg, rating_count, wishlist_count, bookmark_count in self.source_rows(period):
+            rows += 1
+            scores = []
+            if rating_count and rating_count >= min_ratings:
+                scores.append((self.model.METRIC_RATING, (rating_avg, rating_count)))
+            if wishlist_count:
+                scores.append((self.model.METRIC_WISHLIST, (wishlist_count,)))
+            if bookmark_count:
+                scores.append((self.model.METRIC_BOOKMARKS, (bookmark_count,)))
+            if not scores or book_id not in authors:
+                continue
+            scopes = [(None, None), (None, authors[book_id])]
+            scopes.extend((category_id, None) for category_id in categories.get(book_id, ()))
+            for metric, score in scores:
+                for category_id, author_id in scopes:
+                    heap = boards[metric, category_id, author_id]
+                    if len(heap) < size:
+                        heapq.heappush(heap, (score, -book_id))
+                    elif (score, -book_id) > heap[0]:
+                        heapq.heapreplace(heap, (score, -book_id))
+        return {board: [(score[0], -book_id) for score, book_id in sorted(heap, reverse=True)]
+                for board, heap in boards.items()}, rows
+
+    def rebuild(self, periods=None, size=None):
+        """
+        Recomputes every leaderboard and replaces the stored entries. Returns the cost of the run: rows scanned,
+        boards and seconds per period, entries written and the total seconds.
+        """
+        size = size or getattr(settings, 'CATALOG_LEADERBOARD_SIZE', 100)
+        min_ratings = getattr(settings, 'CATALOG_LEADERBOARD_MIN_RATINGS', 3)
+        started, computed_at = time.monotonic(), timezone.now()
+        # book -> author and book -> categories lookups shared by all periods
+        authors = dict(Book.objects.values_list('id', 'author_id').iterator())
+        categories = defaultdict(list)
+        for book_id, category_id in Book.categories.through.objects.values_list('book_id', 'category_id').iterator():
+            categories[book_id].append(category_id)
+        report, entries = {'periods': {}}, []
+        for period in periods or self.model.PERIODS:
+            period_started = time.monotonic()
+            boards, rows = self.calculate(period, size, min_ratings, authors, categories)
+            for (metric, category_id, author_id), ranking in boards.items():
+                entries.extend(
+                    self.model(metric=metric, period=period, category_id=category_id, author_id=author_id,
+                               position=position, book_id=book_id, score=score, computed_at=computed_at)
+                    for position, (score, book_id) in enumerate(ranking, 1)
+                )
+            report['periods'][period] = {'rows': rows, 'boards': len(boards),
+                                         'seconds': time.monotonic() - period_started}
+        write_started = time.monotonic()
+        with transaction.atomic():
+            self.filter(period__in=list(report['periods'])).delete()
+            self.bulk_create(entries)
+        report.update(entries=len(entries), write_seconds=time.monotonic() - write_started,
+                      seconds=time.monotonic() - started)
+        return report
+
+
+class LeaderboardEntry(models.Model):
+    METRIC_RATING = 'rating'
+    METRIC_WISHLIST = 'wishlist'
+    METRIC_BOOKMARKS = 'bookmarks'
+
+    METRIC_CHOICES = (
+        (METRIC_RATING, 'Средняя оценка'),
+        (METRIC_WISHLIST, 'В списках желаний'),
+        (METRIC_BOOKMARKS, 'В закладках'),
+    )
+
+    PERIOD_ALL = 'all'
+    PERIOD_WEEK = 'week'
+
+    PERIOD_CHOICES = (
+        (PERIOD_ALL, 'За всё время'),
+        (PERIOD_WEEK, 'За неделю'),
+    )
+    # a period counts the relations changed within its window, None counts all of them
+    PERIODS = {
+        PERIOD_ALL: None,
+        PERIOD_WEEK: timedelta(days=7),
+    }
+
+    metric = models.CharField(max_length=16, choices=METRIC_CHOICES, verbose_name='Показатель')
+    period = models.CharField(max_length=8, choices=PERIOD_CHOICES, verbose_name='Период')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, blank=True, null=True,
+                                 related_name='leaderboard_entries', verbose_name='Категория')
+    author = models.ForeignKey(Author, on_delete=models.CASCADE, blank=True, null=True,
+                               related_name='leaderboard_entries', verbose_name='Автор')
+    position = models.PositiveSmallIntegerField(verbose_name='Место')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='leaderboard_entries', verbose_name='Книга')
+    score = models.FloatField(verbose_name='Значение')
+    computed_at = models.DateTimeField(verbose_name='Дата расчёта')
+
+    objects = LeaderboardEntryManager()
+
+    class Meta:
+        verbose_name = 'позиция в рейтинге'
+        verbose_name_plural = 'позиции в рейтингах'
+        indexes = [
+            models.Index(fields=['metric', 'period', 'category', 'author', 'position']),
+        ]
+
+    def __str__(self):
+        return '{} {} #{}'.format(self.metric, self.period, self.position)
+
+
+class SimilarBook(models.Model):
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similar_books', verbose_name='Книга')
+    similar = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similar_entries',
+                                verbose_name='Похожая книга')
+    position = models.PositiveSmallIntegerField(verbose_name='Место')
+    score = models.FloatField(verbose_name='Сходство')
+    computed_at = models.DateTimeField(verbose_name='Дата расчёта')
+
+    class Meta:
+        verbose_name = 'похожая книга'
+        verbose_name_plural = 'похожие книги'
+        indexes = [
+            models.Index(fields=['book', 'position']),
+        ]
+
+    def __str__(self):
+        return '{} ~ {}'.format(self.book_id, self.similar_id)
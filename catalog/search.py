@@ -0,0 +1,166 @@
+import re
+from functools import lru_cache, reduce
+from operator import and_, or_
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+TERM_RE = re.compile(r'"([^"]*)"(\*?)|(\S+)')
+
+
+def parse_query(query):
+    """
+    Splits a user query into (text, prefix) terms: "quoted text" is a phrase, a trailing * makes a prefix term.
+    """
+    terms = []
+    for phrase, phrase_prefix, word in TERM_RE.findall(query):
+        text, prefix = (phrase, phrase_prefix) if not word else (word.rstrip('*'), word.endswith('*'))
+        text = ' '.join(text.replace('"', ' ').split())
+        if text:
+            terms.append((text, bool(prefix)))
+    return terms
+
+
+class SearchResults(object):
+    """
+    Lazy ranked result sequence: supports count() and slicing, so the regular paginators can page through it
+    and only the books of the requested page are loaded.
+    """
+
+    def __init__(self, backend, terms, queryset):
+        self.backend = backend
+        self.terms = terms
+        self.queryset = queryset
+
+    @cached_property
+    def _count(self):
+        return self.backend.count(self.terms) if self.terms else 0
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            raise TypeError('Search results only support slicing without a step')
+        offset = item.start or 0
+        limit = None if item.stop is None else max(item.stop - offset, 0)
+        if not self.terms or limit == 0:
+            return []
+        book_ids = self.backend.search_ids(self.terms, offset, limit)
+        books = {book.pk: book for book in self.queryset.filter(pk__in=book_ids)}
+        return [books[book_id] for book_id in book_ids if book_id in books]
+
+
+class BaseSearchBackend(object):
+    def search(self, query, queryset):
+        return SearchResults(self, parse_query(query), queryset)
+
+    def count(self, terms):
+        raise NotImplementedError
+
+    def search_ids(self, terms, offset=0, limit=None):
+        raise NotImplementedError
+
+    def index_books(self, books):
+        pass
+
+    def remove_books(self, book_ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    Index-less fallback for backends without a full-text engine: LIKE scans, ordered by id.
+    """
+    search_fields = ('title', 'title_original', 'isbn', 'author__name', 'author__family_name', 'publisher__name')
+
+    def get_queryset(self, terms):
+        from .models import Book
+
+        conditions = []
+        for text, prefix in terms:
+            lookup = 'istartswith' if prefix else 'icontains'
+            conditions.append(reduce(or_, (Q(**{'{}__{}'.format(field, lookup): text})
+                                           for field in self.search_fields)))
+        return Book.objects.filter(reduce(and_, conditions)).order_by('id')
+
+    def count(self, terms):
+        return self.get_queryset(terms).count()
+
+    def search_ids(self, terms, offset=0, limit=None):
+        book_ids = self.get_queryset(terms).values_list('id', flat=True)
+        return list(book_ids[offset:None if limit is None else offset + limit])
+
+
+class SQLiteFTS5SearchBackend(BaseSearchBackend):
+    """
+    SQLite FTS5 index keyed by book id, ranked by bm25 with the title weighted highest.
+    The table is created by the catalog migrations.
+    """
+    table = 'catalog_book_search'
+    column_weights = (10.0, 5.0, 2.0, 3.0, 1.0)  # title, title_original, isbn, author, publisher
+    index_sql = (
+        "INSERT INTO {table} (rowid, title, title_original, isbn, author, publisher) "
+        "SELECT b.id, b.title, b.title_original, COALESCE(b.isbn, ''), "
+        "a.name || ' ' || COALESCE(a.family_name, ''), COALESCE(p.name, '') "
+        "FROM catalog_book b INNER JOIN catalog_author a ON a.id = b.author_id "
+        "LEFT OUTER JOIN catalog_publisher p ON p.id = b.publisher_id"
+    )
+
+    def match_expression(self, terms):
+        return ' '.join('"{}"{}'.format(text.replace('"', '""'), '*' if prefix else '') for text, prefix in terms)
+
+    def count(self, terms):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM {0} WHERE {0} MATCH %s'.format(self.table),
+                           [self.match_expression(terms)])
+            return cursor.fetchone()[0]
+
+    def search_ids(self, terms, offset=0, limit=None):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT rowid FROM {0} WHERE {0} MATCH %s ORDER BY bm25({0}, {1}), rowid LIMIT %s OFFSET %s'.format(
+                    self.table, ', '.join(str(weight) for weight in self.column_weights)
+                ),
+                [self.match_expression(terms), -1 if limit is None else limit, offset]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def index_books(self, books):
+        # books is a Book queryset, reindexed with a single INSERT ... SELECT
+        query, params = books.values('id').query.sql_with_params()
+        self.remove_books_sql(query, params)
+        with connection.cursor() as cursor:
+            cursor.execute(self.index_sql.format(table=self.table) + ' WHERE b.id IN ({})'.format(query), params)
+
+    def remove_books(self, book_ids):
+        book_ids = list(book_ids)
+        if book_ids:
+            self.remove_books_sql(', '.join(['%s'] * len(book_ids)), book_ids)
+
+    def remove_books_sql(self, query, params):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {} WHERE rowid IN ({})'.format(self.table, query), params)
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {}'.format(self.table))
+            cursor.execute(self.index_sql.format(table=self.table))
+            cursor.execute("INSERT INTO {0} ({0}) VALUES ('optimize')".format(self.table))
+
+
+@lru_cache()
+def load_search_backend(backend_path):
+    return import_string(backend_path)()
+
+
+def get_search_backend():
+    return load_search_backend(getattr(settings, 'CATALOG_SEARCH_BACKEND', 'catalog.search.SQLiteFTS5SearchBackend'))
@@ -0,0 +1,235 @@
+from django.conf import settings
+from django.utils import timezone
+from django.db.models.signals import pre_delete, post_delete, pre_save, post_save, m2m_changed
+from django.dispatch import receiver
+from collections import Counter, defaultdict
+from .models import Author, Book, BookStats, Category, CategoryStats, DiscountGroup, Publisher, UserBookRelation, \
+    UserLibraryStats, books_bulk_changed, user_book_relations_bulk_changed
+from . import logic
+from .search import get_search_backend
+from .autocomplete import author_index, author_label, book_index
+
+
+def update_category_stats(category_ids, book_ids, sign):
+    prices = list(Book.objects.filter(id__in=book_ids).values_list('price', flat=True))
+    priced = [price for price in prices if price is not None]
+    CategoryStats.objects.filter(category_id__in=category_ids).apply_delta(
+        book_count=sign * len(prices), book_price_sum=sign * sum(priced), book_priced_count=sign * len(priced)
+    )
+
+
+@receiver(pre_delete, sender=DiscountGroup)
+def remember_discount_group_books(sender, instance, **kwargs):
+    instance.deleted_book_ids = list(instance.books.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=DiscountGroup)
+def recalculate_discount_group_books(sender, instance, **kwargs):
+    books = Book.objects.filter(id__in=instance.deleted_book_ids)
+    books.recalculate_prices()
+    books.refresh_category_stats()
+
+
+@receiver(pre_delete, sender=Category)
+def touch_category_books(sender, instance, **kwargs):
+    Book.objects.filter(categories=instance).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Category)
+def create_category_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        CategoryStats.objects.create(category=instance)
+
+
+@receiver(pre_save, sender=Book)
+def remember_book_price(sender, instance, raw=False, **kwargs):
+    instance.previous_price = None
+    if not raw and not instance._state.adding:
+        instance.previous_price = Book.objects.filter(pk=instance.pk).values_list('price').first()
+
+
+@receiver(post_save, sender=Book)
+def update_book_price_stats(sender, instance, created, raw=False, **kwargs):
+    if created or raw or instance.previous_price is None:
+        return
+    previous_price, = instance.previous_price
+    if previous_price == instance.price:
+        return
+    CategoryStats.objects.filter(category_id__in=instance.categories.values('id')).apply_delta(
+        book_price_sum=(instance.price or 0) - (previous_price or 0),
+        book_priced_count=(instance.price is not None) - (previous_price is not None)
+    )
+
+
+@receiver(pre_delete, sender=Book)
+def remove_deleted_book_stats(sender, instance, **kwargs):
+    update_category_stats(list(instance.categories.values_list('id', flat=True)), [instance.pk], -1)
+
+
+@receiver(m2m_changed, sender=Book.categories.through)
+def update_category_membership_stats(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_remove', 'pre_clear'):
+        memberships = sender.objects.filter(category_id=instance.pk) if reverse else sender.objects.filter(
+            book_id=instance.pk
+        )
+        if pk_set is not None:
+            memberships = memberships.filter(**{'book_id__in' if reverse else 'category_id__in': pk_set})
+        instance.removed_membership_ids = set(memberships.values_list('book_id' if reverse else 'category_id',
+                                                                      flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_add':
+            sign, related_ids = 1, pk_set
+        else:
+            sign, related_ids = -1, instance.removed_membership_ids
+        if not related_ids:
+            return
+        if reverse:
+            update_category_stats([instance.pk], related_ids, sign)
+            Book.objects.filter(id__in=related_ids).update(updated_at=timezone.now())
+        else:
+            update_category_stats(related_ids, [instance.pk], sign)
+            Book.objects.filter(pk=instance.pk).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index_books(Book.objects.filter(pk=instance.pk))
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    get_search_backend().remove_books([instance.pk])
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Publisher)
+def index_related_books(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        get_search_backend().index_books(instance.books.all())
+
+
+@receiver(pre_delete, sender=Publisher)
+def remember_publisher_books(sender, instance, **kwargs):
+    instance.unindexed_book_ids = list(instance.books.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Publisher)
+def index_publisher_books(sender, instance, **kwargs):
+    get_search_backend().index_books(Book.objects.filter(id__in=instance.unindexed_book_ids))
+
+
+@receiver(post_save, sender=Author)
+def update_author_autocomplete(sender, instance, **kwargs):
+    author_index.update(instance.pk, author_label(instance.name, instance.family_name))
+
+
+@receiver(post_save, sender=Book)
+def update_book_autocomplete(sender, instance, **kwargs):
+    book_index.update(instance.pk, instance.title)
+
+
+@receiver(books_bulk_changed, sender=Book)
+def invalidate_book_autocomplete(sender, book_ids, **kwargs):
+    book_index.invalidate()
+
+
+@receiver(post_delete, sender=Author)
+def remove_author_autocomplete(sender, instance, **kwargs):
+    author_index.remove(instance.pk)
+
+
+@receiver(post_delete, sender=Book)
+def remove_book_autocomplete(sender, instance, **kwargs):
+    book_index.remove(instance.pk)
+
+
+def relation_state(relation):
+    return {'rating': relation.rating, 'in_bookmarks': relation.in_bookmarks, 'in_wishlist': relation.in_wishlist}
+
+
+@receiver(post_save, sender=Book)
+def create_book_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        BookStats.objects.create(book=instance)
+
+
+@receiver(pre_save, sender=UserBookRelation)
+def remember_relation_stats(sender, instance, raw=False, **kwargs):
+    instance.previous_stats = None
+    if not raw and not instance._state.adding:
+        instance.previous_stats = UserBookRelation.objects.filter(pk=instance.pk).values_list(
+            'user_id', 'book_id', 'rating', 'in_bookmarks', 'in_wishlist'
+        ).first()
+
+
+@receiver(post_save, sender=UserBookRelation)
+def update_relation_book_stats(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    deltas = defaultdict(Counter)
+    if instance.previous_stats is not None:
+        _, book_id, rating, in_bookmarks, in_wishlist = instance.previous_stats
+        deltas[book_id].subtract(logic.relation_stats(rating, in_bookmarks, in_wishlist))
+    deltas[instance.book_id].update(logic.relation_stats(**relation_state(instance)))
+    BookStats.objects.apply_deltas(deltas)
+
+
+@receiver(post_delete, sender=UserBookRelation)
+def remove_relation_book_stats(sender, instance, **kwargs):
+    stats = logic.relation_stats(**relation_state(instance))
+    BookStats.objects.apply_deltas({instance.book_id: logic.stats_delta(stats, {})})
+
+
+@receiver(user_book_relations_bulk_changed, sender=UserBookRelation)
+def update_bulk_relations_book_stats(sender, created, updated, **kwargs):
+    deltas = {relation.book_id: logic.relation_stats(**relation_state(relation)) for relation in created}
+    for relation, previous in updated:
+        state = relation_state(relation)
+        deltas[relation.book_id] = logic.stats_delta(logic.relation_stats(**dict(state, **previous)),
+                                                     logic.relation_stats(**state))
+    BookStats.objects.apply_deltas(deltas)
+
+
+def apply_library_stats_deltas(deltas):
+    # deltas is {user_id: relation statistics delta}, of which only the per user counters are kept
+    for user_id, delta in deltas.items():
+        delta = {field: delta.get(field, 0) for field in ('bookmark_count', 'wishlist_count', 'rating_count')}
+        if any(delta.values()):
+            UserLibraryStats.objects.filter(user_id=user_id).apply_delta(**delta)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def create_library_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        UserLibraryStats.objects.create(user=instance)
+
+
+@receiver(post_save, sender=UserBookRelation)
+def update_relation_library_stats(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    deltas = defaultdict(Counter)
+    if instance.previous_stats is not None:
+        user_id, _, rating, in_bookmarks, in_wishlist = instance.previous_stats
+        deltas[user_id].subtract(logic.relation_stats(rating, in_bookmarks, in_wishlist))
+    deltas[instance.user_id].update(logic.relation_stats(**relation_state(instance)))
+    apply_library_stats_deltas(deltas)
+
+
+@receiver(post_delete, sender=UserBookRelation)
+def remove_relation_library_stats(sender, instance, **kwargs):
+    stats = logic.relation_stats(**relation_state(instance))
+    apply_library_stats_deltas({instance.user_id: logic.stats_delta(stats, {})})
+
+
+@receiver(user_book_relations_bulk_changed, sender=UserBookRelation)
+def update_bulk_relations_library_stats(sender, user, created, updated, **kwargs):
+    delta = Counter()
+    for relation in created:
+        delta.update(logic.relation_stats(**relation_state(relation)))
+    for relation, previous in updated:
+        state = relation_state(relation)
+        delta.subtract(logic.relation_stats(**dict(state, **previous)))
+        delta.update(logic.relation_stats(**state))
+    apply_library_stats_deltas({user.pk: delta})
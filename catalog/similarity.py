@@ -0,0 +1,111 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from scipy import sparse
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import SimilarBook, UserBookRelation
+
+
+class SimilarityJob(object):
+    """
+    Offline item-item "similar books" job. The relations are loaded into sparse user x book matrices and books are
+    compared by the cosine of their rating vectors plus bookmark_weight times the cosine of their bookmark vectors,
+    which is the co-bookmark count normalized by both bookmark counts. The top_n neighbours of every book are
+    stored as SimilarBook rows.
+
+    The whole book x book product is computed at once unless chunk_size is given, in which case the products and
+    the writes are done chunk_size books at a time, so memory is bounded by the relation matrices rather than by
+    the square of the number of books. Relations are always read load_chunk_size rows at a time.
+    """
+
+    def __init__(self, top_n=20, chunk_size=None, bookmark_weight=0.5, load_chunk_size=100000):
+        self.top_n = top_n
+        self.chunk_size = chunk_size
+        self.bookmark_weight = bookmark_weight
+        self.load_chunk_size = load_chunk_size
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.monotonic() - started
+
+    def load(self):
+        # (user_id, book_id, rating or 0, in_bookmarks) rows of the relations carrying a rating or a bookmark
+        relations = UserBookRelation.objects.filter(Q(rating__isnull=False) | Q(in_bookmarks=True)).order_by('pk')
+        relations = relations.values_list('pk', 'user_id', 'book_id', 'rating', 'in_bookmarks')
+        chunks, last_pk = [], 0
+        while True:
+            rows = list(relations.filter(pk__gt=last_pk)[:self.load_chunk_size])
+            if not rows:
+                break
+            chunks.append(np.array([(user_id, book_id, rating or 0, in_bookmarks)
+                                    for _, user_id, book_id, rating, in_bookmarks in rows], dtype=np.int64))
+            last_pk = rows[-1][0]
+        return np.concatenate(chunks) if chunks else np.empty((0, 4), dtype=np.int64)
+
+    def build_matrix(self, relations):
+        """
+        Returns the book ids and a books x (2 * users) matrix whose rows are the L2 normalized rating vectors next to
+        the normalized bookmark vectors scaled by sqrt(bookmark_weight): the dot product of two rows is the score.
+        """
+        user_ids, user_index = np.unique(relations[:, 0], return_inverse=True)
+        book_ids, book_index = np.unique(relations[:, 1], return_inverse=True)
+        shape = (len(book_ids), len(user_ids))
+
+        def normalized(mask, values):
+            matrix = sparse.csr_matrix((values[mask], (book_index[mask], user_index[mask])), shape=shape)
+            norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+            return sparse.diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)).dot(matrix)
+
+        ratings = normalized(relations[:, 2] > 0, relations[:, 2].astype(np.float64))
+        bookmarks = normalized(relations[:, 3] > 0, np.ones(len(relations)))
+        return book_ids, sparse.hstack([ratings, bookmarks * np.sqrt(self.bookmark_weight)], format='csr')
+
+    def neighbours(self, book_ids, scores, offset):
+        # top_n columns of every row of the chunk, by descending score then book id, without the book itself
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            columns, values = scores.indices[start:end], scores.data[start:end]
+            keep = (columns != offset + row) & (values > 0)
+            columns, values = columns[keep], values[keep]
+            if len(values) > self.top_n:
+                best = np.argpartition(-values, self.top_n - 1)[:self.top_n]
+                columns, values = columns[best], values[best]
+            order = np.lexsort((book_ids[columns], -values))
+            yield book_ids[offset + row], zip(book_ids[columns[order]], values[order])
+
+    def run(self):
+        computed_at = timezone.now()
+        with self.stage('load'):
+            relations = self.load()
+        with self.stage('matrix'):
+            book_ids, matrix = self.build_matrix(relations)
+            transposed = matrix.T.tocsr()
+        chunk_size = self.chunk_size or max(len(book_ids), 1)
+        stored = 0
+        for offset in range(0, len(book_ids), chunk_size):
+            with self.stage('similarity'):
+                scores = matrix[offset:offset + chunk_size].dot(transposed).tocsr()
+                entries = [
+                    SimilarBook(book_id=int(book_id), similar_id=int(similar_id), position=position,
+                                score=float(score), computed_at=computed_at)
+                    for book_id, neighbours in self.neighbours(book_ids, scores, offset)
+                    for position, (similar_id, score) in enumerate(neighbours, 1)
+                ]
+            with self.stage('store'), transaction.atomic():
+                # book ids are sorted, the chunk replaces the previous neighbours of its id range
+                chunk_ids = book_ids[offset:offset + chunk_size]
+                SimilarBook.objects.filter(book_id__gte=int(chunk_ids[0]), book_id__lte=int(chunk_ids[-1])).delete()
+                SimilarBook.objects.bulk_create(entries)
+            stored += len(entries)
+        with self.stage('store'):
+            # books outside the chunks, which lost all their relations since the previous run
+            SimilarBook.objects.filter(computed_at__lt=computed_at).delete()
+        return {'relations': len(relations), 'books': len(book_ids), 'entries': stored, 'timings': self.timings}
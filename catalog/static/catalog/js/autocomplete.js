@@ -0,0 +1,71 @@
+(function () {
+
+    var minLength = 1,
+        delay = 200;
+
+    function initAutocomplete(container) {
+        var valueInput = container.querySelector('input[type=hidden]'),
+            labelInput = container.querySelector('.js-autocomplete-label'),
+            resultsList = container.querySelector('.js-autocomplete-results'),
+            timer = null,
+            request = null;
+
+        function clearResults() {
+            resultsList.innerHTML = '';
+        }
+
+        function renderResults(results) {
+            clearResults();
+            results.forEach(function (result) {
+                var item = document.createElement('li');
+                item.textContent = result.label;
+                item.addEventListener('mousedown', function (event) {
+                    event.preventDefault();
+                    valueInput.value = result.id;
+                    labelInput.value = result.label;
+                    clearResults();
+                });
+                resultsList.appendChild(item);
+            });
+        }
+
+        function fetchResults() {
+            var query = labelInput.value.trim();
+            if (request) {
+                request.abort();
+            }
+            if (query.length < minLength) {
+                clearResults();
+                return;
+            }
+            request = new XMLHttpRequest();
+            request.open('GET', container.dataset.url + '?q=' + encodeURIComponent(query));
+            request.setRequestHeader('Accept', 'application/json');
+            request.onload = function () {
+                if (this.status === 200) {
+                    renderResults(JSON.parse(this.responseText));
+                }
+            };
+            request.send();
+        }
+
+        labelInput.addEventListener('input', function () {
+            valueInput.value = '';
+            clearTimeout(timer);
+            timer = setTimeout(fetchResults, delay);
+        });
+
+        labelInput.addEventListener('blur', clearResults);
+    }
+
+    function initAll() {
+        Array.prototype.forEach.call(document.querySelectorAll('.js-autocomplete'), initAutocomplete);
+    }
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', initAll);
+    } else {
+        initAll();
+    }
+
+})();
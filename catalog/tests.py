@@ -1,7 +1,22 @@
 from django.test import TestCase
-from . import logic
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from collections import Counter
+from datetime import timedelta
+from io import StringIO
+import json
+import os
+import tempfile
+from . import logic, similarity
 from django.contrib.auth.models import AnonymousUser
-from .models import Book, DiscountGroup, Category
+from .models import Author, Book, BookStats, DiscountGroup, Category, CategoryStats, LeaderboardEntry, Publisher, \
+    SimilarBook, UserBookRelation, UserLibraryStats, user_book_relations_bulk_changed
+from .search import DatabaseSearchBackend, get_search_backend, parse_query
+from .autocomplete import PrefixIndex, author_index, book_index
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.db import connection
+from django.utils import timezone
+from django.urls import reverse
 from api.v1.tests import factories
 from django.contrib.auth import get_user_model
 
@@ -53,14 +68,37 @@ class LogicTestCase(TestCase):
         book = Book.objects.get(id=book.id)
         self.assertEqual(700, book.price)
 
+    def test_book_price_discount_group_deleted(self):
+        discount_group = DiscountGroup.objects.create(name="DG1", discount=20)
+        book = factories.BookFactory.create(discount=10, price_original=1000, discount_group=discount_group)
+        self.assertEqual(700, Book.objects.get(id=book.id).price)
+        discount_group.delete()
+        book = Book.objects.get(id=book.id)
+        self.assertEqual(10, book.discount_total)
+        self.assertEqual(900, book.price)
+
+    def test_book_price_query_has_no_join(self):
+        self.assertNotIn('discountgroup', str(Book.objects.order_by('price').query))
+
+    def test_recalculate_prices_command(self):
+        discount_group = DiscountGroup.objects.create(name="DG1", discount=20)
+        book = factories.BookFactory.create(discount=10, price_original=1000, discount_group=discount_group)
+        Book.objects.filter(id=book.id).update(price=None, discount_total=0)
+        call_command('recalculate_prices', chunk_size=2, stdout=StringIO())
+        book = Book.objects.get(id=book.id)
+        self.assertEqual(30, book.discount_total)
+        self.assertEqual(700, book.price)
+        for book in Book.objects.all():
+            self.assertEqual(logic.price(book.price_original, book.discount_total), book.price)
+
     def test_category_book_stats(self):
         category = factories.CategoryFactory.create()
         factories.BookFactory.create(price_original=20, discount=0, categories=(category,))
         factories.BookFactory.create(price_original=40, discount=0, categories=(category,))
         factories.BookFactory.create(price_original=60, discount=0, categories=(category,))
         category = Category.objects.get(id=category.id)
-        self.assertEqual(3, category.book_count)
-        self.assertEqual(40, category.book_average_price)
+        self.assertEqual(3, category.stats.book_count)
+        self.assertEqual(40, category.stats.book_average_price)
 
     def test_category_book_stats_with_none(self):
         category = factories.CategoryFactory.create()
@@ -68,8 +106,8 @@ class LogicTestCase(TestCase):
         factories.BookFactory.create(price_original=100, discount=0, categories=(category,))
         factories.BookFactory.create(price_original=50, discount=0, categories=(category,))
         category = Category.objects.get(id=category.id)
-        self.assertEqual(3, category.book_count)
-        self.assertEqual(75, category.book_average_price)
+        self.assertEqual(3, category.stats.book_count)
+        self.assertEqual(75, category.stats.book_average_price)
 
     def test_category_book_stats_with_zero(self):
         category = factories.CategoryFactory.create()
@@ -77,5 +115,542 @@ class LogicTestCase(TestCase):
         factories.BookFactory.create(price_original=100, discount=0, categories=(category,))
         factories.BookFactory.create(price_original=50, discount=0, categories=(category,))
         category = Category.objects.get(id=category.id)
-        self.assertEqual(3, category.book_count)
-        self.assertEqual(50, category.book_average_price)
+        self.assertEqual(3, category.stats.book_count)
+        self.assertEqual(50, category.stats.book_average_price)
+
+    def assertCategoryStatsConsistent(self):
+        expected_stats = CategoryStats.objects.calculate()
+        for stats in CategoryStats.objects.all():
+            expected = expected_stats[stats.category_id]
+            self.assertEqual(
+                (expected.book_count, expected.book_price_sum, expected.book_priced_count),
+                (stats.book_count, stats.book_price_sum, stats.book_priced_count),
+                "Stale statistics for category {}".format(stats.category_id)
+            )
+
+    def test_category_stats_incremental_updates(self):
+        category, other_category = factories.CategoryFactory.create_batch(2)
+        first = factories.BookFactory.create(price_original=100, discount=0, categories=(category, other_category))
+        second = factories.BookFactory.create(price_original=None, discount=0, categories=(category,))
+        self.assertCategoryStatsConsistent()
+
+        first.price_original = 300
+        first.save()
+        second.price_original = 50
+        second.save()
+        self.assertCategoryStatsConsistent()
+        self.assertEqual(175, CategoryStats.objects.get(category=category).book_average_price)
+
+        discount_group = DiscountGroup.objects.create(name="DG1", discount=0)
+        Book.objects.filter(id=first.id).update(discount_group=discount_group)
+        discount_group.discount = 50
+        discount_group.save()
+        self.assertCategoryStatsConsistent()
+        self.assertEqual(100, CategoryStats.objects.get(category=category).book_average_price)
+
+        first.categories.remove(other_category, category)
+        category.books.add(first)
+        other_category.books.clear()
+        second.categories.remove(other_category)
+        self.assertCategoryStatsConsistent()
+
+        discount_group.delete()
+        second.delete()
+        self.assertCategoryStatsConsistent()
+        self.assertEqual(1, CategoryStats.objects.get(category=category).book_count)
+
+    def test_category_stats_are_not_aggregated_per_query(self):
+        self.assertNotIn('GROUP BY', str(Category.objects.all().query))
+
+    def test_rebuild_category_stats_command(self):
+        category = factories.CategoryFactory.create()
+        factories.BookFactory.create(price_original=20, discount=0, categories=(category,))
+        CategoryStats.objects.filter(category=category).update(book_count=10)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_category_stats', check_only=True, stdout=StringIO())
+        call_command('rebuild_category_stats', stdout=StringIO())
+        call_command('rebuild_category_stats', check_only=True, stdout=StringIO())
+        self.assertEqual(1, CategoryStats.objects.get(category=category).book_count)
+
+    def test_relations_bulk_upsert_signal(self):
+        user = User.objects.first()
+        book, other_book = Book.objects.all()[:2]
+        UserBookRelation.objects.create(user=user, book=book, rating=2)
+        sent = []
+
+        def receiver(sender, **kwargs):
+            sent.append(kwargs)
+
+        user_book_relations_bulk_changed.connect(receiver)
+        try:
+            results = UserBookRelation.objects.bulk_upsert(user, {
+                book.id: {'rating': 4, 'in_bookmarks': False}, other_book.id: {'in_wishlist': True}
+            })
+        finally:
+            user_book_relations_bulk_changed.disconnect(receiver)
+        self.assertEqual({book.id: 'updated', other_book.id: 'created'}, results)
+        self.assertEqual(1, len(sent))
+        self.assertEqual([other_book.id], [relation.book_id for relation in sent[0]['created']])
+        (relation, previous), = sent[0]['updated']
+        self.assertEqual((book.id, 4, {'rating': 2}), (relation.book_id, relation.rating, previous))
+        self.assertEqual(4, UserBookRelation.objects.get(user=user, book=book).rating)
+
+    def assertBookStatsConsistent(self):
+        stored_stats = BookStats.objects.in_bulk()
+        expected_stats = BookStats.objects.calculate(list(Book.objects.values_list('id', flat=True)))
+        self.assertEqual(set(expected_stats), set(stored_stats), "Every book should have a statistics row")
+        fields = [field.attname for field in BookStats._meta.fields if field.attname not in ('book_id', 'updated_at')]
+        for book_id, expected in expected_stats.items():
+            self.assertEqual(
+                [getattr(expected, field) for field in fields],
+                [getattr(stored_stats[book_id], field) for field in fields],
+                "Stale statistics for book {}".format(book_id)
+            )
+
+    def test_book_stats_incremental_updates(self):
+        first_user, second_user = factories.UserFactory.create_batch(2)
+        book, other_book = Book.objects.all()[:2]
+        first = UserBookRelation.objects.create(user=first_user, book=book, rating=5, in_bookmarks=True)
+        second = UserBookRelation.objects.create(user=second_user, book=book, rating=2, in_wishlist=True)
+        self.assertBookStatsConsistent()
+        self.assertEqual((2, 3.5), (book.stats.rating_count, BookStats.objects.get(book=book).rating_avg))
+
+        first.rating, first.in_bookmarks = None, False
+        first.save()
+        second.book, second.rating = other_book, 4
+        second.save()
+        self.assertBookStatsConsistent()
+        self.assertIsNone(BookStats.objects.get(book=book).rating_avg)
+
+        UserBookRelation.objects.bulk_upsert(first_user, {book.id: {'rating': 1}, other_book.id: {'rating': 3}})
+        self.assertBookStatsConsistent()
+        self.assertEqual({1: 0, 2: 0, 3: 1, 4: 1, 5: 0}, BookStats.objects.get(book=other_book).rating_histogram)
+
+        second.delete()
+        second_user.delete()
+        first_user.delete()
+        self.assertBookStatsConsistent()
+        self.assertEqual(0, BookStats.objects.get(book=book).rating_count)
+
+    def test_rebuild_book_stats_command(self):
+        book = Book.objects.first()
+        UserBookRelation.objects.create(user=User.objects.first(), book=book, rating=4, in_bookmarks=True)
+        BookStats.objects.filter(book=book).update(rating_count=10, bookmark_count=0, rating_avg=1)
+        BookStats.objects.filter(book=Book.objects.last()).delete()
+        call_command('rebuild_book_stats', chunk_size=2, stdout=StringIO())
+        self.assertBookStatsConsistent()
+        self.assertEqual((1, 4.0, 1), BookStats.objects.filter(book=book).values_list(
+            'rating_count', 'rating_avg', 'bookmark_count'
+        ).get())
+
+    def assertLibraryStatsConsistent(self):
+        expected_stats = UserLibraryStats.objects.calculate(list(User.objects.values_list('pk', flat=True)))
+        self.assertEqual(
+            {user_id: (stats.bookmark_count, stats.wishlist_count, stats.rating_count)
+             for user_id, stats in expected_stats.items()},
+            {stats.user_id: (stats.bookmark_count, stats.wishlist_count, stats.rating_count)
+             for stats in UserLibraryStats.objects.all()}
+        )
+
+    def test_library_stats_incremental_updates(self):
+        user, other_user = factories.UserFactory.create_batch(2)
+        book, other_book = Book.objects.all()[:2]
+        relation = UserBookRelation.objects.create(user=user, book=book, rating=3, in_bookmarks=True)
+        UserBookRelation.objects.create(user=other_user, book=other_book, in_wishlist=True)
+        self.assertLibraryStatsConsistent()
+
+        relation.user, relation.rating, relation.in_wishlist = other_user, None, True
+        relation.save()
+        self.assertLibraryStatsConsistent()
+        UserBookRelation.objects.bulk_upsert(user, {book.id: {'rating': 2}, other_book.id: {'in_bookmarks': True}})
+        UserBookRelation.objects.bulk_upsert(user, {book.id: {'rating': None, 'in_wishlist': True}})
+        self.assertLibraryStatsConsistent()
+        self.assertEqual((1, 1, 0), UserLibraryStats.objects.filter(user=user).values_list(
+            'bookmark_count', 'wishlist_count', 'rating_count'
+        ).get())
+
+        relation.delete()
+        book.delete()
+        self.assertLibraryStatsConsistent()
+
+    def test_repair_library_stats_command(self):
+        user = User.objects.first()
+        UserBookRelation.objects.create(user=user, book=Book.objects.first(), rating=5)
+        UserLibraryStats.objects.filter(user=user).update(rating_count=7)
+        UserLibraryStats.objects.filter(user=User.objects.last()).delete()
+        with self.assertRaises(CommandError):
+            call_command('repair_library_stats', check_only=True, stdout=StringIO())
+        out = StringIO()
+        call_command('repair_library_stats', chunk_size=1, stdout=out)
+        self.assertIn('User {}: rating_count is 7, expected 1'.format(user.pk), out.getvalue())
+        self.assertIn('2 users with stale library counters repaired', out.getvalue())
+        call_command('repair_library_stats', check_only=True, stdout=StringIO())
+        self.assertLibraryStatsConsistent()
+
+
+@override_settings(CATALOG_LEADERBOARD_MIN_RATINGS=2)
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        self.users = factories.UserFactory.create_batch(4)
+        self.authors = factories.AuthorFactory.create_batch(2)
+        self.category = factories.CategoryFactory.create()
+        self.books = [factories.BookFactory.create(author=self.authors[i % 2], categories=(self.category,))
+                      for i in range(6)]
+        for user, ratings in zip(self.users, ((5, 4, 3, 2, 1, 5), (5, 4, 3, 2, 1, None), (4, 4, 5, None, 1, None),
+                                              (None, None, None, None, None, None))):
+            for book, rating in zip(self.books, ratings):
+                UserBookRelation.objects.create(user=user, book=book, rating=rating,
+                                                in_wishlist=rating is None, in_bookmarks=rating == 5)
+
+    def board(self, *args, **kwargs):
+        return list(LeaderboardEntry.objects.board(*args, **kwargs).values_list('book_id', 'score'))
+
+    def test_rebuild(self):
+        books = self.books
+        report = LeaderboardEntry.objects.rebuild()
+        self.assertEqual({'all', 'week'}, set(report['periods']))
+        self.assertEqual(6, report['periods']['all']['rows'])
+        # the sixth book has a single rating, below the minimum
+        self.assertEqual([(books[0].id, 14 / 3), (books[1].id, 4), (books[2].id, 11 / 3), (books[3].id, 2),
+                          (books[4].id, 1)], self.board('rating', 'all'))
+        self.assertEqual([(books[0].id, 14 / 3), (books[2].id, 11 / 3), (books[4].id, 1)],
+                         self.board('rating', 'all', author=self.authors[0]))
+        self.assertEqual(self.board('rating', 'all'), self.board('rating', 'all', category=self.category))
+        self.assertEqual([(books[5].id, 3), (books[3].id, 2)] + [(books[i].id, 1) for i in (0, 1, 2, 4)],
+                         self.board('wishlist', 'all'))
+        self.assertEqual(report['entries'], LeaderboardEntry.objects.count())
+
+    def test_rebuild_week_and_size(self):
+        UserBookRelation.objects.filter(user=self.users[0]).update(updated_at=timezone.now() - timedelta(days=8))
+        LeaderboardEntry.objects.rebuild(['week'], size=2)
+        self.assertFalse(LeaderboardEntry.objects.filter(period='all').exists())
+        self.assertEqual([(self.books[0].id, 4.5), (self.books[1].id, 4)], self.board('rating', 'week'))
+        self.assertEqual(2, len(self.board('wishlist', 'week', category=self.category)))
+
+    def test_rebuild_leaderboards_command(self):
+        out = StringIO()
+        call_command('rebuild_leaderboards', periods=['all'], stdout=out)
+        self.assertIn('all: 6 rows scanned', out.getvalue())
+        self.assertTrue(LeaderboardEntry.objects.filter(period='all', metric='bookmarks').exists())
+        self.books[0].delete()
+        self.assertFalse(LeaderboardEntry.objects.filter(book_id=self.books[0].id).exists())
+
+
+class SimilarityTestCase(TestCase):
+    def setUp(self):
+        self.users = factories.UserFactory.create_batch(3)
+        factories.AuthorFactory.create()
+        factories.CategoryFactory.create()
+        self.books = factories.BookFactory.create_batch(4)
+        for user, relations in zip(self.users, (((5, True), (4, False), None, (1, False)),
+                                                ((5, True), (5, True), None, None),
+                                                ((None, True), None, (None, True), (3, False)))):
+            for book, relation in zip(self.books, relations):
+                if relation:
+                    UserBookRelation.objects.create(user=user, book=book, rating=relation[0], in_bookmarks=relation[1])
+
+    def neighbours(self, book):
+        return list(SimilarBook.objects.filter(book=book).order_by('position').values_list('similar_id', 'score'))
+
+    def test_job(self):
+        report = similarity.SimilarityJob(top_n=2).run()
+        self.assertEqual((8, 4), (report['relations'], report['books']))
+        self.assertEqual(['load', 'matrix', 'similarity', 'store'], list(report['timings']))
+        first, second, third, fourth = self.books
+        (best, best_score), (other, other_score) = self.neighbours(first)
+        self.assertEqual((second.id, third.id), (best, other))
+        # rating cosine plus half the bookmark cosine, the third book is only co-bookmarked
+        self.assertAlmostEqual(45 / (50 * 41) ** 0.5 + 0.5 / 3 ** 0.5, best_score)
+        self.assertAlmostEqual(0.5 / 3 ** 0.5, other_score)
+        self.assertEqual([first.id], [similar_id for similar_id, _ in self.neighbours(third)])
+
+        chunked = similarity.SimilarityJob(top_n=2, chunk_size=1, load_chunk_size=3).run()
+        self.assertEqual(report['entries'], chunked['entries'])
+        self.assertEqual([(best, best_score), (other, other_score)], self.neighbours(first))
+
+        UserBookRelation.objects.filter(book=third).delete()
+        similarity.SimilarityJob().run()
+        self.assertEqual([], self.neighbours(third))
+        self.assertEqual([second.id, fourth.id], [similar_id for similar_id, _ in self.neighbours(first)])
+        self.assertAlmostEqual(5 / (50 * 10) ** 0.5, self.neighbours(first)[1][1])
+
+    def test_compute_similar_books_command(self):
+        out = StringIO()
+        call_command('compute_similar_books', chunk_size=2, stdout=out)
+        self.assertIn('similarity: ', out.getvalue())
+        self.assertEqual(SimilarBook.objects.count(), int(out.getvalue().split('Stored ')[1].split()[0]))
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.author = factories.AuthorFactory.create(name='Quintus', family_name='Zanzibarov')
+        self.publisher = Publisher.objects.create(name='Marmalade Press')
+        category = factories.CategoryFactory.create()
+        self.book = factories.BookFactory.create(title='Marmalade skies', title_original='Sky jam',
+                                                 author=self.author, categories=(category,))
+        self.other_book = factories.BookFactory.create(title='Silent harbour', title_original='Harbour',
+                                                       author=self.author, publisher=self.publisher,
+                                                       categories=(category,))
+
+    def search(self, query, backend=None):
+        results = (backend or get_search_backend()).search(query, Book.objects.all())
+        return [book.title for book in results[:len(results)]]
+
+    def test_parse_query(self):
+        self.assertEqual([('silent', False), ('harb', True), ('sky jam', False), ('red fox', True)],
+                         parse_query('silent harb* "sky jam" "red fox"* * ""'))
+
+    def test_ranking_phrase_and_prefix(self):
+        self.assertEqual(['Marmalade skies', 'Silent harbour'], self.search('marmalade'))
+        self.assertEqual(['Marmalade skies', 'Silent harbour'], self.search('zanzib*'), "Ties are ordered by id")
+        self.assertEqual(['Marmalade skies'], self.search('"sky jam"'))
+        self.assertEqual([], self.search('"jam sky"'))
+        self.assertEqual(['Silent harbour'], self.search('silent marm*'))
+        self.assertEqual([], self.search('" * "'))
+
+    def test_index_sync(self):
+        self.book.title = 'Quiet orchard'
+        self.book.save()
+        self.assertEqual(['Quiet orchard'], self.search('orchard'))
+        self.assertEqual([], self.search('skies'))
+
+        self.author.family_name = 'Kilimanjarov'
+        self.author.save()
+        self.assertEqual(2, len(self.search('kilimanjarov')))
+
+        self.publisher.name = 'Lighthouse Books'
+        self.publisher.save()
+        self.assertEqual(['Silent harbour'], self.search('lighthouse'))
+        self.publisher.delete()
+        self.assertEqual([], self.search('lighthouse'))
+
+        self.other_book.delete()
+        self.assertEqual([], self.search('silent'))
+
+    def test_database_backend(self):
+        backend = DatabaseSearchBackend()
+        self.assertEqual(['Marmalade skies', 'Silent harbour'], self.search('marmalade', backend))
+        self.assertEqual(['Silent harbour'], self.search('silent zanzib*', backend))
+
+    def test_rebuild_search_index_command(self):
+        Book.objects.filter(pk=self.book.pk).update(title='Bulk orchard')
+        self.assertEqual([], self.search('orchard'))
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(['Bulk orchard'], self.search('orchard'))
+
+
+class AutocompleteTestCase(TestCase):
+    def setUp(self):
+        author_index.clear()
+        book_index.clear()
+        self.tolstoy = factories.AuthorFactory.create(name='Lev', family_name='Tolstoy')
+        self.tolkien = factories.AuthorFactory.create(name='John', family_name='Tolkien')
+        factories.CategoryFactory.create()
+
+    def test_lookup(self):
+        with self.assertNumQueries(1):
+            self.assertEqual([(self.tolkien.pk, 'John Tolkien'), (self.tolstoy.pk, 'Lev Tolstoy')],
+                             author_index.lookup('tol'))
+            self.assertEqual([(self.tolstoy.pk, 'Lev Tolstoy')], author_index.lookup('  LEV  tol'))
+            self.assertEqual([(self.tolkien.pk, 'John Tolkien')], author_index.lookup('tol', limit=1))
+        self.assertEqual([], author_index.lookup(''))
+
+    def test_incremental_updates(self):
+        author_index.lookup('tol')
+        with self.assertNumQueries(0):
+            self.assertEqual([], author_index.lookup('dostoevsky'))
+        dostoevsky = factories.AuthorFactory.create(name='Fyodor', family_name='Dostoevsky')
+        self.tolstoy.family_name = 'Tolstoi'
+        self.tolstoy.save()
+        self.tolkien.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual([(dostoevsky.pk, 'Fyodor Dostoevsky')], author_index.lookup('dost'))
+            self.assertEqual([(self.tolstoy.pk, 'Lev Tolstoi')], author_index.lookup('tol'))
+
+        book = factories.BookFactory.create(title='War and Peace', author=dostoevsky)
+        self.assertEqual([(book.pk, 'War and Peace')], book_index.lookup('pea'))
+        book.title = 'Crime and Punishment'
+        book.save()
+        self.assertEqual([], book_index.lookup('pea'))
+        self.assertEqual([(book.pk, 'Crime and Punishment')], book_index.lookup('crime'))
+
+    def test_ttl(self):
+        author_index.lookup('tol')
+        Author.objects.filter(pk=self.tolstoy.pk).update(family_name='Tolstoi')
+        self.assertEqual('Lev Tolstoy', author_index.lookup('lev')[0][1])
+        with override_settings(CATALOG_AUTOCOMPLETE_TTL=0):
+            self.assertEqual('Lev Tolstoi', author_index.lookup('lev')[0][1])
+
+    def test_bulk_writes_invalidate_other_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with override_settings(CATALOG_AUTOCOMPLETE_CACHE='autocomplete', CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'autocomplete': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                             'LOCATION': directory.name},
+        }):
+            # the indexes of another worker process
+            other_authors = PrefixIndex('authors', author_index.load)
+            other_books = PrefixIndex('books', book_index.load)
+            self.assertEqual([], other_authors.lookup('dost') + other_books.lookup('crime'))
+            path = os.path.join(directory.name, 'feed.jsonl')
+            with open(path, 'w', encoding='utf-8') as feed:
+                feed.write(json.dumps({'title': 'Crime and Punishment', 'title_original': 'Crime and Punishment',
+                                       'author_name': 'Fyodor', 'author_family_name': 'Dostoevsky',
+                                       'price_original': 10}))
+            call_command('import_books', path, stdout=StringIO(), stderr=StringIO())
+            self.assertEqual('Fyodor Dostoevsky', other_authors.lookup('dost')[0][1])
+            self.assertEqual('Crime and Punishment', other_books.lookup('crime')[0][1])
+            with self.assertNumQueries(0):
+                other_authors.lookup('dost')
+
+        with override_settings(CATALOG_AUTOCOMPLETE_CACHE='default'):
+            self.assertIsNone(author_index.cache, "A process local cache can't reach the other workers")
+
+    def test_add_book_view_does_not_render_authors(self):
+        response = self.client.get(reverse('add_book'))
+        self.assertNotContains(response, 'Tolstoy')
+        self.assertContains(response, reverse('api:v1:author-autocomplete'))
+        response = self.client.post(reverse('add_book'), {
+            'title': 'Anna Karenina', 'title_original': 'Anna Karenina', 'author': self.tolstoy.pk
+        })
+        self.assertRedirects(response, reverse('index'))
+        self.assertEqual(self.tolstoy, Book.objects.get(title='Anna Karenina').author)
+
+    def test_admin_uses_autocomplete(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:catalog_book_change', args=(
+            factories.BookFactory.create(author=self.tolkien).pk,
+        )))
+        self.assertContains(response, 'value="John Tolkien"')
+        self.assertNotContains(response, 'Tolstoy')
+
+
+class ImportBooksCommandTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.author = factories.AuthorFactory.create(name='Lev', family_name='Tolstoy')
+        self.category = factories.CategoryFactory.create(name='Classics')
+        DiscountGroup.objects.create(name='Sale', discount=10)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_feed(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as feed:
+            feed.write(content)
+        return path
+
+    def test_import_csv(self):
+        path = self.write_feed('feed.csv', (
+            'title,title_original,year_published,price_original,discount,author_name,author_family_name,publisher,'
+            'discount_group,categories\n'
+            'War and Peace,Война и мир,1869,100,5,Lev,Tolstoy,Zebra Press,Sale,Classics|Novels\n'
+            'Zanzibar Nights,Zanzibar Nights,,20.50,,Quintus,,Zebra Press,,Novels\n'
+            ',No title,,10,,Lev,Tolstoy,,,\n'
+            'Bad price,Bad price,,abc,,Lev,Tolstoy,,,\n'
+            'Unknown group,Unknown group,,10,,Lev,Tolstoy,,Clearance,\n'
+        ))
+        rejects = os.path.join(self.directory.name, 'rejects.jsonl')
+        out = StringIO()
+        call_command('import_books', path, batch_size=1, rejects=rejects, stdout=out, stderr=StringIO())
+        self.assertIn('2 books imported', out.getvalue())
+
+        war_and_peace = Book.objects.get(title='War and Peace')
+        self.assertEqual((self.author, 1869, 'Zebra Press'), (war_and_peace.author, war_and_peace.year_published,
+                                                              war_and_peace.publisher.name))
+        self.assertEqual(('85.00', '15.00'), (str(war_and_peace.price), str(war_and_peace.discount_total)))
+        self.assertEqual(['Classics', 'Novels'], sorted(war_and_peace.categories.values_list('name', flat=True)))
+        zanzibar = Book.objects.get(title='Zanzibar Nights')
+        self.assertEqual(('Quintus', None), (zanzibar.author.name, zanzibar.author.family_name))
+        self.assertEqual(war_and_peace.publisher, zanzibar.publisher)
+        self.assertEqual(1, Category.objects.filter(name='Novels').count())
+        self.assertEqual(2, Category.objects.get(name='Novels').stats.book_count)
+        call_command('rebuild_category_stats', check_only=True, stdout=StringIO())
+        self.assertEqual([zanzibar], list(get_search_backend().search('zanzib*', Book.objects.all())[:10]))
+
+        with open(rejects, encoding='utf-8') as rejected:
+            rejected = [json.loads(line) for line in rejected]
+        self.assertEqual([4, 5, 6], [reject['line'] for reject in rejected])
+        self.assertTrue(rejected[0]['error'].startswith('title:'))
+        self.assertTrue(rejected[1]['error'].startswith('price_original:'))
+        self.assertTrue(rejected[2]['error'].startswith('discount_group:'))
+
+    def test_import_author_without_family_name(self):
+        author = factories.AuthorFactory.create(name='Quintus', family_name='')
+        path = self.write_feed('feed.jsonl', json.dumps({'title': 'Nights', 'title_original': 'Nights',
+                                                         'author_name': 'Quintus', 'price_original': 10}))
+        call_command('import_books', path, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(author, Book.objects.get(title='Nights').author)
+        self.assertEqual(1, Author.objects.filter(name='Quintus').count())
+
+    def test_import_reserves_ids(self):
+        path = self.write_feed('feed.jsonl', json.dumps({'title': 'Nights', 'title_original': 'Nights',
+                                                         'author_name': 'Quintus', 'categories': ['Novels'],
+                                                         'price_original': 10}))
+        with CaptureQueriesContext(connection) as context:
+            call_command('import_books', path, stdout=StringIO(), stderr=StringIO())
+        statements = [query['sql'] for query in context.captured_queries]
+        for table in ('catalog_author', 'catalog_category', 'catalog_book'):
+            read = statements.index('SELECT "{0}"."id" FROM "{0}" ORDER BY "{0}"."id" DESC LIMIT 1'.format(table))
+            self.assertEqual('UPDATE "{}" SET id = id WHERE 0'.format(table), statements[read - 1])
+
+    def test_import_jsonl(self):
+        rows = [{'title': 'Book {}'.format(i), 'title_original': 'Book', 'author_name': 'Author {}'.format(i % 3),
+                 'categories': ['Classics', 'Category {}'.format(i % 4)], 'price_original': 10} for i in range(50)]
+        path = self.write_feed('feed.jsonl', '\n'.join(json.dumps(row) for row in rows) + '\nnot json\n')
+        with self.assertNumQueries(35):
+            call_command('import_books', path, batch_size=25, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(50, Book.objects.count())
+        self.assertEqual(50, Category.objects.get(name='Classics').stats.book_count)
+        self.assertEqual(3, Author.objects.filter(name__startswith='Author').count())
+        call_command('rebuild_category_stats', check_only=True, stdout=StringIO())
+
+
+class SeedBenchmarkCommandTestCase(TestCase):
+    def seed(self, **options):
+        options = dict({'books': 40, 'users': 8, 'relations': 150, 'authors': 5, 'categories': 4, 'seed': 7,
+                        'batch_size': 16}, **options)
+        call_command('seed_benchmark', stdout=StringIO(), **options)
+
+    def test_seed_benchmark(self):
+        self.seed()
+        self.assertEqual((40, 8, 5, 4), (Book.objects.count(), User.objects.count(), Author.objects.count(),
+                                         Category.objects.count()))
+        self.assertEqual(150, UserBookRelation.objects.count())
+        self.assertTrue(Book.categories.through.objects.exists())
+        call_command('rebuild_category_stats', check_only=True, stdout=StringIO())
+        call_command('repair_library_stats', check_only=True, stdout=StringIO())
+        expected_stats = BookStats.objects.calculate(list(Book.objects.values_list('id', flat=True)))
+        self.assertEqual({book_id: stats.rating_count for book_id, stats in expected_stats.items()},
+                         dict(BookStats.objects.values_list('book_id', 'rating_count')))
+        self.assertTrue(LeaderboardEntry.objects.exists())
+        # the longest title whose words no other title has
+        titles = Counter(frozenset(title.lower().split()) for title in Book.objects.values_list('title', flat=True))
+        book = max((book for book in Book.objects.order_by('id') if titles[frozenset(book.title.lower().split())] == 1),
+                   key=lambda book: len(set(book.title.lower().split())))
+        self.assertEqual([book], list(get_search_backend().search(book.title, Book.objects.all())[:1]))
+
+        readers = sorted(UserLibraryStats.objects.values_list('bookmark_count', 'wishlist_count', 'rating_count'),
+                         key=sum)
+        self.assertGreater(sum(readers[-1]), 150 / 8, "Reading activity should be skewed")
+
+    def test_seed_benchmark_is_reproducible(self):
+        def dataset():
+            return (list(Book.objects.order_by('id').values_list('id', 'title', 'author_id', 'price')),
+                    list(Book.categories.through.objects.order_by('book_id', 'category_id').values_list(
+                        'book_id', 'category_id'
+                    )),
+                    list(UserBookRelation.objects.order_by('user_id', 'book_id').values_list(
+                        'user_id', 'book_id', 'rating', 'in_bookmarks', 'in_wishlist'
+                    )))
+
+        self.seed()
+        seeded = dataset()
+        for model in (User, Author, Category):
+            model.objects.all().delete()
+        self.seed()
+        self.assertEqual(seeded, dataset())
+        self.seed(seed=8)
+        self.assertNotEqual([book[1] for book in seeded[0]], [book[1] for book in dataset()[0][40:]])
@@ -2,6 +2,7 @@ from django.shortcuts import render
 from django.views.generic.list import ListView
 from django.views.generic import CreateView, TemplateView
 from .models import Book
+from .forms import BookForm
 from django.urls import reverse
 
 
@@ -13,8 +14,8 @@ class IndexView(TemplateView):
 
 class AddBookView(CreateView):
     model = Book
+    form_class = BookForm
     template_name = 'catalog/book_create.html'
-    fields = ['title', 'title_original', 'author', 'categories']
 
     def get_success_url(self):
         return reverse('index')
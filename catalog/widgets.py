@@ -0,0 +1,27 @@
+from django import forms
+from django.urls import reverse_lazy
+
+
+class AutocompleteWidget(forms.Widget):
+    """
+    Foreign key input backed by an autocomplete endpoint instead of a <select> with every row as an option.
+    """
+    template_name = 'catalog/widgets/autocomplete.html'
+
+    class Media:
+        js = ('catalog/js/autocomplete.js',)
+
+    def __init__(self, model, url_name, label=str, attrs=None):
+        super().__init__(attrs)
+        self.model = model
+        self.url = reverse_lazy(url_name)
+        self.label = label
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        instance = self.model._default_manager.filter(pk=value).first() if value not in (None, '') else None
+        context['widget'].update({
+            'url': self.url,
+            'label': self.label(instance) if instance else '',
+        })
+        return context
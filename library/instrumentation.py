@@ -0,0 +1,73 @@
+from functools import partial
+from time import perf_counter
+from django.db import connections
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+
+
+class ConnectionInstrumentation(object):
+    """
+    Statement counters of a connection, and the slow query log its slow statements are reported to.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0
+        self.slow_query_log = None
+
+    def query_done(self, connection, sql, params, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        slow_query_log = self.slow_query_log
+        if slow_query_log is not None and seconds >= slow_query_log.threshold:
+            # the EXPLAIN run by the log is not reported again
+            self.slow_query_log = None
+            try:
+                slow_query_log.record(connection, sql, params, seconds)
+            finally:
+                self.slow_query_log = slow_query_log
+
+
+class InstrumentedCursorMixin(object):
+    def execute(self, sql, params=None):
+        return self.timed(super().execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        # the statement is not explained for a list of parameters
+        return self.timed(super().executemany, sql, param_list, explain=False)
+
+    def timed(self, execute, sql, params, explain=True):
+        started = perf_counter()
+        try:
+            result = execute(sql, params)
+        except Exception:
+            # a failed statement is not explained either, it may have aborted the transaction
+            self.db.instrumentation.query_done(self.db, sql, None, perf_counter() - started)
+            raise
+        self.db.instrumentation.query_done(self.db, sql, params if explain else None, perf_counter() - started)
+        return result
+
+
+class InstrumentedCursorWrapper(InstrumentedCursorMixin, CursorWrapper):
+    pass
+
+
+class InstrumentedCursorDebugWrapper(InstrumentedCursorMixin, CursorDebugWrapper):
+    pass
+
+
+def instrumented_connections():
+    # Django 1.11 has no execute_wrapper, the cursors of the connections of the thread are replaced instead
+    for connection in connections.all():
+        if not hasattr(connection, 'instrumentation'):
+            connection.instrumentation = ConnectionInstrumentation()
+            connection.make_cursor = partial(InstrumentedCursorWrapper, db=connection)
+            connection.make_debug_cursor = partial(InstrumentedCursorDebugWrapper, db=connection)
+        yield connection
+
+
+def sql_totals():
+    queries, seconds = 0, 0
+    for connection in instrumented_connections():
+        queries += connection.instrumentation.queries
+        seconds += connection.instrumentation.seconds
+    return queries, seconds
@@ -0,0 +1,92 @@
+import json
+import time
+from collections import OrderedDict, defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from library.profiling import ProfileSpool
+
+SORT_COLUMNS = {'own': 1, 'cumulative': 2}
+
+
+class Command(BaseCommand):
+    help = (
+        'Aggregates the request profiles written by library.profiling.ProfilingMiddleware into the hottest functions '
+        'of every view. Sampled requests are profiled with cProfile, slow ones with stack samples, their times are '
+        'added up.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spool', help='Spool directory, PROFILING_SPOOL_DIR by default')
+        parser.add_argument('--view', action='append', dest='views', metavar='NAME',
+                            help='Only this view (e.g. BookViewSet.list), can be repeated')
+        parser.add_argument('--trigger', choices=('sample', 'slow'), help='Only sampled or only slow requests')
+        parser.add_argument('--since', type=float, help='Only profiles of the last given hours')
+        parser.add_argument('--top', type=int, default=15, help='Functions listed per view')
+        parser.add_argument('--sort', choices=sorted(SORT_COLUMNS), default='own', help='Function ordering')
+        parser.add_argument('--output', help='File receiving the aggregate as JSON')
+
+    def handle(self, *args, **options):
+        directory = options['spool'] or getattr(settings, 'PROFILING_SPOOL_DIR', None)
+        if not directory:
+            raise CommandError('No spool directory, set PROFILING_SPOOL_DIR or pass --spool')
+        views = self.aggregate(ProfileSpool(directory).read(), options)
+        if not views:
+            self.stdout.write('No profiles found in {}'.format(directory))
+            return
+        column = SORT_COLUMNS[options['sort']]
+        report = OrderedDict()
+        for name, view in sorted(views.items(), key=lambda item: item[1]['seconds'], reverse=True):
+            functions = sorted(view['functions'].items(), key=lambda item: item[1][column], reverse=True)
+            report[name] = OrderedDict([
+                ('requests', view['requests']),
+                ('sampled', view['sampled']),
+                ('slow', view['slow']),
+                ('seconds', view['seconds']),
+                ('sql_seconds', view['sql_seconds']),
+                ('sql_queries', view['sql_queries']),
+                ('functions', [OrderedDict([('function', label), ('calls', calls), ('own', own),
+                                            ('cumulative', cumulative)])
+                               for label, (calls, own, cumulative) in functions[:options['top']]]),
+            ])
+            self.write_view(name, report[name])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+    @staticmethod
+    def aggregate(profiles, options):
+        oldest = None if options['since'] is None else time.time() - options['since'] * 3600
+        views = defaultdict(lambda: {'requests': 0, 'sampled': 0, 'slow': 0, 'seconds': 0, 'sql_seconds': 0,
+                                     'sql_queries': 0, 'functions': defaultdict(lambda: [0, 0, 0])})
+        for profile in profiles:
+            name = profile['view'] or '{} {}'.format(profile['method'], profile['path'])
+            if options['views'] and name not in options['views'] or \
+                    options['trigger'] and profile['trigger'] != options['trigger'] or \
+                    oldest is not None and profile['time'] < oldest:
+                continue
+            view = views[name]
+            view['requests'] += 1
+            view['sampled' if profile['trigger'] == 'sample' else 'slow'] += 1
+            view['seconds'] += profile['seconds']
+            if 'sql' in profile:
+                view['sql_seconds'] += profile['sql']['seconds']
+                view['sql_queries'] += profile['sql']['count']
+            for label, calls, own, cumulative in profile['functions']:
+                totals = view['functions'][label]
+                totals[0] += calls or 0
+                totals[1] += own
+                totals[2] += cumulative
+        return views
+
+    def write_view(self, name, view):
+        self.stdout.write(self.style.SUCCESS(
+            '{}: {} requests ({} sampled, {} slow), {:.3f}s, {} queries in {:.3f}s while sampled'.format(
+                name, view['requests'], view['sampled'], view['slow'], view['seconds'], view['sql_queries'],
+                view['sql_seconds']
+            )
+        ))
+        self.stdout.write('  {:>10}{:>10}{:>9}  {}'.format('own s', 'cum s', 'calls', 'function'))
+        for function in view['functions']:
+            self.stdout.write('  {:>10.4f}{:>10.4f}{:>9}  {}'.format(
+                function['own'], function['cumulative'], function['calls'] or '', function['function']
+            ))
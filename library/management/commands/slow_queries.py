@@ -0,0 +1,78 @@
+import json
+from collections import OrderedDict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from library.slow_queries import read_logs
+
+SORT_KEYS = ('seconds', 'count', 'max_seconds')
+
+
+class Command(BaseCommand):
+    help = (
+        'Prints the worst statements of the slow query log written by library.slow_queries.SlowQueryMiddleware, '
+        'the logs of all the worker processes added up per statement fingerprint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log-dir', help='Slow query log directory, SLOW_QUERY_LOG_DIR by default')
+        parser.add_argument('--view', help='Only the statements run by this view (e.g. api:v1:category-list)')
+        parser.add_argument('--top', type=int, default=10, help='Statements listed')
+        parser.add_argument('--sort', choices=SORT_KEYS, default='seconds',
+                            help='Total time, number of occurrences or slowest occurrence')
+        parser.add_argument('--plans', action='store_true', help='Print the EXPLAIN plans')
+        parser.add_argument('--output', help='File receiving the statements as JSON')
+
+    def handle(self, *args, **options):
+        directory = options['log_dir'] or getattr(settings, 'SLOW_QUERY_LOG_DIR', None)
+        if not directory:
+            raise CommandError('No slow query log directory, set SLOW_QUERY_LOG_DIR or pass --log-dir')
+        statements = self.aggregate(read_logs(directory), options['view'])
+        if not statements:
+            self.stdout.write('No slow queries logged in {}'.format(directory))
+            return
+        statements.sort(key=lambda statement: statement[options['sort']], reverse=True)
+        statements = statements[:options['top']]
+        for statement in statements:
+            self.write_statement(statement, options['plans'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(statements, output, indent=2)
+
+    @staticmethod
+    def aggregate(entries, view):
+        statements = OrderedDict()
+        for entry in entries:
+            if view is not None and view not in entry['views']:
+                continue
+            statement = statements.get(entry['id'])
+            if statement is None:
+                statement = statements[entry['id']] = OrderedDict([
+                    ('id', entry['id']), ('fingerprint', entry['fingerprint']), ('sql', entry['sql']),
+                    ('database', entry['database']), ('count', 0), ('seconds', 0), ('max_seconds', 0),
+                    ('views', {}), ('plan', entry['plan']), ('first_seen', entry['first_seen']),
+                    ('last_seen', entry['last_seen']),
+                ])
+            statement['count'] += entry['count']
+            statement['seconds'] += entry['seconds']
+            statement['max_seconds'] = max(statement['max_seconds'], entry['max_seconds'])
+            for name, count in entry['views'].items():
+                statement['views'][name] = statement['views'].get(name, 0) + count
+            statement['plan'] = statement['plan'] or entry['plan']
+            statement['first_seen'] = min(statement['first_seen'], entry['first_seen'])
+            statement['last_seen'] = max(statement['last_seen'], entry['last_seen'])
+        return list(statements.values())
+
+    def write_statement(self, statement, plans):
+        self.stdout.write(self.style.SUCCESS(
+            '{}: {} times, {:.3f}s in total, {:.3f}s at most, {:.3f}s on average'.format(
+                statement['id'], statement['count'], statement['seconds'], statement['max_seconds'],
+                statement['seconds'] / statement['count']
+            )
+        ))
+        views = sorted(statement['views'].items(), key=lambda item: item[1], reverse=True)
+        self.stdout.write('  views: {}'.format(', '.join('{} ({})'.format(name or 'no view', count)
+                                                         for name, count in views)))
+        self.stdout.write('  {}'.format(statement['fingerprint']))
+        if plans:
+            for line in statement['plan'] or ['no plan']:
+                self.stdout.write('    {}'.format(line))
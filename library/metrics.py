@@ -0,0 +1,273 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from time import perf_counter
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from rest_framework.exceptions import NotFound
+from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from library.instrumentation import sql_totals
+
+METRICS_SUFFIX = '.metrics'
+# bytes of the file in use, then entries of key length, value count, key padded to 8 bytes and the values as doubles
+HEADER = struct.Struct('<Q')
+ENTRY = struct.Struct('<II')
+INITIAL_SIZE = 1 << 16
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# values of a series, followed by the latency histogram buckets, the last one being +Inf
+REQUESTS, LATENCY_SUM, SQL_QUERIES, SQL_SECONDS, RESPONSE_BYTES = range(5)
+COUNTERS = (
+    ('library_http_requests_total', REQUESTS, 'Requests by view and method.'),
+    ('library_http_sql_queries_total', SQL_QUERIES, 'SQL queries run while serving the requests.'),
+    ('library_http_sql_duration_seconds_total', SQL_SECONDS, 'Time spent in SQL queries while serving the requests.'),
+    ('library_http_response_bytes_total', RESPONSE_BYTES, 'Bytes of response bodies.'),
+)
+LATENCY_HISTOGRAM = 'library_http_request_duration_seconds'
+
+
+def padded(length):
+    return (length + 7) // 8 * 8
+
+
+def read_entries(buffer, used):
+    # (key, index of the first value in doubles, number of values)
+    offset = HEADER.size
+    while offset < used:
+        key_length, count = ENTRY.unpack_from(buffer, offset)
+        offset += ENTRY.size
+        key = bytes(buffer[offset:offset + key_length]).decode('utf-8')
+        offset += padded(key_length)
+        yield key, offset // 8, count
+        offset += count * 8
+
+
+class MetricsFile(object):
+    """
+    Memory mapped values of one process, keyed by series. Only its process writes to it, other processes read it
+    at any time: entries are written before the header takes them in and doubles are updated in place.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size < INITIAL_SIZE:
+            os.ftruncate(self.fd, INITIAL_SIZE)
+            size = INITIAL_SIZE
+        self.map_file(size)
+        # a file left by an earlier process with the same pid is carried on, counters never go back
+        self.used = HEADER.unpack_from(self.map, 0)[0] or HEADER.size
+        self.positions = {key: (index, count) for key, index, count in read_entries(self.map, self.used)}
+
+    def map_file(self, size):
+        self.map = mmap.mmap(self.fd, size)
+        self.values = memoryview(self.map).cast('d')
+
+    def position(self, key, count):
+        index, known_count = self.positions.get(key) or self.allocate(key, count)
+        return index if known_count == count else None
+
+    def allocate(self, key, count):
+        encoded = key.encode('utf-8')
+        size = ENTRY.size + padded(len(encoded)) + count * 8
+        if self.used + size > len(self.map):
+            self.grow(self.used + size)
+        ENTRY.pack_into(self.map, self.used, len(encoded), count)
+        self.map[self.used + ENTRY.size:self.used + ENTRY.size + len(encoded)] = encoded
+        self.positions[key] = ((self.used + ENTRY.size + padded(len(encoded))) // 8, count)
+        self.used += size
+        HEADER.pack_into(self.map, 0, self.used)
+        return self.positions[key]
+
+    def grow(self, needed):
+        size = len(self.map)
+        while size < needed:
+            size *= 2
+        self.values.release()
+        self.map.close()
+        os.ftruncate(self.fd, size)
+        self.map_file(size)
+
+    def close(self):
+        self.values.release()
+        self.map.close()
+        os.close(self.fd)
+
+
+class MetricsRecorder(object):
+    """
+    Request metrics of the worker processes: each process writes to its own file of the directory, named after its
+    pid, and collect() sums up the files of all of them.
+    """
+
+    def __init__(self, directory, latency_buckets):
+        self.directory = directory
+        self.latency_buckets = tuple(float(bucket) for bucket in latency_buckets)
+        self.value_count = RESPONSE_BYTES + 1 + len(self.latency_buckets) + 1
+        self.lock = threading.Lock()
+        self.pid = None
+        self.file = None
+
+    def get_file(self):
+        # forked workers must not write to the file of their parent
+        if self.pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            self.pid = os.getpid()
+            self.file = MetricsFile(os.path.join(self.directory, '{}{}'.format(self.pid, METRICS_SUFFIX)))
+        return self.file
+
+    def record(self, key, seconds, sql_queries, sql_seconds, response_bytes):
+        bucket = RESPONSE_BYTES + 1 + bisect.bisect_left(self.latency_buckets, seconds)
+        with self.lock:
+            metrics_file = self.get_file()
+            index = metrics_file.position(key, self.value_count)
+            if index is None:
+                return
+            values = metrics_file.values
+            values[index + REQUESTS] += 1
+            values[index + LATENCY_SUM] += seconds
+            values[index + SQL_QUERIES] += sql_queries
+            values[index + SQL_SECONDS] += sql_seconds
+            values[index + RESPONSE_BYTES] += response_bytes
+            values[index + bucket] += 1
+
+    def paths(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(names) if name.endswith(METRICS_SUFFIX)]
+
+    def collect(self):
+        series = {}
+        for path in self.paths():
+            try:
+                with open(path, 'rb') as metrics_file:
+                    content = metrics_file.read()
+            except FileNotFoundError:
+                continue
+            doubles = memoryview(content[:len(content) // 8 * 8]).cast('d')
+            for key, index, count in read_entries(content, HEADER.unpack_from(content, 0)[0]):
+                # series written with other latency buckets are left out
+                if count == self.value_count:
+                    totals = series.setdefault(key, [0] * count)
+                    for position, value in enumerate(doubles[index:index + count]):
+                        totals[position] += value
+        return OrderedDict(sorted(series.items()))
+
+    def exposition(self):
+        series = self.collect()
+        lines = []
+        for name, position, description in COUNTERS:
+            lines.extend(['# HELP {} {}'.format(name, description), '# TYPE {} counter'.format(name)])
+            lines.extend('{}{{{}}} {!r}'.format(name, key, float(values[position])) for key, values in series.items())
+        lines.extend(['# HELP {} Request latency.'.format(LATENCY_HISTOGRAM),
+                      '# TYPE {} histogram'.format(LATENCY_HISTOGRAM)])
+        for key, values in series.items():
+            cumulative = 0
+            buckets = values[RESPONSE_BYTES + 1:]
+            for upper_bound, count in zip(self.latency_buckets + (float('inf'),), buckets):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {!r}'.format(
+                    LATENCY_HISTOGRAM, key, '+Inf' if upper_bound == float('inf') else repr(upper_bound),
+                    float(cumulative)
+                ))
+            lines.append('{}_sum{{{}}} {!r}'.format(LATENCY_HISTOGRAM, key, float(values[LATENCY_SUM])))
+            lines.append('{}_count{{{}}} {!r}'.format(LATENCY_HISTOGRAM, key, float(values[REQUESTS])))
+        return '\n'.join(lines) + '\n'
+
+
+@lru_cache(maxsize=None)
+def get_recorder(directory, latency_buckets):
+    # one recorder, and so one writer of the process file, per directory
+    return MetricsRecorder(directory, latency_buckets)
+
+
+def configured_recorder():
+    directory = getattr(settings, 'METRICS_DIR', None)
+    if not directory:
+        return None
+    return get_recorder(directory, tuple(getattr(settings, 'METRICS_LATENCY_BUCKETS', DEFAULT_LATENCY_BUCKETS)))
+
+
+def label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+@lru_cache(maxsize=1024)
+def series_key(view, method):
+    return 'view="{}",method="{}"'.format(label_value(view), method if method in METHODS else 'OTHER')
+
+
+class MetricsMiddleware(object):
+    """
+    Records the requests count, latency histogram, SQL queries and response bytes of every resolved view (its URL
+    name, e.g. api:v1:book-list) and method into METRICS_DIR, served by MetricsView. Streaming responses are recorded
+    once their content is consumed.
+    """
+
+    def __init__(self, get_response):
+        self.recorder = configured_recorder()
+        if self.recorder is None:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = perf_counter()
+        sql_started = sql_totals()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        key = series_key(match.view_name if match else 'unresolved', request.method)
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, key, started, sql_started)
+        else:
+            self.record(key, started, sql_started, len(response.content))
+        return response
+
+    def stream(self, content, key, started, sql_started):
+        response_bytes = 0
+        try:
+            for chunk in content:
+                response_bytes += len(chunk)
+                yield chunk
+        finally:
+            self.record(key, started, sql_started, response_bytes)
+
+    def record(self, key, started, sql_started, response_bytes):
+        seconds = perf_counter() - started
+        queries, sql_seconds = sql_totals()
+        self.recorder.record(key, seconds, queries - sql_started[0], sql_seconds - sql_started[1], response_bytes)
+
+
+class PrometheusRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'prometheus'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            # errors
+            data = '{}\n'.format(data.get('detail', ''))
+        return data.encode(self.charset)
+
+
+class MetricsView(APIView):
+    """
+    Request metrics of all the worker processes in the Prometheus text format.
+    """
+    permission_classes = (IsAdminUser,)
+    renderer_classes = (PrometheusRenderer,)
+
+    def get(self, request):
+        recorder = configured_recorder()
+        if recorder is None:
+            raise NotFound('Metrics are disabled, set METRICS_DIR')
+        return Response(recorder.exposition(), content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,252 @@
+import cProfile
+import gzip
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import lru_cache
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+SPOOL_SUFFIX = '.json.gz'
+# functions kept per profile, the top ones by own time and by cumulative time
+FUNCTIONS_KEPT = 100
+# innermost frames kept per stack sample
+STACK_DEPTH = 64
+SLOWEST_QUERIES_KEPT = 5
+
+
+@lru_cache(maxsize=None)
+def path_prefixes():
+    return sorted((os.path.join(os.path.abspath(path), '') for path in sys.path if path), key=len, reverse=True)
+
+
+@lru_cache(maxsize=4096)
+def function_label(filename, line, name):
+    # pstats style label, relative to the sys.path entry the module was imported from
+    for prefix in path_prefixes():
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):]
+            break
+    return '{}:{}({})'.format(filename, line, name)
+
+
+def top_functions(rows):
+    # rows are [label, calls, own seconds, cumulative seconds]
+    kept = {row[0]: row for row in sorted(rows, key=lambda row: row[2], reverse=True)[:FUNCTIONS_KEPT]}
+    kept.update((row[0], row) for row in sorted(rows, key=lambda row: row[3], reverse=True)[:FUNCTIONS_KEPT])
+    return sorted(kept.values(), key=lambda row: row[3], reverse=True)
+
+
+def cprofile_functions(profiler):
+    return top_functions([
+        [function_label(*key), calls, own, cumulative]
+        for key, (_, calls, own, cumulative, _) in pstats.Stats(profiler).stats.items()
+    ])
+
+
+def stack_functions(stacks, interval):
+    own, cumulative = Counter(), Counter()
+    for stack, count in stacks.items():
+        own[stack[0]] += count
+        for label in set(stack):
+            cumulative[label] += count
+    return top_functions([[label, None, own[label] * interval, count * interval]
+                          for label, count in cumulative.items()])
+
+
+class StackSampler(object):
+    """
+    Background thread collecting the stacks of the threads registered with start() every interval seconds. It is
+    cheap enough to run for every request, so requests found to be slow once they are done still have a profile.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = {}
+        self.condition = threading.Condition()
+        self.pid = None
+
+    def ensure_thread(self):
+        # after a fork the sampling thread only exists in the parent process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name='profiling-stack-sampler', daemon=True).start()
+
+    def start(self):
+        with self.condition:
+            self.ensure_thread()
+            self.stacks[threading.get_ident()] = Counter()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            return self.stacks.pop(threading.get_ident(), Counter())
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stacks:
+                    self.condition.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.condition:
+                for thread_id, stacks in self.stacks.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None and len(stack) < STACK_DEPTH:
+                        code = frame.f_code
+                        stack.append(function_label(code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    if stack:
+                        stacks[tuple(stack)] += 1
+
+
+class ProfileSpool(object):
+    """
+    Directory of gzipped JSON profiles, one per request, named after their creation time. Every process writes to it
+    and the oldest files are removed once there are more than max_files.
+    """
+
+    def __init__(self, directory, max_files=2000):
+        self.directory = directory
+        self.max_files = max_files
+
+    def paths(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(names) if name.endswith(SPOOL_SUFFIX)]
+
+    def write(self, profile):
+        os.makedirs(self.directory, exist_ok=True)
+        name = '{:016d}-{}{}'.format(int(time.time() * 1000000), uuid.uuid4().hex[:12], SPOOL_SUFFIX)
+        path = os.path.join(self.directory, name)
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as spool_file:
+            json.dump(profile, spool_file, separators=(',', ':'))
+        # readers never see a partial file
+        os.replace(path + '.tmp', path)
+        self.rotate()
+        return path
+
+    def rotate(self):
+        paths = self.paths()
+        for path in paths[:max(len(paths) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # removed by another process rotating at the same time
+                pass
+
+    def read(self):
+        for path in self.paths():
+            try:
+                with gzip.open(path, 'rt', encoding='utf-8') as spool_file:
+                    yield json.load(spool_file)
+            except (FileNotFoundError, EOFError, ValueError):
+                continue
+
+
+def view_name(view_func, method):
+    # BookViewSet.list for viewsets, the dotted path of the function or class otherwise
+    view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+    if view_class is None:
+        return '{}.{}'.format(view_func.__module__, view_func.__name__)
+    action = (getattr(view_func, 'actions', None) or {}).get(method.lower(), method.lower())
+    return '{}.{}'.format(view_class.__name__, action)
+
+
+class ProfilingMiddleware(object):
+    """
+    Production profiler. PROFILING_SAMPLE_RATE of the requests run under cProfile with their SQL queries timed, the
+    others are stack sampled and kept when they take PROFILING_SLOW_REQUEST_SECONDS or more. Profiles go to the
+    PROFILING_SPOOL_DIR spool, aggregated with the aggregate_profiles command. Streaming responses are profiled up
+    to the start of the stream.
+    """
+
+    def __init__(self, get_response):
+        spool_dir = getattr(settings, 'PROFILING_SPOOL_DIR', None)
+        if not spool_dir:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.spool = ProfileSpool(spool_dir, getattr(settings, 'PROFILING_SPOOL_MAX_FILES', 2000))
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.01)
+        self.slow_seconds = getattr(settings, 'PROFILING_SLOW_REQUEST_SECONDS', None)
+        self.sampler = None
+        if self.slow_seconds is not None:
+            self.sampler = StackSampler(getattr(settings, 'PROFILING_STACK_INTERVAL', 0.005))
+
+    def __call__(self, request):
+        if random.random() < self.sample_rate:
+            return self.profile_request(request)
+        if self.sampler is None:
+            return self.get_response(request)
+        self.sampler.start()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            stacks = self.sampler.stop()
+        seconds = time.perf_counter() - started
+        if seconds >= self.slow_seconds:
+            self.spool.write(self.get_profile(request, response, seconds, 'slow', profiler='stack',
+                                              interval=self.sampler.interval,
+                                              functions=stack_functions(stacks, self.sampler.interval)))
+        return response
+
+    def profile_request(self, request):
+        databases = list(connections.all())
+        debug_cursors = [(connection.force_debug_cursor, len(connection.queries_log)) for connection in databases]
+        for connection in databases:
+            connection.force_debug_cursor = True
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        finally:
+            queries = []
+            for connection, (force_debug_cursor, logged) in zip(databases, debug_cursors):
+                connection.force_debug_cursor = force_debug_cursor
+                queries.extend((connection.alias, query) for query in list(connection.queries_log)[logged:])
+        seconds = time.perf_counter() - started
+        self.spool.write(self.get_profile(request, response, seconds, 'sample', profiler='cprofile',
+                                          functions=cprofile_functions(profiler), sql=self.get_sql(queries)))
+        return response
+
+    @staticmethod
+    def get_sql(queries):
+        timed = sorted(((float(query['time']), alias, query['sql']) for alias, query in queries), reverse=True)
+        return {
+            'count': len(timed),
+            'seconds': sum(seconds for seconds, _, _ in timed),
+            'slowest': [{'seconds': seconds, 'alias': alias, 'sql': sql[:1000]}
+                        for seconds, alias, sql in timed[:SLOWEST_QUERIES_KEPT]],
+        }
+
+    @staticmethod
+    def get_profile(request, response, seconds, trigger, **profile):
+        profile.update({
+            'view': getattr(request, 'profiling_view', None),
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'seconds': seconds,
+            'time': time.time(),
+            'pid': os.getpid(),
+            'trigger': trigger,
+        })
+        return profile
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.profiling_view = view_name(view_func, request.method)
@@ -0,0 +1,133 @@
+import random
+import threading
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SAFE_METHODS = ('GET', 'HEAD')
+STICKY_COOKIE = 'primary_reads'
+WRITE_KEY = 'replica:write:{}'
+
+local = threading.local()
+
+
+def transaction_state():
+    connection = connections[DEFAULT_DB_ALIAS]
+    return connection.in_atomic_block, len(connection.savepoint_ids)
+
+
+def read_replica():
+    # reads inside a transaction started since the replica was chosen see the writes of the transaction
+    replica = getattr(local, 'replica', None)
+    if replica is None or transaction_state() != local.transaction_state:
+        return None
+    return replica
+
+
+def get_writes_cache():
+    alias = getattr(settings, 'REPLICA_WRITES_CACHE', None)
+    if not alias:
+        return None
+    cache = caches[alias]
+    # a write recorded in one worker process would never be seen by the others
+    return None if isinstance(cache, (LocMemCache, DummyCache)) else cache
+
+
+def record_write(user):
+    cache, sticky_seconds = get_writes_cache(), getattr(settings, 'REPLICA_STICKY_SECONDS', 0)
+    if cache is not None and sticky_seconds:
+        cache.set(WRITE_KEY.format(user.pk), True, sticky_seconds)
+
+
+def wrote_recently(user):
+    cache = get_writes_cache()
+    # without a shared record of the writes, any authenticated user may just have written
+    return cache is None or cache.get(WRITE_KEY.format(user.pk)) is not None
+
+
+def use_primary_after_write(user):
+    """
+    Moves the reads of an authenticated request back to the primary when its user wrote within
+    REPLICA_STICKY_SECONDS. Views call it once the request is authenticated, which also covers the clients that do
+    not send the cookie back.
+    """
+    if getattr(local, 'replica', None) is not None and user.is_authenticated and wrote_recently(user):
+        local.replica = None
+
+
+class ReplicaRouter(object):
+    """
+    Sends the reads of the requests ReplicaMiddleware picked a replica for to that replica, everything else to the
+    primary, default.
+    """
+
+    def db_for_read(self, model, **hints):
+        return read_replica()
+
+    def db_for_write(self, model, **hints):
+        # not the replica an instance was read from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS}.union(getattr(settings, 'REPLICA_DATABASES', ()))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaMiddleware(object):
+    """
+    Reads of the GET and HEAD requests to the views of REPLICA_URL_NAMESPACES go to one of REPLICA_DATABASES. A
+    client writing anything gets a signed cookie keeping its reads on the primary for REPLICA_STICKY_SECONDS, so it
+    sees its own changes despite the replication lag. The writes of authenticated users are also recorded in
+    REPLICA_WRITES_CACHE for the views calling use_primary_after_write(), which token clients ignoring cookies need.
+    """
+
+    def __init__(self, get_response):
+        self.replicas = list(getattr(settings, 'REPLICA_DATABASES', ()))
+        if not self.replicas:
+            raise MiddlewareNotUsed()
+        self.namespaces = set(getattr(settings, 'REPLICA_URL_NAMESPACES', ()))
+        self.sticky_seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 0)
+        self.get_response = get_response
+
+    def __call__(self, request):
+        local.replica = None
+        try:
+            response = self.get_response(request)
+        except Exception:
+            local.replica = None
+            raise
+        if request.method not in SAFE_METHODS and response.status_code < 400 and self.sticky_seconds:
+            response.set_signed_cookie(STICKY_COOKIE, '1', salt=STICKY_COOKIE, max_age=self.sticky_seconds,
+                                       httponly=True)
+            # the user authenticated by the view, DRF sets it on the Django request as well
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                record_write(user)
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content)
+        else:
+            local.replica = None
+        return response
+
+    def stream(self, content):
+        # exports read while they stream
+        try:
+            yield from content
+        finally:
+            local.replica = None
+
+    def is_sticky(self, request):
+        return self.sticky_seconds and request.get_signed_cookie(
+            STICKY_COOKIE, default=None, salt=STICKY_COOKIE, max_age=self.sticky_seconds
+        ) is not None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method in SAFE_METHODS and request.resolver_match.namespace in self.namespaces and \
+                not self.is_sticky(request):
+            local.transaction_state = transaction_state()
+            local.replica = random.choice(self.replicas)
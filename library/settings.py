@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
+import importlib.util
 import os
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -22,7 +23,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SECRET_KEY = 'dk3_03jn!%#=9b41375g_dbt!wc_)g)9-=q586ac9kd=*o4*uf'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.environ.get('DJANGO_DEBUG', 'true').lower() in ('1', 'true', 'yes')
 
 ALLOWED_HOSTS = []
 
@@ -38,14 +39,17 @@ INSTALLED_APPS = [
     # packages
     'rest_framework',
     'django_filters',
-    'debug_toolbar',
     # apps
     'library',
     'catalog',
+    'api',
 ]
 
 MIDDLEWARE = [
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'library.metrics.MetricsMiddleware',
+    'library.profiling.ProfilingMiddleware',
+    'library.slow_queries.SlowQueryMiddleware',
+    'library.routers.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,6 +59,13 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# a development dependency, left out when DEBUG is off or the package is not installed
+DEBUG_TOOLBAR = DEBUG and importlib.util.find_spec('debug_toolbar') is not None
+if DEBUG_TOOLBAR:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.insert(MIDDLEWARE.index('django.middleware.security.SecurityMiddleware'),
+                      'debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'library.urls'
 
 TEMPLATES = [
@@ -87,6 +98,96 @@ DATABASES = {
     }
 }
 
+# Read replicas of default, as a comma separated list of SQLite files in DJANGO_DATABASE_REPLICAS: copies of
+# db.sqlite3 stand in for them locally. The GET and HEAD requests to the views of REPLICA_URL_NAMESPACES read from
+# one of them, see library.routers.
+REPLICA_DATABASES = []
+for number, name in enumerate(filter(None, os.environ.get('DJANGO_DATABASE_REPLICAS', '').split(',')), 1):
+    REPLICA_DATABASES.append('replica{}'.format(number))
+    DATABASES[REPLICA_DATABASES[-1]] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['library.routers.ReplicaRouter']
+REPLICA_URL_NAMESPACES = ['api:v1']
+# Clients read from default for this long after a write, so they see their own changes
+REPLICA_STICKY_SECONDS = 10
+
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# A FileBasedCache (django.core.cache.backends.filebased.FileBasedCache) shares entries between worker processes
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Alias of the cache holding the user independent part of serialized books, None disables it. Invalidations have to
+# reach every worker process, so process local backends (LocMemCache, DummyCache) leave it disabled as well; a
+# FileBasedCache in DJANGO_BOOK_REPRESENTATION_CACHE_DIR enables it. Its MAX_ENTRIES keeps culling away from the
+# version tokens of the books.
+BOOK_REPRESENTATION_CACHE = None
+if os.environ.get('DJANGO_BOOK_REPRESENTATION_CACHE_DIR'):
+    BOOK_REPRESENTATION_CACHE = 'book_representations'
+    CACHES[BOOK_REPRESENTATION_CACHE] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ['DJANGO_BOOK_REPRESENTATION_CACHE_DIR'],
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    }
+BOOK_REPRESENTATION_CACHE_TIMEOUT = 60 * 60
+
+# Alias of the cache recording the last write of every user for REPLICA_STICKY_SECONDS, so the clients that do not
+# send the sticky cookie back still read their own changes. Without a cache shared between the worker processes,
+# the reads of every authenticated user stay on the primary.
+REPLICA_WRITES_CACHE = BOOK_REPRESENTATION_CACHE
+
+# Book lists rendered from values_list() rows by api.v1.compiled instead of the serializers and the representation
+# cache, which still serves the other book responses
+API_COMPILED_LISTS = True
+
+# Full-text book search, catalog.search.DatabaseSearchBackend is the index-less fallback for other databases
+CATALOG_SEARCH_BACKEND = 'catalog.search.SQLiteFTS5SearchBackend'
+
+# Seconds before the in-process author/title autocomplete indexes are rebuilt, None keeps them until restart
+CATALOG_AUTOCOMPLETE_TTL = 5 * 60
+# Alias of the cache holding the versions of the autocomplete indexes, which bulk writes (import_books,
+# recalculate_prices, seed_benchmark) replace so that every process rebuilds its index on the next lookup. Without
+# a cache shared between the processes, rows written in bulk by one of them show up in the autocomplete of the
+# others only after CATALOG_AUTOCOMPLETE_TTL.
+CATALOG_AUTOCOMPLETE_CACHE = BOOK_REPRESENTATION_CACHE
+
+# Books kept per leaderboard, and ratings a book needs before it is ranked by its average
+CATALOG_LEADERBOARD_SIZE = 100
+CATALOG_LEADERBOARD_MIN_RATINGS = 3
+
+# Request profiling by library.profiling.ProfilingMiddleware, off while PROFILING_SPOOL_DIR is empty;
+# aggregate the spool with the aggregate_profiles command
+PROFILING_SPOOL_DIR = os.environ.get('DJANGO_PROFILING_SPOOL_DIR')
+# Fraction of the requests profiled with cProfile and timed SQL queries
+PROFILING_SAMPLE_RATE = 0.01
+# Other requests are stack sampled every PROFILING_STACK_INTERVAL seconds and kept past this duration, None disables
+PROFILING_SLOW_REQUEST_SECONDS = 1.0
+PROFILING_STACK_INTERVAL = 0.005
+# Oldest profiles are removed past this number of files
+PROFILING_SPOOL_MAX_FILES = 2000
+
+# Per view request metrics recorded by library.metrics.MetricsMiddleware, one memory mapped file per worker process,
+# summed up by the staff only /metrics endpoint in the Prometheus text format; off while METRICS_DIR is empty.
+# Files of exited workers keep counting, the directory is emptied when all the workers are restarted.
+METRICS_DIR = os.environ.get('DJANGO_METRICS_DIR')
+# Upper bounds in seconds of the latency histogram buckets
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Statements of SLOW_QUERY_SECONDS or more, logged by library.slow_queries.SlowQueryMiddleware with the view running
+# them and their EXPLAIN plan, grouped by normalized statement in one JSON file per worker process of
+# SLOW_QUERY_LOG_DIR; off while it is empty. The slow_queries command prints the worst offenders.
+SLOW_QUERY_LOG_DIR = os.environ.get('DJANGO_SLOW_QUERY_LOG_DIR')
+SLOW_QUERY_SECONDS = 0.1
+# Statements of new fingerprints are left out of a process log past this number
+SLOW_QUERY_LOG_MAX_FINGERPRINTS = 1000
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
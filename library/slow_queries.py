@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from library.instrumentation import instrumented_connections
+
+LOG_SUFFIX = '.slow-queries.json'
+SQL_KEPT = 2000
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'(?<![\w."])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b')
+PLACEHOLDER_RE = re.compile(r'%s|\?')
+PLACEHOLDER_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+ROW_LIST_RE = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+local = threading.local()
+
+
+def fingerprint(sql):
+    """
+    The statement with its literals and placeholders replaced by ?, lists of them by (...), so the statements of a
+    queryset are grouped whatever their parameters and the length of their IN lists.
+    """
+    sql = STRING_RE.sub('?', sql)
+    sql = NUMBER_RE.sub('?', sql)
+    sql = PLACEHOLDER_RE.sub('?', sql)
+    sql = PLACEHOLDER_LIST_RE.sub('(...)', sql)
+    sql = ROW_LIST_RE.sub('(...)', sql)
+    return WHITESPACE_RE.sub(' ', sql).strip()
+
+
+def fingerprint_id(fingerprint):
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:12]
+
+
+def explain(connection, sql, params):
+    # a cursor of the backend, bypassing the instrumentation and the query log
+    cursor = connection.create_cursor()
+    try:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute('EXPLAIN ' + sql, params)
+        return [' '.join(str(value) for value in row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def current_view():
+    return getattr(local, 'view', None)
+
+
+class SlowQueryLog(object):
+    """
+    Statements of this process slower than threshold seconds, grouped by fingerprint with their count, their total
+    and slowest times, the views running them and the EXPLAIN plan of the first SELECT. Written to a JSON file of
+    the directory named after the pid whenever a statement is added, read back by the slow_queries command.
+    """
+
+    def __init__(self, directory, threshold, max_fingerprints=1000):
+        self.directory = directory
+        self.threshold = threshold
+        self.max_fingerprints = max_fingerprints
+        self.lock = threading.Lock()
+        self.pid = None
+        self.entries = {}
+
+    def path(self):
+        return os.path.join(self.directory, '{}{}'.format(self.pid, LOG_SUFFIX))
+
+    def load(self):
+        # forked workers start from their own file, not from the statements of their parent
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.entries = {entry['id']: entry for entry in read_log(self.path())}
+
+    def record(self, connection, sql, params, seconds):
+        sql_fingerprint = fingerprint(sql)
+        key = fingerprint_id(sql_fingerprint)
+        view = current_view() or ''
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= self.max_fingerprints:
+                    return
+                entry = self.entries[key] = {
+                    'id': key, 'fingerprint': sql_fingerprint, 'sql': sql[:SQL_KEPT], 'database': connection.alias,
+                    'count': 0, 'seconds': 0, 'max_seconds': 0, 'views': {}, 'plan': None, 'first_seen': time.time(),
+                }
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['views'][view] = entry['views'].get(view, 0) + 1
+            entry['last_seen'] = time.time()
+            if entry['plan'] is None and params is not None and sql.lstrip()[:6].upper() == 'SELECT':
+                try:
+                    entry['plan'] = explain(connection, sql, params)
+                except Exception as error:
+                    entry['plan'] = ['EXPLAIN failed: {}'.format(error)]
+            self.write()
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path()
+        with open(path + '.tmp', 'w') as log_file:
+            json.dump(list(self.entries.values()), log_file)
+        os.replace(path + '.tmp', path)
+
+
+def read_log(path):
+    try:
+        with open(path) as log_file:
+            return json.load(log_file)
+    except (FileNotFoundError, ValueError):
+        return []
+
+
+def read_logs(directory):
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.endswith(LOG_SUFFIX):
+            yield from read_log(os.path.join(directory, name))
+
+
+@lru_cache(maxsize=None)
+def get_log(directory, threshold, max_fingerprints):
+    # one log, and so one writer of the process file, per directory
+    return SlowQueryLog(directory, threshold, max_fingerprints)
+
+
+class SlowQueryMiddleware(object):
+    """
+    Reports the statements of the requests taking SLOW_QUERY_SECONDS or more to the slow query log of
+    SLOW_QUERY_LOG_DIR, along with the URL name of the view running them.
+    """
+
+    def __init__(self, get_response):
+        directory = getattr(settings, 'SLOW_QUERY_LOG_DIR', None)
+        if not directory:
+            raise MiddlewareNotUsed()
+        self.log = get_log(directory, getattr(settings, 'SLOW_QUERY_SECONDS', 0.1),
+                           getattr(settings, 'SLOW_QUERY_LOG_MAX_FINGERPRINTS', 1000))
+        self.get_response = get_response
+
+    def __call__(self, request):
+        self.attach(self.log, None)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            self.attach(None, None)
+            raise
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content)
+        else:
+            self.attach(None, None)
+        return response
+
+    def stream(self, content):
+        try:
+            yield from content
+        finally:
+            self.attach(None, None)
+
+    @staticmethod
+    def attach(log, view):
+        local.view = view
+        for connection in instrumented_connections():
+            connection.instrumentation.slow_query_log = log
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        local.view = request.resolver_match.view_name